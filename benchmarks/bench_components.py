@@ -0,0 +1,190 @@
+"""
+组件基准测试：生成不同形态和大小的文档（多级标题、大表格、大量图片），分阶段测量解析、知识块拼接、段落合并和响应序列化的
+耗时、Python 内存峰值（tracemalloc）和阶段结束时仍然存活的新分配内存块数量，可以保存为基线并与基线比较，超过阈值时以非0状态退出。
+不需要 Qdrant 和 Embedding 服务。在项目根目录执行：
+
+    PYTHONPATH=src:tests python benchmarks/bench_components.py --sizes small medium --save-baseline baseline.json
+    PYTHONPATH=src:tests python benchmarks/bench_components.py --sizes small medium --baseline baseline.json
+
+耗时取多次运行的中位数，内存统计单独运行一次，避免 tracemalloc 影响计时。比较基线时至少重复5次，
+与基线的差值同时超过比例阈值和绝对下限才视为退化，避免几毫秒的阶段因为计时抖动被误报。基线与机器相关，应在同一台机器上比较。
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable
+
+from docx_factory import SHAPES, SIZES, make
+
+DEFAULT_SHAPES = ["deep-headings", "huge-tables", "many-images"]
+
+
+def stages(path: str, img_path: str) -> dict[str, Callable[[], object]]:
+    """文档的各个测量阶段，阶段之间共享已经解析的结果，只测量阶段本身"""
+    import docx
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+
+    from common import success
+    from kb.doc_retriever import DocRetriever, merge_chunks
+    from kb.kb_config import DocxSchema
+    from kb.kb_loader import DocxLoader, DocxStreamLoader, convert_table_to_markdown
+
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        loader = DocxLoader(path, img_path=img_path, doc_id="bench")
+        docs = list(loader.lazy_load())
+    leaves = list(loader)
+    groups: dict[str, list[str]] = {}
+    for doc in docs:
+        groups.setdefault(doc.metadata[DocxSchema.PARENT_ID], []).append(doc.page_content)
+    # _merge_doc 只使用静态方法，不需要连接知识库
+    retriever = object.__new__(DocRetriever)
+
+    def quiet(fn: Callable[[], object]) -> Callable[[], object]:
+        # 加载器解析图片时会打印图题，输出不计入测量
+        def run():
+            with open(os.devnull, "w") as out, contextlib.redirect_stdout(out):
+                return fn()
+
+        return run
+
+    def pairwise_merge():
+        res = []
+        for contents in groups.values():
+            merged = contents[0]
+            for content in contents[1:]:
+                merged = DocRetriever.merge_with_common_prefix(merged, content)
+            res.append(merged)
+        return res
+
+    return {
+        "docx.open": lambda: docx.Document(path),
+        "loader.parse_to_tree": quiet(loader.parse_to_tree),
+        "loader.tables_to_markdown": lambda: [convert_table_to_markdown(t) for t in loader.document.tables],
+        "node.get_value_from_tree": lambda: [leaf.get_value_from_tree() for leaf in leaves],
+        "loader.lazy_load": quiet(lambda: list(DocxLoader(path, img_path=img_path, doc_id="bench").lazy_load())),
+        "stream_loader.lazy_load": quiet(
+            lambda: list(DocxStreamLoader(path, img_path=img_path, doc_id="bench").lazy_load())),
+        "retriever.merge_doc": lambda: retriever._merge_doc(list(docs)),
+        "retriever.merge_chunks": lambda: [merge_chunks(contents) for contents in groups.values()],
+        "retriever.merge_with_common_prefix": pairwise_merge,
+        "response.serialize": lambda: JSONResponse(
+            content=jsonable_encoder(success(data=[vars(doc) for doc in docs]))).body,
+    }
+
+
+def measure(fn: Callable[[], object], repeat: int) -> dict[str, float]:
+    """耗时取中位数；内存峰值和存活内存块在开启 tracemalloc 后单独运行一次"""
+    fn()  # 预热，排除首次导入和缓存的影响
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+    del result
+    return {"ms": statistics.median(times) * 1000, "peak_kb": (peak - base) / 1024, "blocks": blocks}
+
+
+MIN_COMPARE_REPEAT = 5
+"""与基线比较时的最少计时次数，次数太少时中位数不稳定"""
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], time_tolerance: float, memory_tolerance: float,
+            time_floor: float = 2., memory_floor: float = 64.) -> list[str]:
+    """
+    与基线比较，返回退化的项目
+    Args:
+        results: 本次结果
+        baseline: 基线结果
+        time_tolerance: 耗时超过基线的比例阈值
+        memory_tolerance: 内存峰值超过基线的比例阈值
+        time_floor: 耗时差值的绝对下限（毫秒），差值低于该值时忽略
+        memory_floor: 内存峰值差值的绝对下限（KB），差值低于该值时忽略
+    """
+    regressions = []
+    for key, r in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if r["ms"] - base["ms"] > max(base["ms"] * time_tolerance, time_floor):
+            regressions.append(f"{key}: time {base['ms']:.2f} -> {r['ms']:.2f} ms")
+        if r["peak_kb"] - base["peak_kb"] > max(base["peak_kb"] * memory_tolerance, memory_floor):
+            regressions.append(f"{key}: peak {base['peak_kb']:.0f} -> {r['peak_kb']:.0f} KB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shapes", nargs="*", choices=SHAPES, default=DEFAULT_SHAPES, help="文档形态")
+    parser.add_argument("--sizes", nargs="*", choices=SIZES, default=["small"], help="文档大小")
+    parser.add_argument("--stages", nargs="*", help="只运行名称包含这些字符串的阶段")
+    parser.add_argument("--repeat", type=int, default=MIN_COMPARE_REPEAT,
+                        help=f"每个阶段的计时次数，与基线比较时不少于{MIN_COMPARE_REPEAT}")
+    parser.add_argument("--baseline", help="与该基线文件比较")
+    parser.add_argument("--save-baseline", help="将结果保存为基线文件")
+    parser.add_argument("--time-tolerance", type=float, default=0.2, help="耗时超过基线的比例阈值")
+    parser.add_argument("--memory-tolerance", type=float, default=0.1, help="内存峰值超过基线的比例阈值")
+    parser.add_argument("--time-floor", type=float, default=2., help="耗时差值低于该毫秒数时不视为退化")
+    parser.add_argument("--memory-floor", type=float, default=64., help="内存峰值差值低于该KB数时不视为退化")
+    args = parser.parse_args()
+    if (args.baseline or args.save_baseline) and args.repeat < MIN_COMPARE_REPEAT:
+        parser.error(f"--repeat must be at least {MIN_COMPARE_REPEAT} when saving or comparing a baseline")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    results: dict[str, dict] = {}
+    print(f"{'case':<58}{'ms':>10}{'peak KB':>12}{'blocks':>10}{'vs base':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        img_path = os.path.join(tmp, "img")
+        for shape in args.shapes:
+            for size in args.sizes:
+                path = os.path.join(tmp, f"{shape}-{size}.docx")
+                start = time.perf_counter()
+                make(shape, path, size)
+                print(f"# {shape}/{size}: {os.path.getsize(path) / 1024:.0f} KB, "
+                      f"generated in {time.perf_counter() - start:.1f}s")
+                for stage, fn in stages(path, img_path).items():
+                    if args.stages and not any(s in stage for s in args.stages):
+                        continue
+                    key = f"{shape}/{size}/{stage}"
+                    r = results[key] = measure(fn, args.repeat)
+                    base = baseline.get(key)
+                    delta = f"{(r['ms'] / base['ms'] - 1) * 100:+.0f}%" if base else ""
+                    print(f"{key:<58}{r['ms']:>10.2f}{r['peak_kb']:>12.0f}{r['blocks']:>10}{delta:>10}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version, "created_at": time.time(), "repeat": args.repeat, "results": results},
+                      f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+    if baseline:
+        regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance,
+                              args.time_floor, args.memory_floor)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+docx 加载器基准测试：生成大文档，对比 `DocxLoader` 与 `DocxStreamLoader` 的耗时、吞吐量和内存峰值，并检查两者的知识块一致。
+每个加载器在独立的进程中运行，避免互相影响内存统计。在项目根目录执行：
+
+    PYTHONPATH=src:tests python benchmarks/bench_docx_loader.py --sections 2000
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from docx_factory import make_sections
+
+LOADERS = ("DocxLoader", "DocxStreamLoader")
+
+
+def peak_rss_kb() -> int:
+    """进程的内存峰值（KB），包含 lxml 在 C 层分配的内存。ru_maxrss 会继承父进程的峰值，优先读取 VmHWM"""
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def load(loader_name: str, path: str, img_path: str):
+    import kb.kb_loader
+    loader = getattr(kb.kb_loader, loader_name)(path, img_path=img_path, doc_id="bench")
+    return list(loader.lazy_load())
+
+
+def run(loader_name: str, path: str, img_path: str) -> dict:
+    """在当前进程中运行一个加载器，先计时再统计 Python 对象的内存峰值"""
+    # 先完成导入，内存增长只计算解析本身
+    import docx.table  # noqa: F401
+    import kb.kb_loader  # noqa: F401
+    rss_before = peak_rss_kb()
+    start = time.perf_counter()
+    chunks = len(load(loader_name, path, img_path))
+    seconds = time.perf_counter() - start
+    rss_after = peak_rss_kb()
+    tracemalloc.start()
+    load(loader_name, path, img_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"loader": loader_name, "chunks": chunks, "seconds": seconds, "chunks_per_second": chunks / seconds,
+            "rss_growth_mb": (rss_after - rss_before) / 1024, "tracemalloc_peak_mb": peak / 1024 / 1024}
+
+
+def check_same(path: str, img_path: str) -> bool:
+    """两个加载器的知识块是否一致"""
+    results = [[(d.page_content, d.metadata) for d in load(name, path, img_path)] for name in LOADERS]
+    return results[0] == results[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", type=int, default=500, help="一级标题数量")
+    parser.add_argument("--paragraphs", type=int, default=8, help="每个二级标题下的段落数量")
+    parser.add_argument("--file", help="使用已有的文档，不生成")
+    parser.add_argument("--run", choices=LOADERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        img_path = os.path.join(tmp, "img")
+        if args.run:
+            print(json.dumps(run(args.run, args.file, img_path)))
+            return
+        path = args.file
+        if path is None:
+            path = os.path.join(tmp, "bench.docx")
+            start = time.perf_counter()
+            make_sections(path, args.sections, args.paragraphs)
+            print(f"generated {path} ({os.path.getsize(path) / 1024 / 1024:.1f} MB) "
+                  f"in {time.perf_counter() - start:.1f}s")
+        print(f"same output: {check_same(path, img_path)}")
+        print(f"{'loader':<18}{'chunks':>8}{'seconds':>10}{'chunks/s':>10}{'rss MB':>10}{'py peak MB':>12}")
+        for name in LOADERS:
+            out = subprocess.run([sys.executable, __file__, "--run", name, "--file", path],
+                                 capture_output=True, text=True, check=True)
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"{r['loader']:<18}{r['chunks']:>8}{r['seconds']:>10.2f}{r['chunks_per_second']:>10.0f}"
+                  f"{r['rss_growth_mb']:>10.1f}{r['tracemalloc_peak_mb']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+知识库存储配置基准测试：对每种存储配置写入相同的随机向量，比较检索延迟、召回率（与精确检索对比）和估算的内存占用。
+量化、磁盘存储和 HNSW 参数只在 Qdrant 服务端生效，本地模式下各配置的结果相同。在项目根目录执行：
+
+    PYTHONPATH=src python benchmarks/bench_storage_profile.py --location http://localhost:6333 --points 100000
+"""
+import argparse
+import time
+import uuid
+
+import numpy as np
+from qdrant_client import QdrantClient, models
+
+from kb.kb_profile import Quantization, StorageProfile
+
+PROFILES = {
+    "default": StorageProfile(),
+    "int8": StorageProfile(quantization=Quantization.INT8),
+    "int8+disk": StorageProfile(quantization=Quantization.INT8, on_disk=True, oversampling=2),
+    "binary+disk": StorageProfile(quantization=Quantization.BINARY, on_disk=True, oversampling=3),
+    "hnsw-m8": StorageProfile(hnsw_m=8, hnsw_ef_construct=64),
+}
+
+
+def make_vectors(n: int, dim: int, clusters: int = 64, seed: int = 0) -> np.ndarray:
+    """生成聚簇分布的单位向量，比均匀分布更接近真实的文本向量"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def estimate_ram_mb(profile: StorageProfile, n: int, dim: int) -> float:
+    """按配置估算常驻内存：原始向量、量化向量和 HNSW 第0层的边，不含 payload"""
+    size = 0 if profile.on_disk else n * dim * 4
+    if profile.quantization_always_ram:
+        size += {Quantization.NONE: 0, Quantization.INT8: n * dim, Quantization.BINARY: n * dim / 8}[
+            profile.quantization]
+    if not profile.hnsw_on_disk:
+        size += n * (profile.hnsw_m or 16) * 2 * 4
+    return size / 1024 / 1024
+
+
+def wait_green(client: QdrantClient, name: str, timeout: float = 600):
+    """等待后台优化（建索引、量化）完成"""
+    deadline = time.monotonic() + timeout
+    while client.get_collection(name).status != models.CollectionStatus.GREEN and time.monotonic() < deadline:
+        time.sleep(0.5)
+
+
+def run(client: QdrantClient, label: str, profile: StorageProfile, vectors: np.ndarray, queries: np.ndarray,
+        top: int, batch: int) -> dict:
+    name = f"bench_{label}_{uuid.uuid4().hex[:8]}"
+    client.create_collection(collection_name=name, **profile.create_params(vectors.shape[1]))
+    try:
+        start = time.perf_counter()
+        for i in range(0, len(vectors), batch):
+            client.upload_collection(collection_name=name, vectors=vectors[i:i + batch],
+                                     ids=list(range(i, min(i + batch, len(vectors)))), wait=True)
+        wait_green(client, name)
+        build = time.perf_counter() - start
+
+        latencies, recalls = [], []
+        for query in queries:
+            exact = client.search(collection_name=name, query_vector=query, limit=top,
+                                  search_params=models.SearchParams(exact=True))
+            start = time.perf_counter()
+            res = client.search(collection_name=name, query_vector=query, limit=top,
+                                search_params=profile.search_params())
+            latencies.append(time.perf_counter() - start)
+            recalls.append(len({p.id for p in res} & {p.id for p in exact}) / top)
+        latencies = np.array(latencies) * 1000
+        return {"profile": label, "build_s": build, "p50_ms": np.percentile(latencies, 50),
+                "p95_ms": np.percentile(latencies, 95), "recall": float(np.mean(recalls)),
+                "ram_mb": estimate_ram_mb(profile, *vectors.shape)}
+    finally:
+        client.delete_collection(collection_name=name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--location", default=":memory:", help="Qdrant 地址，默认使用本地内存模式")
+    parser.add_argument("--points", type=int, default=20000, help="向量数量")
+    parser.add_argument("--dim", type=int, default=1024, help="向量维度")
+    parser.add_argument("--queries", type=int, default=100, help="查询数量")
+    parser.add_argument("--top", type=int, default=10, help="每次查询返回的数量，召回率按该数量计算")
+    parser.add_argument("--batch", type=int, default=1000, help="每次写入的向量数量")
+    parser.add_argument("--profiles", nargs="*", choices=PROFILES, default=list(PROFILES), help="测试的配置")
+    args = parser.parse_args()
+
+    client = QdrantClient(location=args.location)
+    vectors = make_vectors(args.points, args.dim)
+    queries = make_vectors(args.queries, args.dim, seed=1)
+    print(f"{'profile':<14}{'build s':>10}{'p50 ms':>10}{'p95 ms':>10}{'recall':>10}{'est. RAM MB':>14}")
+    for label in args.profiles:
+        r = run(client, label, PROFILES[label], vectors, queries, args.top, args.batch)
+        print(f"{r['profile']:<14}{r['build_s']:>10.1f}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+              f"{r['recall']:>10.3f}{r['ram_mb']:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+"""
+端到端压测：在临时目录中启动应用和兼容 OpenAI 接口的模拟 Embedding 服务（`/v1/embeddings`，延迟和向量维度可配置），
+先上传若干文档作为知识库数据，然后按比例混合相似查询、父子关联查询、条件查询和上传请求，
+统计每个接口的吞吐量和 p50/p95/p99 延迟，以及上传文档的入库耗时。在项目根目录执行：
+
+    PYTHONPATH=src:tests python benchmarks/load_harness.py --duration 30 --concurrency 32
+    PYTHONPATH=src:tests python benchmarks/load_harness.py --mix query=50,relevant=50 --no-cache --output no-cache.json
+    PYTHONPATH=src:tests python benchmarks/load_harness.py --location http://localhost:6333 --workers 4 --job-workers 4
+
+默认使用内存模式的 Qdrant，数据只存在于应用进程中，因此入库任务在应用进程的线程中执行，只能使用单个 uvicorn worker；
+指定 --location 连接 Qdrant 服务时可以使用多个 worker，入库任务由随应用启动的工作进程执行。
+内存模式下异步查询在线程中调用同步客户端，连接 Qdrant 服务时使用异步客户端，两者的结果可以用来比较同步和异步的调用方式。
+其它应用配置可以通过 --env 覆盖，例如 --env COALESCE_MAX_WAIT_MS=0 关闭 Embedding 请求合并。
+
+压测为闭环模式：--concurrency 个协程各自连续发送请求，延迟包含压测客户端自身的开销。
+上传请求依次使用预先生成的 --upload-docs 个内容不同的文档，用完后重复上传，重复的文档不会再次入库。
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from docx_factory import make_sections
+
+OPS = ("query", "relevant", "filter", "upload")
+"""支持的请求类型"""
+
+DEFAULT_MIX = "query=70,relevant=20,filter=5,upload=5"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _vector(text: str, dim: int) -> np.ndarray:
+    """按文本哈希生成固定的单位向量，相同文本的向量相同"""
+    rng = np.random.default_rng(int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little"))
+    vector = rng.standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def serve_embeddings(port: int, dim: int, latency_ms: float, per_text_ms: float):
+    """模拟 Embedding 服务，每次请求等待 latency_ms 加上每条文本 per_text_ms 的时间后返回"""
+    import uvicorn
+    from fastapi import Body, FastAPI
+
+    app = FastAPI()
+    stats = {"requests": 0, "texts": 0, "chars": 0}
+
+    @app.post("/v1/embeddings")
+    async def embeddings(body: dict = Body(...)):
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        stats["requests"] += 1
+        stats["texts"] += len(texts)
+        chars = sum(len(text) for text in texts)
+        stats["chars"] += chars
+        await asyncio.sleep((latency_ms + per_text_ms * len(texts)) / 1000)
+        size = body.get("dimensions") or dim
+        data = []
+        for i, text in enumerate(texts):
+            vector = _vector(text, size)
+            # 未指定格式时 openai 客户端请求 base64 编码的 float32
+            embedding = (base64.b64encode(vector.tobytes()).decode() if body.get("encoding_format") == "base64"
+                         else vector.tolist())
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        return {"object": "list", "model": body["model"], "data": data,
+                "usage": {"prompt_tokens": chars, "total_tokens": chars}}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def _job_loop(stop: threading.Event):
+    """在应用进程中领取并执行入库任务，内存模式的 Qdrant 不能跨进程共享"""
+    from kb.job.job_queue import get_job_queue
+    from kb.job.job_worker import run_job
+    from kb.kb_config import JobConfig
+
+    queue = get_job_queue()
+    while not stop.is_set():
+        job = queue.claim()
+        if job is None:
+            stop.wait(JobConfig.POLL_INTERVAL)
+            continue
+        run_job(queue, job)
+
+
+def serve_app(workdir: str, port: int, workers: int, job_threads: int, env: dict[str, str]):
+    """在 workdir 中启动应用，配置在导入应用前通过环境变量设置，相对路径的数据文件都写入 workdir"""
+    os.environ.update(env)
+    sys.path[:] = [os.path.abspath(p) for p in sys.path]
+    os.chdir(workdir)
+    # 应用和解析进程的输出写入日志文件，不与压测结果混在一起
+    log = os.open("app.log", os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    import uvicorn
+
+    from kb import kb_parse_pool
+
+    stop = threading.Event()
+    threads = []
+    if job_threads:
+        import app  # noqa: F401 先导入应用，工作线程与应用共用同一个 Qdrant 客户端
+        for i in range(job_threads):
+            threads.append(threading.Thread(target=_job_loop, args=(stop,), name=f"kb-job-thread-{i}", daemon=True))
+            threads[-1].start()
+    # uvicorn 正常关闭后会用原来的处理函数重新触发 SIGTERM，默认处理会直接结束进程，不执行下面的清理
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        uvicorn.run("app:app", host="127.0.0.1", port=port, workers=workers, log_level="warning")
+    finally:
+        # 工作线程使用的解析进程池属于应用进程，先停止领取任务再关闭，否则进程池会被重新创建
+        stop.set()
+        for thread in threads:
+            thread.join(5)
+        kb_parse_pool.shutdown()
+
+
+class DocPool:
+    """预先生成内容不同的 docx 文档，避免压测过程中生成文档占用压测客户端的时间"""
+
+    def __init__(self, num: int, sections: int, paras: int, vocabulary: list[str], seed: int):
+        rng = random.Random(seed)
+        self.docs: list[tuple[str, bytes]] = []
+        for n in range(num):
+            buffer = io.BytesIO()
+            make_sections(buffer, sections, paragraphs=paras, tables=0, title=f"文档{n}",
+                          words=lambda k: "，".join(rng.choices(vocabulary, k=k)))
+            self.docs.append((f"load-{n}.docx", buffer.getvalue()))
+        self._next = 0
+
+    def take(self) -> tuple[str, bytes]:
+        doc = self.docs[self._next % len(self.docs)]
+        self._next += 1
+        return doc
+
+
+class Workload:
+    """压测请求，每个方法发送一种请求并返回响应"""
+
+    def __init__(self, kb_id: str, queries: list[str], docs: DocPool, limit: int):
+        self.kb_id = kb_id
+        self.queries = queries
+        self.docs = docs
+        self.limit = limit
+        self.file_ids: list[str] = []
+        """已经上传的文档id，条件查询从中选择"""
+        self.job_ids: list[str] = []
+        """压测期间提交的入库任务"""
+
+    async def query(self, client, rng: random.Random):
+        return await client.get(f"/kb/{self.kb_id}", params={"query": rng.choice(self.queries), "limit": self.limit})
+
+    async def relevant(self, client, rng: random.Random):
+        return await client.get(f"/kb/{self.kb_id}", params={"query": rng.choice(self.queries), "limit": self.limit,
+                                                              "relevant": True})
+
+    async def filter(self, client, rng: random.Random):
+        condition = {"file_id": [rng.choice(self.file_ids)]} if self.file_ids else None
+        return await client.post(f"/kb/{self.kb_id}", params={"limit": 10}, json=condition)
+
+    async def upload(self, client, rng: random.Random):
+        filename, content = self.docs.take()
+        mime = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+        resp = await client.put(f"/kb/file/{self.kb_id}", files={"file": (filename, content, mime)})
+        if resp.status_code == 200:
+            data = resp.json()["data"]
+            self.file_ids.append(data["file_id"])
+            if data["job_id"] and not data["duplicate"]:
+                self.job_ids.append(data["job_id"])
+        return resp
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    res = {}
+    for item in mix.split(","):
+        op, _, weight = item.partition("=")
+        if op.strip() not in OPS:
+            raise argparse.ArgumentTypeError(f"unknown request type {op}, choose from {', '.join(OPS)}")
+        res[op.strip()] = float(weight)
+    return res
+
+
+async def wait_ready(client, process: multiprocessing.Process, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise RuntimeError("app exited during startup")
+        try:
+            if (await client.get("/health/ready")).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError("app is not ready")
+
+
+async def wait_jobs(client, job_ids: list[str], timeout: float) -> list[dict]:
+    """等待入库任务结束，返回任务详情，超时时返回当前状态"""
+    deadline = time.monotonic() + timeout
+    pending, jobs = list(job_ids), {}
+    while pending and time.monotonic() < deadline:
+        for job_id in list(pending):
+            job = (await client.get(f"/kb/file/jobs/{job_id}")).json()["data"]
+            jobs[job_id] = job
+            if job["state"] in ("done", "failed"):
+                pending.remove(job_id)
+        if pending:
+            await asyncio.sleep(0.5)
+    return [jobs[job_id] for job_id in job_ids if job_id in jobs]
+
+
+async def run_load(client, workload: Workload, mix: dict[str, float], concurrency: int, duration: float,
+                   warmup: float, seed: int) -> tuple[dict[str, list[float]], dict[str, dict[str, int]]]:
+    """闭环压测，只统计预热结束后开始的请求，返回每种请求的延迟（秒）和错误状态码计数"""
+    ops, weights = list(mix), list(mix.values())
+    latencies: dict[str, list[float]] = {op: [] for op in ops}
+    errors: dict[str, dict[str, int]] = {op: {} for op in ops}
+    start = time.perf_counter()
+    measure_from, end = start + warmup, start + warmup + duration
+
+    async def worker(i: int):
+        rng = random.Random(seed + i)
+        while (now := time.perf_counter()) < end:
+            op = rng.choices(ops, weights)[0]
+            try:
+                resp = await getattr(workload, op)(client, rng)
+                status = str(resp.status_code) if resp.status_code != 200 else None
+            except Exception as e:
+                status = type(e).__name__
+            if now < measure_from:
+                continue
+            latencies[op].append(time.perf_counter() - now)
+            if status:
+                errors[op][status] = errors[op].get(status, 0) + 1
+
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return latencies, errors
+
+
+def summarize(latencies: dict[str, list[float]], errors: dict[str, dict[str, int]], duration: float) -> dict:
+    res = {}
+    for op, values in [*latencies.items(), ("total", [v for values in latencies.values() for v in values])]:
+        ms = np.array(values) * 1000 if values else np.zeros(1)
+        failed = (sum(errors[op].values()) if op in errors
+                  else sum(n for counts in errors.values() for n in counts.values()))
+        res[op] = {"requests": len(values), "errors": failed, "rps": len(values) / duration,
+                   "mean_ms": float(ms.mean()), "p50_ms": float(np.percentile(ms, 50)),
+                   "p95_ms": float(np.percentile(ms, 95)), "p99_ms": float(np.percentile(ms, 99))}
+        if op in errors and errors[op]:
+            res[op]["error_codes"] = errors[op]
+    return res
+
+
+def summarize_jobs(jobs: list[dict]) -> dict:
+    done = [job for job in jobs if job["state"] == "done"]
+    seconds = np.array([job["finished_at"] - job["created_at"] for job in done]) if done else np.zeros(1)
+    return {"submitted": len(jobs), "done": len(done), "failed": sum(job["state"] == "failed" for job in jobs),
+            "chunks": sum(job["chunks_done"] for job in done),
+            "p50_s": float(np.percentile(seconds, 50)), "p95_s": float(np.percentile(seconds, 95)),
+            "parse_s": sum(job["parse_seconds"] for job in done), "write_s": sum(job["write_seconds"] for job in done)}
+
+
+def print_report(results: dict, jobs: dict, embedding: dict, cache: dict):
+    print(f"{'endpoint':<12}{'requests':>10}{'errors':>8}{'req/s':>10}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for op, r in results.items():
+        print(f"{op:<12}{r['requests']:>10}{r['errors']:>8}{r['rps']:>10.1f}{r['mean_ms']:>10.1f}"
+              f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}")
+        if r.get("error_codes"):
+            print(f"{'':<12}errors: {r['error_codes']}")
+    print("(latency in ms)")
+    if jobs["submitted"]:
+        print(f"ingest: {jobs['done']}/{jobs['submitted']} jobs done, {jobs['failed']} failed, "
+              f"{jobs['chunks']} chunks, submit->done p50 {jobs['p50_s']:.2f}s p95 {jobs['p95_s']:.2f}s, "
+              f"parse {jobs['parse_s']:.1f}s write {jobs['write_s']:.1f}s in total")
+    if embedding.get("requests"):
+        print(f"embedding server: {embedding['requests']} requests, "
+              f"{embedding['texts'] / embedding['requests']:.1f} texts/request")
+    for name, stats in cache.items():
+        print(f"cache {name}: hit ratio {stats['hit_ratio']:.2f} ({stats['hits']} hits, {stats['misses']} misses)")
+
+
+async def run(args, base_url: str, embedding_url: str, app_process: multiprocessing.Process) -> dict:
+    import httpx
+
+    rng = random.Random(args.seed)
+    vocabulary = [f"主题{i}" for i in range(args.vocabulary)]
+    queries = [" ".join(rng.choices(vocabulary, k=3)) for _ in range(args.distinct_queries)]
+    print(f"# generating {args.upload_docs + args.seed_docs} documents")
+    docs = DocPool(args.upload_docs + args.seed_docs, args.doc_sections, args.doc_paras, vocabulary, args.seed)
+    workload = Workload(f"load_{uuid.uuid4().hex[:8]};{args.model}", queries, docs, args.limit)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        await wait_ready(client, app_process)
+        print(f"# seeding {workload.kb_id} with {args.seed_docs} documents")
+        for _ in range(args.seed_docs):
+            resp = await workload.upload(client, rng)
+            resp.raise_for_status()
+        seed_jobs = await wait_jobs(client, workload.job_ids, args.drain_timeout)
+        if any(job["state"] != "done" for job in seed_jobs):
+            raise RuntimeError(f"seeding failed: {[job.get('error') for job in seed_jobs]}")
+        workload.job_ids.clear()
+
+        mix = args.mix
+        print(f"# running {mix} for {args.duration}s (+{args.warmup}s warm-up), concurrency {args.concurrency}")
+        latencies, errors = await run_load(client, workload, mix, args.concurrency, args.duration, args.warmup,
+                                           args.seed)
+        jobs = await wait_jobs(client, workload.job_ids, args.drain_timeout)
+        cache = (await client.get("/kb/cache/stats")).json()["data"]
+    async with httpx.AsyncClient() as client:
+        embedding = (await client.get(f"{embedding_url}/stats")).json()
+    return {"results": summarize(latencies, errors, args.duration), "jobs": summarize_jobs(jobs),
+            "embedding": embedding, "cache": cache}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help=f"请求比例，可选 {', '.join(OPS)}")
+    parser.add_argument("--concurrency", type=int, default=16, help="同时发送请求的协程数量")
+    parser.add_argument("--duration", type=float, default=20, help="统计时长（秒）")
+    parser.add_argument("--warmup", type=float, default=3, help="预热时长（秒），期间的请求不统计")
+    parser.add_argument("--timeout", type=float, default=60, help="单个请求的超时时间（秒）")
+    parser.add_argument("--limit", type=int, default=3, help="查询返回的条数")
+    parser.add_argument("--distinct-queries", type=int, default=1000, help="不同查询语句的数量，越少缓存命中越多")
+    parser.add_argument("--vocabulary", type=int, default=500, help="文档和查询使用的词汇数量")
+    parser.add_argument("--seed-docs", type=int, default=10, help="压测前上传的文档数量")
+    parser.add_argument("--upload-docs", type=int, default=50, help="压测期间上传使用的不同文档数量")
+    parser.add_argument("--doc-sections", type=int, default=10, help="每个文档的章节数量")
+    parser.add_argument("--doc-paras", type=int, default=4, help="每个小节的段落数量")
+    parser.add_argument("--drain-timeout", type=float, default=300, help="等待入库任务完成的时间（秒）")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--model", default="bge-m3", help="模拟的 Embedding 模型名称")
+    parser.add_argument("--dim", type=int, default=1024, help="模拟的向量维度")
+    parser.add_argument("--embedding-latency-ms", type=float, default=20, help="模拟 Embedding 每次请求的固定延迟")
+    parser.add_argument("--embedding-per-text-ms", type=float, default=0.5, help="模拟 Embedding 每条文本增加的延迟")
+    parser.add_argument("--location", default=":memory:", help="Qdrant 连接地址，默认使用内存模式")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker 数量，内存模式只能为1")
+    parser.add_argument("--job-workers", type=int, default=2, help="入库任务的工作线程（内存模式）或工作进程数量")
+    parser.add_argument("--no-cache", action="store_true", help="关闭查询向量缓存和查询结果缓存")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="应用的其它配置")
+    parser.add_argument("--keep", action="store_true", help="保留应用的工作目录（数据和日志）")
+    parser.add_argument("--output", help="将结果和参数保存为 JSON 文件，便于比较不同配置")
+    args = parser.parse_args()
+    in_memory = args.location == ":memory:"
+    if in_memory and args.workers != 1:
+        parser.error("in-memory Qdrant only lives in one process, use --location with --workers > 1")
+
+    embedding_port, app_port = _free_port(), _free_port()
+    embedding_url = f"http://127.0.0.1:{embedding_port}"
+    env = {"LOCATION": args.location, "BASE_URL": f"{embedding_url}/v1", "API_KEY": "dummy",
+           "EMBEDDINGS": args.model, "DIMENSIONS": f"{args.model}:{args.dim}", "POLL_INTERVAL": "0.1",
+           "EMBEDDED_WORKERS": str(not in_memory), "WORKER_NUM": str(args.job_workers)}
+    if args.no_cache:
+        env.update({"RESULT_TTL": "0", "QUERY_EMBEDDING_SIZE": "0"})
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    ctx = multiprocessing.get_context("spawn")
+    workdir = tempfile.mkdtemp(prefix="kb-load-")
+    processes = [
+        ctx.Process(target=serve_embeddings, name="fake-embedding",
+                    args=(embedding_port, args.dim, args.embedding_latency_ms, args.embedding_per_text_ms)),
+        ctx.Process(target=serve_app, name="app",
+                    args=(workdir, app_port, args.workers, args.job_workers if in_memory else 0, env)),
+    ]
+    for p in processes:
+        p.start()
+    keep = args.keep
+    try:
+        report = asyncio.run(run(args, f"http://127.0.0.1:{app_port}", embedding_url, processes[1]))
+    except BaseException:
+        keep = True
+        raise
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.join(10)
+            if p.is_alive():
+                # 超时未退出时强制结束，残留的进程会一直占用标准输出
+                p.kill()
+                p.join()
+        if keep:
+            print(f"work directory kept at {workdir}, app log: {os.path.join(workdir, 'app.log')}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report["results"], report["jobs"], report["embedding"], report["cache"])
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "env": env, **report}, f, indent=2, ensure_ascii=False)
+        print(f"results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
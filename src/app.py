@@ -1,20 +1,61 @@
 """启动脚本，注意启动位置必须和app同一级目录，或者将该目录添加到PYTHONPATH中"""
+import time
+
+_STARTED_AT = time.monotonic()
+"""进程开始导入应用的时间，用于统计冷启动耗时"""
+
+import asyncio
 import logging
+from contextlib import asynccontextmanager
+from typing import Optional
 
 from fastapi import FastAPI
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response
 
 import config
-from common import failed, AbsException
+import metrics
+from common import failed, success, AbsException
 from config import file_handle
 from kb import kb_router
+from kb.embedding import kb_embedding
+from kb.file.file_service import UploadSizeLimitMiddleware
+from kb.job.job_worker import WorkerPool
+from kb.kb_config import JobConfig, EmbeddingConfig
+from kb.kb_metrics import aflush_periodically, get_metrics_store
 
 # 这里的 ‘G’ 代表Global的意思
 config.logs_config(handlers=file_handle(tag='G'))
-app = FastAPI(title='WeYon AI Open Platform', version='0.1.0', root_path="/api/v1")
+
+
+_startup_seconds: Optional[float] = None
+"""冷启动耗时，应用开始接收请求前为空"""
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """随 API 进程启动和关闭入库任务的工作进程，并在后台预热 Embedding 模型，预热不阻塞启动，同时定期写入指标快照"""
+    global _startup_seconds
+    pool = None
+    if JobConfig.EMBEDDED_WORKERS and JobConfig.WORKER_NUM > 0:
+        pool = WorkerPool(num=JobConfig.WORKER_NUM)
+        pool.start()
+    warm_up = asyncio.create_task(kb_embedding.awarm_up()) if EmbeddingConfig.WARM_UP else None
+    flush = asyncio.create_task(aflush_periodically())
+    _startup_seconds = time.monotonic() - _STARTED_AT
+    logger.info(f"Startup finished in {_startup_seconds:.3f}s")
+    yield
+    flush.cancel()
+    if warm_up:
+        warm_up.cancel()
+    if pool:
+        pool.stop()
+
+
+app = FastAPI(title='WeYon AI Open Platform', version='0.1.0', root_path="/api/v1", lifespan=lifespan)
 
 app.include_router(kb_router.router)
+app.add_middleware(UploadSizeLimitMiddleware)
 
 logger = logging.getLogger(__name__)
 logger.addHandler(config.file_handle(tag="EXC"))
@@ -33,3 +74,21 @@ async def file_exception(_, exc: AbsException):
 async def root():
     """测试连接使用"""
     return RedirectResponse("/docs")
+
+
+@app.get("/health/ready", summary="就绪检查")
+async def ready():
+    """应用启动完成且 Embedding 模型预热完成时返回200，否则返回503，返回数据中包含冷启动耗时和各模型的预热状态"""
+    state = kb_embedding.warm_up_state
+    is_ready = _startup_seconds is not None and (not EmbeddingConfig.WARM_UP or state.ready)
+    data = {"ready": is_ready, "startup_seconds": _startup_seconds, "embeddings": state.to_dict()}
+    if is_ready:
+        return success(data=data)
+    return JSONResponse(status_code=503, content=jsonable_encoder(failed(msg="NOT_READY", data=data)))
+
+
+@app.get("/metrics", summary="运行指标")
+async def get_metrics():
+    """Prometheus 文本格式的运行指标，包含 API 进程、入库工作进程和解析进程的指标"""
+    snap = await asyncio.to_thread(get_metrics_store().collect)
+    return Response(content=metrics.render(snap), media_type=metrics.CONTENT_TYPE)
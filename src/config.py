@@ -14,9 +14,18 @@ class BaseConfig(type):
         """创建"""
         for key, value in attrs.items():
             if key in os.environ and not callable(value):
-                attrs[key] = os.environ[key]
+                attrs[key] = mcs._convert(value, os.environ[key])
         return type.__new__(mcs, name, bases, attrs)
 
+    @staticmethod
+    def _convert(default, value: str):
+        """环境变量均为字符串，按照默认值的类型转换，避免数值类配置被覆盖成字符串"""
+        if isinstance(default, bool):
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        if isinstance(default, (int, float)):
+            return type(default)(value)
+        return value
+
 
 class LogConfig(metaclass=BaseConfig):
     """日志配置"""
@@ -1,58 +1,222 @@
-from typing import List
+import asyncio
+import functools
+import math
+import os
+from abc import abstractmethod
+from typing import Iterable, List
 
 from qdrant_client.models import models
 
-from kb.kb_config import DocxSchema
-from kb.kb_core import Document, VectorKB
+from kb.kb_cache import get_generation
+from kb.kb_config import DocxSchema, RetrieverConfig
+from kb.kb_core import BaseVectorKB, Document, VectorKB, async_client, client, is_collection_missing
 
+SECTIONS_SUFFIX = ";sections"
+"""父节点段落集合的后缀，段落集合与知识库集合同名加上该后缀"""
 
-class DocRetriever(VectorKB):
 
+def merge_chunks(contents: Iterable[str]) -> str:
+    """
+    依次合并同一父节点下的知识块，结果与逐个调用 `DocRetriever.merge_with_common_prefix` 相同，
+    但只在最后拼接一次，耗时与文本总长度成正比
+    """
+    pieces = []
+    first = None
+    for content in contents:
+        if first is None:
+            first = content
+            pieces.append(content)
+            continue
+        common = len(os.path.commonprefix((first, content)))
+        if common == len(first) and len(pieces) > 1:
+            # 公共前缀超出了第一个知识块，需要与已合并的全部文本比较
+            merged = "".join(pieces)
+            common = len(os.path.commonprefix((merged, content)))
+            pieces = [merged]
+        pieces.append('\n')
+        pieces.append(content[common:])
+    return "".join(pieces)
+
+
+class ParentRetriever(BaseVectorKB):
+    """
+    父子文档检索：按知识块检索后返回知识块所在父节点的完整段落。
+    段落在入库时预先合并并以父节点id为主键保存，查询时按id一次取回。
+    与知识库的存储后端组合使用，段落的存储由子类实现，见 `DocRetriever`
+    """
+
+    _SCROLL_SIZE = 256
 
     def query_doc(self, *args, query: str, filter_condition=None, limit=3, **kwargs) -> list[Document]:
-        chunks = super().query_doc(query=query,
-                                          filter_condition=filter_condition,
-                                          limit=limit * 3,
-                                          *args,
-                                          **kwargs)
-        doc_rel = self._remove_duplicates(chunk.metadata.get(DocxSchema.PARENT_ID) for chunk in chunks)
-        docs = self._get_docs_by_parent(doc_rel)
+        search = functools.partial(super().query_doc, *args, query=query, filter_condition=filter_condition,
+                                   **kwargs)
+        fetch = self._fetch_size(limit)
+        while True:
+            chunks = search(limit=fetch)
+            doc_rel = self._remove_duplicates(chunk.metadata.get(DocxSchema.PARENT_ID) for chunk in chunks)
+            if not self._need_more(limit, fetch, chunks, doc_rel):
+                break
+            fetch = self._next_fetch_size(limit, fetch)
+        self._observe(len(chunks), len(doc_rel))
+        docs = self._get_sections(doc_rel)
+        self._resort_doc(docs)
+        return docs[:limit]
+
+    async def aquery_doc(self, *args, query: str, filter_condition=None, limit=3, **kwargs) -> list[Document]:
+        search = functools.partial(super().aquery_doc, *args, query=query, filter_condition=filter_condition,
+                                   **kwargs)
+        fetch = self._fetch_size(limit)
+        while True:
+            chunks = await search(limit=fetch)
+            doc_rel = self._remove_duplicates(chunk.metadata.get(DocxSchema.PARENT_ID) for chunk in chunks)
+            if not self._need_more(limit, fetch, chunks, doc_rel):
+                break
+            fetch = self._next_fetch_size(limit, fetch)
+        self._observe(len(chunks), len(doc_rel))
+        docs = await self._aget_sections(doc_rel)
         self._resort_doc(docs)
-        docs = self._merge_doc(docs)
         return docs[:limit]
 
-    def __init__(self, vector_kb: VectorKB):
+    def _fetch_size(self, limit: int) -> int:
+        """按当前的多取倍数计算需要检索的知识块数量"""
+        # 倍数趋近整数时避免浮点误差多取一个
+        return max(limit, math.ceil(round(limit * self._overfetch, 3)))
+
+    @staticmethod
+    def _need_more(limit: int, fetch: int, chunks: list, doc_rel: list) -> bool:
+        """父节点不够且知识库中还有更多知识块时需要扩大检索数量"""
+        return len(doc_rel) < limit and len(chunks) == fetch and fetch < limit * RetrieverConfig.MAX_OVERFETCH
+
+    @staticmethod
+    def _next_fetch_size(limit: int, fetch: int) -> int:
+        return min(fetch * 2, math.ceil(limit * RetrieverConfig.MAX_OVERFETCH))
+
+    def _observe(self, chunks: int, parents: int):
+        """按本次每个父节点平均命中的知识块数量平滑调整多取倍数"""
+        if parents == 0:
+            return
+        ratio = chunks / parents
+        self._overfetch = min(max(1., 0.8 * self._overfetch + 0.2 * ratio), RetrieverConfig.MAX_OVERFETCH)
+
+    def __init__(self, vector_kb: BaseVectorKB):
         super().__init__(vector_kb.kb_id)
+        self.sections_id = f"{self.kb_id}{SECTIONS_SUFFIX}"
+        """段落集合名称"""
+        self._overfetch = RetrieverConfig.OVERFETCH
+        """多取倍数，多个知识块可能属于同一个父节点，需要多取知识块才能得到足够数量的父节点"""
 
     @staticmethod
     def merge_with_common_prefix(str1, str2):
-        # 找到两个字符串的公共前缀
-        common = ""
-        for c1, c2 in zip(str1, str2):
-            if c1 == c2:
-                common += c1
-            else:
-                break
         # 合并字符串，只保留一份公共前缀
-        merged = common + str1[len(common):] + '\n' + str2[len(common):]
-        return merged
+        common = os.path.commonprefix((str1, str2))
+        return str1 + '\n' + str2[len(common):]
 
     @staticmethod
     def _remove_duplicates(lst):
-        return list(set(lst))
+        return list({parent_id for parent_id in lst if parent_id})
+
+    def build_sections(self, file_id: str):
+        """
+        合并文档中每个父节点下的全部知识块并写入段落集合，删除文档中已经不存在的段落。
+        文档入库或替换完成后调用，重复执行的结果相同
+        Args:
+            file_id: 文档id
+        """
+        with self._timer("build_sections"):
+            sections = self._merge_doc(self._to_documents(self.file_points(file_id)))
+            self._save_sections(file_id, sections)
+        get_generation().bump(self.kb_id)
+
+    @abstractmethod
+    def _save_sections(self, file_id: str, sections: List[Document]):
+        """保存文档的全部段落，并删除文档中已经不存在的段落"""
+
+    @abstractmethod
+    def remove_sections(self, file_ids: list[str]):
+        """删除文档的全部段落"""
+
+    @abstractmethod
+    async def aremove_sections(self, file_ids: list[str]):
+        """异步版本的 `remove_sections`"""
+
+    @abstractmethod
+    def _retrieve_sections(self, parent_ids: List[str]) -> list:
+        """按父节点id读取已经保存的段落记录"""
+
+    @abstractmethod
+    async def _aretrieve_sections(self, parent_ids: List[str]) -> list:
+        """异步版本的 `_retrieve_sections`"""
+
+    @staticmethod
+    def _stale_sections_selector(file_id: str, sections: List[Document]) -> models.FilterSelector:
+        """文档中不在本次段落之列的旧段落"""
+        selector = BaseVectorKB._file_selector(file_id)
+        if sections:
+            selector.filter.must_not = [
+                models.HasIdCondition(has_id=[doc.metadata[DocxSchema.PARENT_ID] for doc in sections])]
+        return selector
 
-    def _get_docs_by_parent(self, doc_rel: List[List[str]]) -> List[Document]:
-        """通过父节点id查找响嘎un节点"""
+    def _get_sections(self, parent_ids: List[str]) -> List[Document]:
+        """按父节点id批量获取段落"""
+        if not parent_ids:
+            return []
+        with self._timer("retrieve_sections"):
+            recs = self._retrieve_sections(parent_ids)
+        docs = self._to_documents(recs)
+        missing = self._missing_parents(parent_ids, recs)
+        if missing:
+            # 更新前入库的文档没有段落，退回按父节点读取知识块后合并
+            with self._timer("merge_sections"):
+                docs.extend(self._merge_doc(self._get_docs_by_parent(missing)))
+        return docs
+
+    async def _aget_sections(self, parent_ids: List[str]) -> List[Document]:
+        """异步版本的 `_get_sections`"""
+        if not parent_ids:
+            return []
+        with self._timer("retrieve_sections"):
+            recs = await self._aretrieve_sections(parent_ids)
+        docs = self._to_documents(recs)
+        missing = self._missing_parents(parent_ids, recs)
+        if missing:
+            with self._timer("merge_sections"):
+                docs.extend(self._merge_doc(await self._aget_docs_by_parent(missing)))
+        return docs
+
+    @staticmethod
+    def _missing_parents(parent_ids: List[str], recs) -> List[str]:
+        """没有预先合并段落的父节点，即更新前入库的文档"""
+        found = {str(rec.id) for rec in recs}
+        return [parent_id for parent_id in parent_ids if parent_id not in found]
+
+    def _get_docs_by_parent(self, doc_rel: List[str]) -> List[Document]:
+        """通过父节点id查找全部子节点"""
         # langchain中的qdrant无法执行scroll操作，因此需要调用qdrant的python客户端
-        fil = models.Filter(
+        points, offset = [], None
+        while True:
+            recs, offset = self.scroll(scroll_filter=self._parent_filter(doc_rel), limit=self._SCROLL_SIZE,
+                                       offset=offset, with_vectors=False)
+            points.extend(recs)
+            if offset is None:
+                return self._to_documents(points)
+
+    async def _aget_docs_by_parent(self, doc_rel: List[str]) -> List[Document]:
+        """异步版本的 `_get_docs_by_parent`"""
+        points, offset = [], None
+        while True:
+            recs, offset = await self.ascroll(scroll_filter=self._parent_filter(doc_rel), limit=self._SCROLL_SIZE,
+                                              offset=offset, with_vectors=False)
+            points.extend(recs)
+            if offset is None:
+                return self._to_documents(points)
+
+    @staticmethod
+    def _parent_filter(doc_rel: List[str]) -> models.Filter:
+        return models.Filter(
             should=[
                 models.FieldCondition(key=f'{DocxSchema.METADATA}.{DocxSchema.PARENT_ID}',
                                       match=models.MatchAny(any=doc_rel))]
         )
-        recs = self.scroll(scroll_filter=fil)
-        return [Document(page_content=chunk.payload[DocxSchema.PAGE_CONTENT],
-                         metadata=chunk.payload[DocxSchema.METADATA]) for
-                chunk in recs[0]]
 
     @staticmethod
     def _resort_doc(docs: List[Document]):
@@ -60,25 +224,84 @@ class DocRetriever(VectorKB):
         docs.sort(key=lambda x: x.metadata[DocxSchema.ORDER_BY])
 
     def _merge_doc(self, docs: List[Document]) -> List[Document]:
-        """合并相同父节点的文档"""
-        pre_doc: Document | None = None
-        parent_id = None
+        """按文档顺序合并相同父节点的知识块，段落的元数据沿用第一个知识块"""
+        self._resort_doc(docs)
+        groups: dict[str, List[Document]] = {}
         for doc in docs:
-            if doc.metadata[DocxSchema.PARENT_ID] != parent_id:
-                parent_id = doc.metadata[DocxSchema.PARENT_ID]
-                pre_doc = doc
-            else:
-                pre_doc.page_content = self.merge_with_common_prefix(pre_doc.page_content, doc.page_content)
-                doc.page_content = ""
-
-        docs = [doc for doc in docs if doc.page_content != ""]
-        return docs
+            groups.setdefault(doc.metadata[DocxSchema.PARENT_ID], []).append(doc)
+        return [Document(merge_chunks(doc.page_content for doc in group), dict(group[0].metadata))
+                for group in groups.values()]
+
+
+class DocRetriever(ParentRetriever, VectorKB):
+    """Qdrant 知识库的父子文档检索，段落保存在知识库集合名称加后缀的段落集合中"""
+
+    def ensure_sections_collection(self):
+        """段落集合不存在时创建"""
+        if not client.collection_exists(collection_name=self.sections_id):
+            # 段落只按id读取，不需要向量
+            client.create_collection(collection_name=self.sections_id, vectors_config={})
+            client.create_payload_index(collection_name=self.sections_id,
+                                        field_name=f"{DocxSchema.METADATA}.{DocxSchema.FILE_ID}",
+                                        field_schema="keyword")
+
+    def remove_sections(self, file_ids: list[str]):
+        """删除文档的全部段落"""
+        try:
+            client.delete(collection_name=self.sections_id, points_selector=self._file_selector(file_ids))
+        except Exception as e:
+            if not is_collection_missing(e):
+                raise
+
+    async def aremove_sections(self, file_ids: list[str]):
+        """异步版本的 `remove_sections`"""
+        try:
+            await async_client.delete(collection_name=self.sections_id, points_selector=self._file_selector(file_ids))
+        except Exception as e:
+            if not is_collection_missing(e):
+                raise
+
+    def _save_sections(self, file_id: str, sections: List[Document]):
+        self.ensure_sections_collection()
+        for i in range(0, len(sections), self._SCROLL_SIZE):
+            client.upsert(collection_name=self.sections_id,
+                          points=[models.PointStruct(id=doc.metadata[DocxSchema.PARENT_ID], vector={},
+                                                     payload=vars(doc))
+                                  for doc in sections[i:i + self._SCROLL_SIZE]])
+        client.delete(collection_name=self.sections_id,
+                      points_selector=self._stale_sections_selector(file_id, sections))
+
+    def _retrieve_sections(self, parent_ids: List[str]) -> list:
+        try:
+            return client.retrieve(collection_name=self.sections_id, ids=parent_ids, with_vectors=False)
+        except Exception as e:
+            if not is_collection_missing(e):
+                raise
+            return []
+
+    async def _aretrieve_sections(self, parent_ids: List[str]) -> list:
+        try:
+            return await async_client.retrieve(collection_name=self.sections_id, ids=parent_ids, with_vectors=False)
+        except Exception as e:
+            if not is_collection_missing(e):
+                raise
+            return []
 
 
 def get_doc_kb_by_id(kb_id: str):
     from kb.kb_core import __kb_register, get_kb_by_id
+    from kb.numpy_kb import NumpyDocRetriever, NumpyKB
     vkb = get_kb_by_id(kb_id)
     key = f'{kb_id};doc'
     if key not in __kb_register:
-        __kb_register[key] = DocRetriever(vkb)
+        __kb_register[key] = NumpyDocRetriever(vkb) if isinstance(vkb, NumpyKB) else DocRetriever(vkb)
     return get_kb_by_id(key)
+
+
+async def aget_doc_kb_by_id(kb_id: str):
+    """异步版本的 `get_doc_kb_by_id`，首次创建时需要读取存储配置，在线程池中执行"""
+    from kb.kb_core import __kb_register
+    key = f'{kb_id};doc'
+    if key in __kb_register:
+        return __kb_register[key]
+    return await asyncio.to_thread(get_doc_kb_by_id, kb_id)
@@ -0,0 +1,101 @@
+"""
+Embedding 请求合并。并发的查询各自只有一条文本，逐条请求无法利用模型的批处理能力，
+这里在极短的时间窗口内收集同一模型的异步请求，合并为一次批量请求后再分发结果。
+"""
+import asyncio
+from typing import Optional
+
+from openai.types.embedding import Embedding
+
+from kb.embedding.kb_embedding import EmbeddingModel
+from kb.kb_config import EmbeddingConfig
+from metrics import Histogram
+
+BATCH_SIZE = Histogram("kb_embedding_coalesced_batch_size", "合并后的 Embedding 批量请求大小",
+                       labelnames=("model",), buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+class CoalescingEmbedding(EmbeddingModel):
+    """合并并发异步请求的 Embedding 模型，同步请求直接转发"""
+
+    def __init__(self, model: EmbeddingModel, model_uid: str,
+                 max_wait_ms: float = EmbeddingConfig.COALESCE_MAX_WAIT_MS,
+                 max_batch: int = EmbeddingConfig.COALESCE_MAX_BATCH):
+        """
+        Args:
+            model: 被合并请求的模型
+            model_uid: 模型id
+            max_wait_ms: 第一个请求到达后最多等待的时间（毫秒）
+            max_batch: 合并的文本数量达到该值时立即发送
+        """
+        super().__init__()
+        self.model = model
+        self.model_uid = model_uid
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending: list[tuple[list[str], asyncio.Future]] = []
+        self._pending_items = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def probe_size(self) -> int:
+        return self.model.size
+
+    async def aprobe_size(self) -> int:
+        return await self.model.asize()
+
+    def embed(self, query: str) -> Embedding:
+        return self.model.embed(query)
+
+    def embed_batch(self, texts: list[str]) -> list[Embedding]:
+        return self.model.embed_batch(texts)
+
+    async def aembed_batch(self, texts: list[str]) -> list[Embedding]:
+        if not texts:
+            return []
+        if len(texts) >= self.max_batch:
+            # 本身已经是足够大的批量请求
+            BATCH_SIZE.labels(model=self.model_uid).observe(len(texts))
+            return await self.model.aembed_batch(texts)
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop, self._pending, self._pending_items, self._timer = loop, [], 0, None
+        future = loop.create_future()
+        self._pending.append((texts, future))
+        self._pending_items += len(texts)
+        if self._pending_items >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        """发送当前收集到的请求"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending, self._pending_items = self._pending, [], 0
+        if pending:
+            task = self._loop.create_task(self._send(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, pending: list[tuple[list[str], asyncio.Future]]):
+        texts = [text for part, _ in pending for text in part]
+        BATCH_SIZE.labels(model=self.model_uid).observe(len(texts))
+        try:
+            ems = await self.model.aembed_batch(texts)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        start = 0
+        for part, future in pending:
+            res = [Embedding(embedding=em.embedding, index=i, object="embedding")
+                   for i, em in enumerate(ems[start:start + len(part)])]
+            start += len(part)
+            # 等待方可能已经取消
+            if not future.done():
+                future.set_result(res)
@@ -0,0 +1,167 @@
+"""
+Embedding 持久化缓存，按照(模型, 文本哈希)缓存向量，相同的知识块重复入库或者入库到使用同一模型的其它知识库时不再请求模型
+"""
+import asyncio
+import hashlib
+import threading
+import time
+
+import numpy as np
+from openai.types.embedding import Embedding
+
+from kb.embedding.kb_embedding import EmbeddingModel
+from kb.kb_config import EmbeddingConfig
+from kb.kb_sqlite import connect
+from metrics import Counter
+
+CACHE_HITS = Counter("kb_embedding_cache_hits_total", "Embedding 缓存命中次数", labelnames=("model",))
+CACHE_MISSES = Counter("kb_embedding_cache_misses_total", "Embedding 缓存未命中次数", labelnames=("model",))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model     TEXT NOT NULL,
+    text_hash BLOB NOT NULL,
+    dtype     TEXT NOT NULL,
+    vector    BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (model, text_hash)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used);
+"""
+
+_SQL_VARIABLES = 500
+"""单条 SQL 中参数数量上限"""
+
+
+class CachedEmbedding(EmbeddingModel):
+    """带持久化缓存的 Embedding 模型，缓存超出容量时淘汰最久未使用的向量"""
+
+    def __init__(self, model: EmbeddingModel, model_uid: str,
+                 path: str = EmbeddingConfig.CACHE_PATH,
+                 max_items: int = EmbeddingConfig.CACHE_MAX_ITEMS,
+                 dtype: str = EmbeddingConfig.CACHE_DTYPE):
+        """
+        Args:
+            model: 被缓存的模型
+            model_uid: 模型id，作为缓存键的一部分，不同模型的缓存互不影响
+            path: 缓存数据库路径
+            max_items: 缓存向量数量上限
+            dtype: 向量保存精度，float16 占用空间减半
+        """
+        super().__init__()
+        self.model = model
+        self.model_uid = model_uid
+        self.max_items = max_items
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.executescript(_SCHEMA)
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def _hash(text: str) -> bytes:
+        return hashlib.sha256(text.encode('utf-8')).digest()
+
+    def probe_size(self) -> int:
+        return self.model.size
+
+    async def aprobe_size(self) -> int:
+        return await self.model.asize()
+
+    def embed(self, query: str) -> Embedding:
+        return self.embed_batch([query])[0]
+
+    def embed_batch(self, texts: list[str]) -> list[Embedding]:
+        hashes, vectors, missing = self._prepare(texts)
+        if missing:
+            self._complete(vectors, missing, self.model.embed_batch(list(missing.values())))
+        return self._finish(hashes, vectors)
+
+    async def aembed_batch(self, texts: list[str]) -> list[Embedding]:
+        # 缓存的读写是同步的数据库事务，在线程池中执行，不阻塞事件循环
+        hashes, vectors, missing = await asyncio.to_thread(self._prepare, texts)
+        if missing:
+            ems = await self.model.aembed_batch(list(missing.values()))
+            await asyncio.to_thread(self._complete, vectors, missing, ems)
+        return self._finish(hashes, vectors)
+
+    def _prepare(self, texts: list[str]) -> tuple[list[bytes], dict[bytes, np.ndarray], dict[bytes, str]]:
+        """查询缓存，返回文本哈希、命中的向量以及需要请求模型的文本"""
+        hashes = [self._hash(text) for text in texts]
+        vectors = self._lookup(list(set(hashes)))
+        hits = sum(1 for h in hashes if h in vectors)
+        self._count_hits(hits, len(texts) - hits)
+        # 同一批中重复的文本只请求一次
+        missing = {h: text for h, text in zip(hashes, texts) if h not in vectors}
+        return hashes, vectors, missing
+
+    def _complete(self, vectors: dict[bytes, np.ndarray], missing: dict[bytes, str], ems: list[Embedding]):
+        computed = {h: np.asarray(em.embedding, dtype=np.float32) for h, em in zip(missing, ems)}
+        self._store(computed)
+        vectors.update(computed)
+
+    @staticmethod
+    def _finish(hashes: list[bytes], vectors: dict[bytes, np.ndarray]) -> list[Embedding]:
+        return [Embedding(embedding=vectors[h].tolist(), index=i, object="embedding")
+                for i, h in enumerate(hashes)]
+
+    def _count_hits(self, hits: int, misses: int):
+        self.hits += hits
+        self.misses += misses
+        CACHE_HITS.labels(model=self.model_uid).inc(hits)
+        CACHE_MISSES.labels(model=self.model_uid).inc(misses)
+
+    def _lookup(self, hashes: list[bytes]) -> dict[bytes, np.ndarray]:
+        """查询缓存并更新命中向量的使用时间"""
+        found = {}
+        with self._lock:
+            for i in range(0, len(hashes), _SQL_VARIABLES):
+                part = hashes[i:i + _SQL_VARIABLES]
+                rows = self._conn.execute(
+                    f"SELECT text_hash, dtype, vector FROM embeddings "
+                    f"WHERE model = ? AND text_hash IN ({','.join('?' * len(part))})",
+                    (self.model_uid, *part))
+                for text_hash, dtype, vector in rows:
+                    found[text_hash] = np.frombuffer(vector, dtype=dtype).astype(np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                                       [(now, self.model_uid, h) for h in found])
+        return found
+
+    def _store(self, vectors: dict[bytes, np.ndarray]):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, text_hash, dtype, vector, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(self.model_uid, h, self.dtype.str, v.astype(self.dtype).tobytes(), now)
+                     for h, v in vectors.items()])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._count += len(vectors)
+            if self._count > self.max_items:
+                self._evict()
+
+    def _evict(self):
+        """淘汰最久未使用的向量，一次淘汰到容量的90%，避免每次写入都触发淘汰"""
+        # 其它进程也可能写入同一个缓存，淘汰前重新统计
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if self._count <= self.max_items:
+            return
+        excess = self._count - int(self.max_items * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE (model, text_hash) IN "
+            "(SELECT model, text_hash FROM embeddings ORDER BY last_used LIMIT ?)", (excess,))
+        self._count -= excess
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
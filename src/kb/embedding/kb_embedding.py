@@ -1,20 +1,69 @@
 import abc
+import asyncio
+import threading
+import time
 from abc import abstractmethod
+from contextlib import contextmanager
 from logging import getLogger
-from typing import Callable, Any
+from typing import Callable, Any, Optional, Union
 
 from openai.types.embedding import Embedding
 
 from kb.embedding.embedding_excep import EmbeddingExistException, EmbeddingNotFoundException
+from metrics import Counter, Histogram
 
 _logger = getLogger(__name__)
 
+REQUEST_SECONDS = Histogram("kb_embedding_request_seconds", "Embedding 接口的请求耗时", labelnames=("model",))
+REQUEST_TEXTS = Counter("kb_embedding_texts_total", "请求 Embedding 接口的文本数量", labelnames=("model",))
+REQUEST_CHARS = Counter("kb_embedding_chars_total", "请求 Embedding 接口的文本字符数", labelnames=("model",))
+REQUEST_TOKENS = Counter("kb_embedding_tokens_total", "Embedding 接口返回的 token 用量", labelnames=("model",))
+REQUEST_ERRORS = Counter("kb_embedding_errors_total", "Embedding 接口的请求失败次数", labelnames=("model", "error"))
+
 
 class EmbeddingModel(abc.ABC, Callable[[str], Any]):
     """文本向量化模型"""
+    _PROBE_TEXT: str = "Hello"
+
+    def __init__(self, size: Optional[int] = None):
+        """
+        Args:
+            size: 向量维度，为空时在首次使用时请求一次模型获取
+        """
+        self._size = size
+        self._size_lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        """向量维度，未知时同步探测"""
+        if self._size is None:
+            with self._size_lock:
+                if self._size is None:
+                    self._size = self.probe_size()
+        return self._size
+
+    @size.setter
+    def size(self, size: int):
+        self._size = size
+
+    @property
+    def size_known(self) -> bool:
+        """向量维度是否已知，不会触发探测"""
+        return self._size is not None
 
-    def __init__(self, size: int):
-        self.size = size
+    async def asize(self) -> int:
+        """异步版本的 `size`，探测时不阻塞事件循环"""
+        if self._size is None:
+            self._size = await self.aprobe_size()
+        return self._size
+
+    def probe_size(self) -> int:
+        """请求一次模型获取向量维度"""
+        return len(self.embed(EmbeddingModel._PROBE_TEXT).embedding)
+
+    async def aprobe_size(self) -> int:
+        """异步版本的 `probe_size`"""
+        return len((await self.aembed(EmbeddingModel._PROBE_TEXT)).embedding)
 
     def __call__(self, query: str) -> Embedding:
         return self.embed(query)
@@ -23,6 +72,25 @@ class EmbeddingModel(abc.ABC, Callable[[str], Any]):
     def embed(self, query: str) -> Embedding:
         pass
 
+    def embed_batch(self, texts: list[str]) -> list[Embedding]:
+        """
+        批量向量化，默认逐条调用 `embed`，支持批量输入的模型应当重写该方法
+        Args:
+            texts: 需要向量化的文本列表
+
+        Returns:
+            与输入顺序一致的向量列表
+        """
+        return [self.embed(text) for text in texts]
+
+    async def aembed(self, query: str) -> Embedding:
+        """异步版本的 `embed`"""
+        return (await self.aembed_batch([query]))[0]
+
+    async def aembed_batch(self, texts: list[str]) -> list[Embedding]:
+        """异步版本的 `embed_batch`，默认在线程中执行，支持异步请求的模型应当重写该方法"""
+        return await asyncio.to_thread(self.embed_batch, texts)
+
 
 __embeddings: dict[str, EmbeddingModel] = {}
 
@@ -52,37 +120,181 @@ def get_all_embeddings():
     return __embeddings.copy()
 
 
+def find_wrapped(model: EmbeddingModel, cls: type) -> Optional[EmbeddingModel]:
+    """在包装链（缓存、请求合并等包装模型的 `model` 属性）中查找指定类型的模型"""
+    while model is not None:
+        if isinstance(model, cls):
+            return model
+        model = getattr(model, "model", None)
+    return None
+
+
 class OpenAIEmbedding(EmbeddingModel):
     """OpenAI Embedding Model"""
-    _TEST_TEXT: str = "Hello"
 
     def embed(self, query: str) -> Embedding:
-        res = self._client.embeddings.create(model=self.model_uid,
-                                             input=[query])
+        with self._observe([query]) as record:
+            res = record(self._client.embeddings.create(model=self.model_uid,
+                                                        input=[query]))
         return res.data[-1]
 
-    def __init__(self, client, model_uid: str):
-        super().__init__(size=0)
+    def embed_batch(self, texts: list[str]) -> list[Embedding]:
+        if not texts:
+            return []
+        with self._observe(texts) as record:
+            res = record(self._client.embeddings.create(model=self.model_uid,
+                                                        input=texts))
+        # 接口不保证返回顺序，按照index还原为输入顺序
+        return sorted(res.data, key=lambda e: e.index)
+
+    async def aembed_batch(self, texts: list[str]) -> list[Embedding]:
+        if not texts:
+            return []
+        with self._observe(texts) as record:
+            res = record(await self._aclient.embeddings.create(model=self.model_uid,
+                                                               input=texts))
+        return sorted(res.data, key=lambda e: e.index)
+
+    @contextmanager
+    def _observe(self, texts: list[str]):
+        """记录一次接口请求的耗时、文本量和失败次数，返回的函数用于记录响应中的 token 用量"""
+        def record(res):
+            usage = getattr(res, "usage", None)
+            if usage is not None and usage.total_tokens:
+                REQUEST_TOKENS.labels(model=self.model_uid).inc(usage.total_tokens)
+            return res
+
+        try:
+            with REQUEST_SECONDS.labels(model=self.model_uid).time():
+                yield record
+        except Exception as e:
+            REQUEST_ERRORS.labels(model=self.model_uid, error=type(e).__name__).inc()
+            raise
+        REQUEST_TEXTS.labels(model=self.model_uid).inc(len(texts))
+        REQUEST_CHARS.labels(model=self.model_uid).inc(sum(len(text) for text in texts))
+
+    def __init__(self, client, model_uid: str, aclient=None, size: Optional[int] = None):
+        """
+        创建时不请求模型，向量维度没有给出时在首次使用时探测
+        Args:
+            client: OpenAI 客户端
+            model_uid: 模型id
+            aclient: 异步客户端，为空时按照 client 的接口地址获取共用的异步客户端
+            size: 向量维度
+        """
+        super().__init__(size=size)
         from openai import Client
         assert isinstance(client, Client)
         self._client = client
+        self._aclient = aclient or _get_async_client(api_key=client.api_key, base_url=str(client.base_url))
         self.model_uid = model_uid
-        res = self(OpenAIEmbedding._TEST_TEXT)
-        self.size = len(res.embedding)
 
     @staticmethod
-    def from_api(api_key: str, base_url: str, model_uid: str):
+    def from_api(api_key: str, base_url: str, model_uid: str, size: Optional[int] = None):
         from openai import Client
         return OpenAIEmbedding(client=Client(api_key=api_key,
                                              base_url=base_url),
-                               model_uid=model_uid)
+                               model_uid=model_uid,
+                               aclient=_get_async_client(api_key=api_key, base_url=base_url),
+                               size=size)
+
+
+__async_clients: dict[tuple[str, str], Any] = {}
+
+
+def _get_async_client(api_key: str, base_url: str):
+    """同一接口地址的模型共用一个异步客户端，也就是共用一个连接池"""
+    key = (api_key, base_url.rstrip('/'))
+    if key not in __async_clients:
+        from openai import AsyncOpenAI
+        __async_clients[key] = AsyncOpenAI(api_key=api_key, base_url=base_url)
+    return __async_clients[key]
+
+
+class WarmUpState:
+    """模型预热状态，预热即探测向量维度，同时也建立了到模型服务的连接"""
+
+    def __init__(self):
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.models: dict[str, str] = {}
+        """模型id到状态（pending/ready/failed）"""
+        self.errors: dict[str, str] = {}
+
+    @property
+    def ready(self) -> bool:
+        return self.finished_at is not None and all(state == "ready" for state in self.models.values())
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"ready": self.ready,
+                "seconds": (self.finished_at or time.monotonic()) - self.started_at if self.started_at else None,
+                "models": self.models.copy(),
+                "errors": self.errors.copy()}
+
+
+warm_up_state = WarmUpState()
+
+
+async def awarm_up(models: dict[str, EmbeddingModel] = None) -> WarmUpState:
+    """
+    并发探测所有维度未知的模型，失败的模型会在首次使用时再次探测
+    Args:
+        models: 需要预热的模型，默认为所有已注册的模型
+    """
+    models = get_all_embeddings() if models is None else models
+    state = warm_up_state
+    state.started_at, state.finished_at = time.monotonic(), None
+    state.models = {model_uid: "pending" for model_uid in models}
+    state.errors = {}
+
+    async def probe(model_uid: str, model: EmbeddingModel):
+        try:
+            await model.asize()
+        except Exception as e:
+            _logger.warning(f"Failed to warm up EmbeddingModel-[{model_uid}]: {e!r}")
+            state.models[model_uid] = "failed"
+            state.errors[model_uid] = repr(e)
+        else:
+            state.models[model_uid] = "ready"
+
+    await asyncio.gather(*[probe(model_uid, model) for model_uid, model in models.items()])
+    state.finished_at = time.monotonic()
+    return state
 
 
 from kb.kb_config import EmbeddingConfig
 
+
+def _parse_dimensions(dimensions: Union[str, dict[str, int]]) -> dict[str, int]:
+    """解析配置的向量维度，环境变量格式为 `model:size,model:size`"""
+    if isinstance(dimensions, dict):
+        return {model_uid: int(size) for model_uid, size in dimensions.items()}
+    res = {}
+    for item in dimensions.split(","):
+        if item.strip():
+            model_uid, size = item.rsplit(":", 1)
+            res[model_uid.strip()] = int(size)
+    return res
+
+
 embeds = [EmbeddingConfig.EMBEDDINGS] if isinstance(EmbeddingConfig.EMBEDDINGS, str) else EmbeddingConfig.EMBEDDINGS
 
+cache_models = EmbeddingConfig.CACHE_MODELS
+if isinstance(cache_models, str):
+    cache_models = [m.strip() for m in cache_models.split(",") if m.strip()]
+
+dimensions = _parse_dimensions(EmbeddingConfig.DIMENSIONS)
+
+# 注册时不请求模型，维度没有配置的模型在预热或首次使用时探测
 for emb in embeds:
-    register(emb, OpenAIEmbedding.from_api(api_key=EmbeddingConfig.API_KEY,
-                                           base_url=EmbeddingConfig.BASE_URL,
-                                           model_uid=emb))
+    em = OpenAIEmbedding.from_api(api_key=EmbeddingConfig.API_KEY,
+                                  base_url=EmbeddingConfig.BASE_URL,
+                                  model_uid=emb,
+                                  size=dimensions.get(emb))
+    if emb in cache_models:
+        from kb.embedding.embedding_cache import CachedEmbedding
+        em = CachedEmbedding(em, model_uid=emb)
+    if EmbeddingConfig.COALESCE_MAX_WAIT_MS > 0:
+        from kb.embedding.embedding_batcher import CoalescingEmbedding
+        em = CoalescingEmbedding(em, model_uid=emb)
+    register(emb, em)
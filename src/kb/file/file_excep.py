@@ -35,3 +35,12 @@ class FileNotFound(FileException):
         super().__init__(filename)
         self.base_path = base_path
         self.msg = msg or f"The file-[{filename}] is not found" + (f" in path-[{base_path}]" if base_path else "")
+
+
+class FileDuplicateException(FileException):
+    """知识库中已经存在相同内容的其它文档"""
+
+    def __init__(self, filename, file_id, msg=None):
+        super().__init__(filename)
+        self.file_id = file_id
+        self.msg = msg or f"The content of file-[{filename}] already exists as file-[{file_id}]"
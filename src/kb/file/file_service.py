@@ -1,8 +1,16 @@
 import glob
+import hashlib
 import os.path
+import re
 import uuid
+from typing import AsyncIterator, NamedTuple, Optional
 
+import anyio
 import magic
+from fastapi import Request, UploadFile
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
 from kb.file.file_excep import FileTypeException, FileSizeException, FileNotFound
 from kb.kb_config import UploadConfig
@@ -26,34 +34,205 @@ def check_file_type(byte, filename):
         raise FileTypeException(filename, msg="File extension does not match MIME type")
 
 
-def check_file_size(byte):
+def check_file_size(size: int, filename: str = ""):
     """检查文件大小不得超出指定大小"""
-    limit_size = UploadConfig.MAX_FILE_SIZE * 1024 * 1024
-    if len(byte) > limit_size:
-        raise FileSizeException(filename="", msg=f"File size limited in {UploadConfig.MAX_FILE_SIZE}MB")
+    if size > max_file_bytes():
+        raise FileSizeException(filename=filename, msg=f"File size limited in {UploadConfig.MAX_FILE_SIZE}MB")
+
+
+def max_file_bytes() -> int:
+    """文件大小限制（字节）"""
+    return UploadConfig.MAX_FILE_SIZE * 1024 * 1024
 
 
 def get_file_ext(filename) -> str:
     return filename.split('.')[-1].lower()
 
 
-def save_file(contents, filename) -> tuple[str, str]:
+class SavedFile(NamedTuple):
+    """保存后的上传文件"""
+    path: str
+    size: int
+    sha256: str
+
+
+async def save_upload_file(file: UploadFile) -> SavedFile:
     """
-    保存文件到配置目录
+    分块保存上传文件到配置目录，保存过程中检查大小、类型并计算哈希，内存占用与文件大小无关
     Args:
-        contents: 文件内容
-        filename: 上传时的文件名
+        file: 上传的文件
 
     Returns:
-        文件id
+        保存后的临时文件，需要通过 `FileStore.add` 按内容转存
+
+    Raises:
+        FileSizeException: 文件超出大小限制
+        FileTypeException: 文件类型不允许
     """
-    file_id = uuid.uuid4().__str__()
     os.makedirs(UploadConfig.UPLOAD_SAVING_PATH, exist_ok=True)
-    save_file_path = os.path.join(UploadConfig.UPLOAD_SAVING_PATH,
-                                  file_id + '.' + get_file_ext(filename))
-    with open(save_file_path, 'wb') as f:
-        f.write(contents)
-    return file_id, save_file_path
+    # 写入临时文件，全部校验通过后再按内容转存，避免留下不完整的文件
+    part_path = os.path.join(UploadConfig.UPLOAD_SAVING_PATH, f"{uuid.uuid4()}.part")
+    sha256 = hashlib.sha256()
+    size = 0
+    head = b''
+    try:
+        with open(part_path, 'wb') as f:
+            while chunk := await file.read(UploadConfig.CHUNK_SIZE):
+                size += len(chunk)
+                check_file_size(size, file.filename)
+                if len(head) < UploadConfig.MIME_SNIFF_SIZE:
+                    head += chunk[:UploadConfig.MIME_SNIFF_SIZE - len(head)]
+                    if len(head) == UploadConfig.MIME_SNIFF_SIZE:
+                        check_file_type(head, file.filename)
+                await run_in_threadpool(_write_chunk, f, sha256, chunk)
+        if len(head) < UploadConfig.MIME_SNIFF_SIZE:
+            check_file_type(head, file.filename)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return SavedFile(path=part_path, size=size, sha256=sha256.hexdigest())
+
+
+def _write_chunk(f, sha256, chunk: bytes):
+    sha256.update(chunk)
+    f.write(chunk)
+
+
+class UploadSizeLimitMiddleware:
+    """
+    上传大小限制中间件。请求体在进入路由前就会被完整接收，因此在接收阶段统计字节数，
+    超出限制时立即中断接收并返回错误，而不是等整个文件上传完成
+    """
+
+    _MULTIPART_OVERHEAD = 64 * 1024
+    """multipart 编码的边界、头部等额外开销"""
+
+    def __init__(self, app, path_prefix: str = "/kb/file/"):
+        self.app = app
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "PUT" or self.path_prefix not in scope["path"]:
+            await self.app(scope, receive, send)
+            return
+        limit = max_file_bytes() + self._MULTIPART_OVERHEAD
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            await self._reject(scope, receive, send)
+            return
+
+        received = 0
+        exceeded = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise FileSizeException(filename="", msg=f"File size limited in {UploadConfig.MAX_FILE_SIZE}MB")
+            return message
+
+        async def guarded_send(message):
+            # 超出限制后路由对请求体解析失败的响应会被替换
+            if not exceeded:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except FileSizeException:
+            if not exceeded:
+                raise
+        if exceeded:
+            await self._reject(scope, receive, send)
+
+    @staticmethod
+    async def _reject(scope, receive, send):
+        from common import failed
+        response = JSONResponse(status_code=400, content=jsonable_encoder(
+            failed(msg=f"File size limited in {UploadConfig.MAX_FILE_SIZE}MB")))
+        await response(scope, receive, send)
+
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _parse_range(value: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    解析单个字节范围，多个范围不支持，按完整文件返回
+    Returns:
+        [起始, 结束] 闭区间，不支持时返回None
+
+    Raises:
+        ValueError: 范围超出文件大小
+    """
+    match = _RANGE_PATTERN.match(value.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if start == "":
+        if end == "" or int(end) == 0:
+            raise ValueError(value)
+        # 后缀范围：最后n个字节
+        return max(0, size - int(end)), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError(value)
+    return start, end
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def file_range_response(request: Request, path: str, filename: str, etag: str = None) -> Response:
+    """
+    文件下载响应，支持断点续传（单个 Range）和条件请求（If-None-Match、If-Range）
+    Args:
+        request: 下载请求
+        path: 文件路径
+        filename: 下载的文件名
+        etag: 文件内容的标识，一般为内容哈希，为空时按修改时间和大小生成
+    """
+    stat = os.stat(path)
+    etag = f'"{etag or hashlib.md5(f"{stat.st_mtime}-{stat.st_size}".encode()).hexdigest()}"'
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = _parse_range(range_header, stat.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers.update({"Content-Range": f"bytes {start}-{end}/{stat.st_size}",
+                            "Content-Length": str(end - start + 1),
+                            "Content-Disposition": f'attachment; filename="{filename}"'})
+            return StreamingResponse(_read_range(path, start, end), status_code=206, headers=headers,
+                                     media_type="application/octet-stream")
+    return FileResponse(path=path, filename=filename, headers=headers, stat_result=stat)
+
+
+async def _read_range(path: str, start: int, end: int) -> AsyncIterator[bytes]:
+    remaining = end - start + 1
+    async with await anyio.open_file(path, mode="rb") as f:
+        await f.seek(start)
+        while remaining > 0:
+            chunk = await f.read(min(UploadConfig.CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
 
 
 def get_upload_file_path(file_id: str) -> str:
@@ -68,6 +247,11 @@ def get_upload_file_path(file_id: str) -> str:
     Raises:
         FileNotFound: 文件不存在
     """
+    from kb.file.file_store import get_file_store
+    path = get_file_store().path_of(file_id)
+    if path and os.path.exists(path):
+        return path
+    # 兼容按文档id命名保存的旧文件
     files = glob.glob(f"{file_id}.*", root_dir=UploadConfig.UPLOAD_SAVING_PATH)
     if len(files) > 0:
         filename = files[-1]
@@ -0,0 +1,293 @@
+"""
+上传文件索引。文件内容按 SHA-256 寻址保存，同一份内容在磁盘上只保存一次；
+文档id在知识库内按内容唯一，重复上传相同内容到同一个知识库会得到同一个文档id。
+"""
+import os
+import threading
+import time
+import uuid
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+from kb.file.file_excep import FileNotFound, FileDuplicateException
+from kb.file.file_service import SavedFile, get_file_ext
+from kb.job.job_queue import JobQueue, JobState, get_job_queue
+from kb.kb_config import UploadConfig
+from kb.kb_sqlite import connect
+
+
+class FileRecord(BaseModel):
+    """知识库中的文档"""
+    file_id: str = Field(description="文档id")
+    kb_id: str = Field(description="知识库id")
+    sha256: str = Field(description="文件内容哈希")
+    filename: str = Field(description="首次上传时的文件名")
+    path: str = Field(description="文件保存路径")
+    size: int = Field(description="文件大小（字节）")
+    job_id: Optional[str] = Field(description="入库任务id", default=None)
+    status: JobState = Field(description="入库状态，与最近一次入库任务的状态一致", default=JobState.PENDING)
+    chunks: Optional[int] = Field(description="入库的知识块数量，入库完成前为空", default=None)
+    created_at: float = Field(description="首次上传时间")
+    aliases: list[str] = Field(description="重复上传时使用过的其它文件名", default=[])
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id    TEXT PRIMARY KEY,
+    kb_id      TEXT NOT NULL,
+    sha256     TEXT NOT NULL,
+    filename   TEXT NOT NULL,
+    path       TEXT NOT NULL,
+    size       INTEGER NOT NULL,
+    job_id     TEXT,
+    status     TEXT NOT NULL DEFAULT 'pending',
+    chunks     INTEGER,
+    created_at REAL NOT NULL,
+    UNIQUE (kb_id, sha256)
+);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+CREATE INDEX IF NOT EXISTS files_kb_id ON files (kb_id, created_at);
+CREATE TABLE IF NOT EXISTS file_aliases (
+    file_id  TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (file_id, filename)
+);
+"""
+
+
+class FileStore:
+    """
+    上传文件索引，记录文档与内容的对应关系，内容的引用数为引用它的文档数。
+    API 进程和工作进程共用同一个索引，文件的转存和删除都在 `BEGIN IMMEDIATE` 事务中进行，多个进程之间互斥
+    """
+
+    def __init__(self, path: str = UploadConfig.INDEX_PATH, jobs: JobQueue = None):
+        """
+        Args:
+            path: 索引数据库路径
+            jobs: 任务队列，删除文件前检查是否还有未完成的任务使用该文件，默认为 `get_job_queue()`
+        """
+        self.path = path
+        self._jobs = jobs
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(files)")}
+        if columns and "status" not in columns:
+            # 旧版本创建的索引没有入库状态，已有文档按已入库处理
+            self._conn.execute("ALTER TABLE files ADD COLUMN status TEXT NOT NULL DEFAULT 'done'")
+            self._conn.execute("ALTER TABLE files ADD COLUMN chunks INTEGER")
+        self._conn.executescript(_SCHEMA)
+
+    def add(self, kb_id: str, saved: SavedFile, filename: str) -> tuple[FileRecord, bool]:
+        """
+        将上传的临时文件按内容转存并登记，知识库中已经存在相同内容时返回已有的文档，并将文件名记为别名
+        Args:
+            kb_id: 知识库id
+            saved: 上传保存的临时文件
+            filename: 上传时的文件名
+
+        Returns:
+            文档，以及是否为新建的文档
+        """
+        sha256 = saved.sha256
+        path = os.path.join(UploadConfig.UPLOAD_SAVING_PATH, f"{sha256}.{get_file_ext(filename)}")
+        with self._lock:
+            # 与其它进程中删除文件互斥，避免刚复用的文件被删除
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._move(saved, path)
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO files (file_id, kb_id, sha256, filename, path, size, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (str(uuid.uuid4()), kb_id, sha256, filename, path, saved.size, time.time()))
+                created = cursor.rowcount == 1
+                row = self._conn.execute("SELECT file_id, filename FROM files WHERE kb_id = ? AND sha256 = ?",
+                                         (kb_id, sha256)).fetchone()
+                if not created and row["filename"] != filename:
+                    self._conn.execute("INSERT OR IGNORE INTO file_aliases (file_id, filename) VALUES (?, ?)",
+                                       (row["file_id"], filename))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self.get(row["file_id"]), created
+
+    def replace(self, kb_id: str, file_id: str, saved: SavedFile, filename: str) -> tuple[FileRecord, bool]:
+        """
+        用上传的临时文件替换文档内容，文档id不变，旧内容不再被文档和未完成的任务引用时删除
+        Args:
+            kb_id: 知识库id
+            file_id: 被替换的文档id
+            saved: 上传保存的临时文件
+            filename: 上传时的文件名，与原文件名不同时记为别名
+
+        Returns:
+            文档，以及内容是否发生变化
+
+        Raises:
+            FileNotFound: 知识库中不存在该文档
+            FileDuplicateException: 知识库中已经有其它文档是相同的内容
+        """
+        sha256 = saved.sha256
+        path = os.path.join(UploadConfig.UPLOAD_SAVING_PATH, f"{sha256}.{get_file_ext(filename)}")
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT sha256, path, filename FROM files WHERE file_id = ? AND kb_id = ?",
+                                         (file_id, kb_id)).fetchone()
+                if row is None:
+                    raise FileNotFound(filename=file_id)
+                if row["sha256"] != sha256:
+                    other = self._conn.execute("SELECT file_id FROM files WHERE kb_id = ? AND sha256 = ?",
+                                               (kb_id, sha256)).fetchone()
+                    if other is not None:
+                        raise FileDuplicateException(filename=filename, file_id=other["file_id"])
+                    self._conn.execute("UPDATE files SET sha256 = ?, path = ?, size = ? WHERE file_id = ?",
+                                       (sha256, path, saved.size, file_id))
+                if row["filename"] != filename:
+                    self._conn.execute("INSERT OR IGNORE INTO file_aliases (file_id, filename) VALUES (?, ?)",
+                                       (file_id, filename))
+                self._move(saved, path)
+                changed = row["sha256"] != sha256
+                if changed:
+                    self._remove_unreferenced(row["path"])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                if os.path.exists(saved.path):
+                    os.remove(saved.path)
+                raise
+        return self.get(file_id), changed
+
+    def set_job(self, file_id: str, job_id: str):
+        """记录文档的入库任务，入库状态重置为等待"""
+        with self._lock:
+            self._conn.execute("UPDATE files SET job_id = ?, status = ? WHERE file_id = ?",
+                               (job_id, JobState.PENDING.value, file_id))
+
+    def set_status(self, file_id: str, status: JobState, chunks: int = None):
+        """
+        更新文档的入库状态
+        Args:
+            file_id: 文档id
+            status: 入库状态
+            chunks: 入库的知识块数量，为空时不更新
+        """
+        with self._lock:
+            self._conn.execute("UPDATE files SET status = ?, chunks = COALESCE(?, chunks) WHERE file_id = ?",
+                               (status.value, chunks, file_id))
+
+    def find(self, file_id: str) -> Optional[FileRecord]:
+        """查询文档，不存在时返回None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM files WHERE file_id = ?", (file_id,)).fetchone()
+            if row is None:
+                return None
+            aliases = [r["filename"] for r in self._conn.execute(
+                "SELECT filename FROM file_aliases WHERE file_id = ? ORDER BY rowid", (file_id,))]
+        return FileRecord(**row, aliases=aliases)
+
+    def list(self, kb_id: str, offset: int = 0, limit: int = 100) -> tuple[list[FileRecord], int]:
+        """
+        按上传时间列出知识库中的文档
+        Returns:
+            当前页的文档，以及文档总数
+        """
+        with self._lock:
+            total = self._conn.execute("SELECT COUNT(*) FROM files WHERE kb_id = ?", (kb_id,)).fetchone()[0]
+            rows = self._conn.execute("SELECT * FROM files WHERE kb_id = ? ORDER BY created_at, file_id "
+                                      "LIMIT ? OFFSET ?", (kb_id, limit, offset)).fetchall()
+            aliases: dict[str, list[str]] = {}
+            if rows:
+                marks = ",".join("?" * len(rows))
+                for r in self._conn.execute(f"SELECT file_id, filename FROM file_aliases "
+                                            f"WHERE file_id IN ({marks}) ORDER BY rowid",
+                                            [row["file_id"] for row in rows]):
+                    aliases.setdefault(r["file_id"], []).append(r["filename"])
+        return [FileRecord(**row, aliases=aliases.get(row["file_id"], [])) for row in rows], total
+
+    def get(self, file_id: str) -> FileRecord:
+        """
+        查询文档
+
+        Raises:
+            FileNotFound: 文档不存在
+        """
+        record = self.find(file_id)
+        if record is None:
+            raise FileNotFound(filename=file_id)
+        return record
+
+    def release(self, kb_id: str, file_id: str) -> bool:
+        """
+        从知识库中移除文档，内容不再被任何文档和未完成的任务引用时删除磁盘上的文件
+        Returns:
+            文档是否存在
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT sha256, path FROM files WHERE file_id = ? AND kb_id = ?",
+                                         (file_id, kb_id)).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return False
+                self._conn.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+                self._conn.execute("DELETE FROM file_aliases WHERE file_id = ?", (file_id,))
+                self._remove_unreferenced(row["path"])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return True
+
+    def remove_unreferenced(self, path: str) -> bool:
+        """
+        文件不再被任何文档和未完成的任务引用时删除。
+        替换或移除文档时仍有任务在使用旧文件则暂时保留，由工作进程在任务结束后调用
+        Returns:
+            文件是否被删除
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                removed = self._remove_unreferenced(path)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return removed
+
+    @staticmethod
+    def _move(saved: SavedFile, path: str):
+        """将临时文件转存到内容寻址的路径，内容已经存在时丢弃临时文件，需要在写事务中调用"""
+        if os.path.exists(path):
+            os.remove(saved.path)
+        else:
+            os.replace(saved.path, path)
+
+    def _remove_unreferenced(self, path: str) -> bool:
+        """在写事务中检查文件的引用并删除，事务期间其它进程无法转存或登记同一个文件"""
+        refs = self._conn.execute("SELECT COUNT(*) FROM files WHERE path = ?", (path,)).fetchone()[0]
+        if refs or (self._jobs or get_job_queue()).uses(path) or not os.path.exists(path):
+            return False
+        os.remove(path)
+        return True
+
+    def path_of(self, file_id: str) -> Optional[str]:
+        """文档的文件路径，不存在时返回None"""
+        with self._lock:
+            row = self._conn.execute("SELECT path FROM files WHERE file_id = ?", (file_id,)).fetchone()
+        return row["path"] if row else None
+
+
+__store: Optional[FileStore] = None
+
+
+def get_file_store() -> FileStore:
+    """获取上传文件索引，首次使用时初始化"""
+    global __store
+    if __store is None:
+        __store = FileStore()
+    return __store
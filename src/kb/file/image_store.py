@@ -0,0 +1,96 @@
+"""
+文档图片存储。图片按内容的 SHA-256 命名，同一张图片（例如每页都有的logo）无论出现多少次、上传多少次都只写入一次；
+写入在线程池中进行，不阻塞文档解析。
+"""
+import hashlib
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from kb.file.file_excep import FileNotFound
+from kb.kb_config import DocxImageParserConfig
+
+_NAME_PATTERN = re.compile(r"^[\w-]+\.\w+$")
+"""图片文件名，兼容以前按uuid命名的图片"""
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DocxImageParserConfig.WRITE_WORKERS,
+                                           thread_name_prefix="kb-image-writer")
+        return _executor
+
+
+class ImageStore:
+    """按内容寻址的图片目录"""
+
+    def __init__(self, path: str = DocxImageParserConfig.IMG_SAVE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending: dict[str, Future] = {}
+        """正在写入的图片"""
+
+    def save(self, blob: bytes, ext: str = "png") -> str:
+        """
+        提交图片写入，立即返回文件名，文件在后台写入
+        Args:
+            blob: 图片内容
+            ext: 图片扩展名
+
+        Returns:
+            图片文件名
+        """
+        filename = f"{hashlib.sha256(blob).hexdigest()}.{ext.lower()}"
+        with self._lock:
+            if filename in self._pending or os.path.exists(os.path.join(self.path, filename)):
+                return filename
+            self._pending[filename] = _get_executor().submit(self._write, filename, blob)
+        return filename
+
+    def _write(self, filename: str, blob: bytes):
+        os.makedirs(self.path, exist_ok=True)
+        # 先写临时文件再改名，其它进程不会读到写了一半的图片
+        tmp = os.path.join(self.path, f"{filename}.{uuid.uuid4().hex}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(blob)
+        os.replace(tmp, os.path.join(self.path, filename))
+
+    def flush(self):
+        """等待已提交的图片全部写入，写入失败时抛出异常"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.result()
+
+    def path_of(self, filename: str) -> str:
+        """
+        图片的文件路径
+
+        Raises:
+            FileNotFound: 图片不存在或者文件名不合法
+        """
+        if not _NAME_PATTERN.match(filename):
+            raise FileNotFound(filename=filename)
+        path = os.path.join(self.path, filename)
+        if not os.path.isfile(path):
+            raise FileNotFound(filename=filename, base_path=self.path)
+        return path
+
+
+__stores: dict[str, ImageStore] = {}
+
+
+def get_image_store(path: str = None) -> ImageStore:
+    """获取图片目录，同一目录共用一个实例"""
+    path = path or DocxImageParserConfig.IMG_SAVE_PATH
+    if path not in __stores:
+        __stores.setdefault(path, ImageStore(path))
+    return __stores[path]
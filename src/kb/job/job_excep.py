@@ -0,0 +1,24 @@
+from common import AbsException
+
+
+class JobException(AbsException):
+    """入库任务异常"""
+
+    def __init__(self, job_id, msg=None):
+        super().__init__(msg or f"JobException with job {job_id}")
+        self.job_id = job_id
+
+
+class JobNotFoundException(JobException):
+    """任务不存在"""
+
+    def __init__(self, job_id):
+        super().__init__(job_id, msg=f"The job-[{job_id}] is not found")
+
+
+class JobStateException(JobException):
+    """任务状态不允许当前操作"""
+
+    def __init__(self, job_id, state):
+        super().__init__(job_id, msg=f"The job-[{job_id}] is {state}, only failed jobs can be retried")
+        self.state = state
@@ -0,0 +1,216 @@
+"""
+知识入库任务队列，基于本地 SQLite 持久化，API 进程负责提交与查询，工作进程负责消费
+"""
+import threading
+import time
+import uuid
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+from kb.job.job_excep import JobNotFoundException, JobStateException
+from kb.kb_config import JobConfig
+from kb.kb_sqlite import connect
+
+
+class JobState(str, Enum):
+    """任务状态"""
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class JobKind(str, Enum):
+    """任务类型"""
+    INGEST = "ingest"
+    """解析文档并写入全部知识块"""
+    REPLACE = "replace"
+    """文档内容更新，只写入新增或变化的知识块，删除不再存在的知识块"""
+
+
+class Job(BaseModel):
+    """入库任务"""
+    job_id: str = Field(description="任务id")
+    kind: JobKind = Field(description="任务类型", default=JobKind.INGEST)
+    kb_id: str = Field(description="知识库id")
+    file_id: str = Field(description="文档id")
+    filename: str = Field(description="上传时的文件名")
+    filepath: str = Field(description="文件保存路径")
+    state: JobState = Field(description="任务状态")
+    attempts: int = Field(description="已经执行的次数", default=0)
+    chunks_total: Optional[int] = Field(description="知识块总数，解析完成后才能确定", default=None)
+    chunks_done: int = Field(description="已经写入知识库的知识块数量，重试时从这里继续", default=0)
+    error: Optional[str] = Field(description="最近一次失败的原因", default=None)
+    created_at: float = Field(description="提交时间")
+    started_at: Optional[float] = Field(description="最近一次开始执行的时间", default=None)
+    finished_at: Optional[float] = Field(description="完成时间", default=None)
+    parse_seconds: float = Field(description="文档解析耗时（秒）", default=0)
+    write_seconds: float = Field(description="向量化与写入耗时（秒）", default=0)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id        TEXT PRIMARY KEY,
+    kb_id         TEXT NOT NULL,
+    file_id       TEXT NOT NULL,
+    filename      TEXT NOT NULL,
+    filepath      TEXT NOT NULL,
+    state         TEXT NOT NULL,
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    chunks_total  INTEGER,
+    chunks_done   INTEGER NOT NULL DEFAULT 0,
+    error         TEXT,
+    created_at    REAL NOT NULL,
+    available_at  REAL NOT NULL,
+    started_at    REAL,
+    heartbeat_at  REAL,
+    finished_at   REAL,
+    parse_seconds REAL NOT NULL DEFAULT 0,
+    write_seconds REAL NOT NULL DEFAULT 0,
+    kind          TEXT NOT NULL DEFAULT 'ingest'
+);
+CREATE INDEX IF NOT EXISTS jobs_state_available ON jobs (state, available_at);
+"""
+
+
+class JobQueue:
+    """持久化的任务队列，进程重启后未完成的任务会被重新领取"""
+
+    def __init__(self, path: str = JobConfig.DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.executescript(_SCHEMA)
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "kind" not in columns:
+            # 旧版本创建的任务表没有任务类型
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN kind TEXT NOT NULL DEFAULT 'ingest'")
+
+    def submit(self, kb_id: str, file_id: str, filename: str, filepath: str,
+               kind: JobKind = JobKind.INGEST) -> Job:
+        """提交入库任务"""
+        now = time.time()
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, kind, kb_id, file_id, filename, filepath, state, created_at, available_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind.value, kb_id, file_id, filename, filepath, JobState.PENDING.value, now, now))
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Job:
+        """
+        查询任务
+        Raises:
+            JobNotFoundException: 任务不存在
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            raise JobNotFoundException(job_id=job_id)
+        return Job(**row)
+
+    def claim(self) -> Optional[Job]:
+        """
+        领取一个可执行的任务：待执行且到达重试时间的任务，或者心跳超时（工作进程异常退出）的执行中任务
+
+        Returns:
+            领取到的任务，没有则返回None
+        """
+        now = time.time()
+        stale = now - JobConfig.STALE_SECONDS
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT job_id FROM jobs "
+                    "WHERE (state = ? AND available_at <= ?) OR (state = ? AND heartbeat_at < ?) "
+                    "ORDER BY created_at LIMIT 1",
+                    (JobState.PENDING.value, now, JobState.RUNNING.value, stale)).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE jobs SET state = ?, attempts = attempts + 1, started_at = ?, heartbeat_at = ? "
+                    "WHERE job_id = ?",
+                    (JobState.RUNNING.value, now, now, row["job_id"]))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self.get(row["job_id"])
+
+    def progress(self, job_id: str, chunks_done: int, chunks_total: int = None,
+                 parse_seconds: float = None, write_seconds: float = None):
+        """记录任务进度，同时作为工作进程的心跳"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET chunks_done = ?, chunks_total = COALESCE(?, chunks_total), "
+                "parse_seconds = COALESCE(?, parse_seconds), write_seconds = COALESCE(?, write_seconds), "
+                "heartbeat_at = ? WHERE job_id = ?",
+                (chunks_done, chunks_total, parse_seconds, write_seconds, time.time(), job_id))
+
+    def heartbeat(self, job_id: str):
+        """执行中任务的心跳，只更新心跳时间，任务已经结束或被重新领取时不影响"""
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ? AND state = ?",
+                               (time.time(), job_id, JobState.RUNNING.value))
+
+    def uses(self, filepath: str) -> bool:
+        """是否有待执行或执行中的任务使用该文件"""
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM jobs WHERE filepath = ? AND state IN (?, ?) LIMIT 1",
+                                     (filepath, JobState.PENDING.value, JobState.RUNNING.value)).fetchone()
+        return row is not None
+
+    def finish(self, job_id: str):
+        """任务完成"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, chunks_total = COALESCE(chunks_total, chunks_done), "
+                "chunks_done = COALESCE(chunks_total, chunks_done), error = NULL, finished_at = ? "
+                "WHERE job_id = ?",
+                (JobState.DONE.value, time.time(), job_id))
+
+    def fail(self, job_id: str, error: str):
+        """任务失败，未超过最大次数时按指数退避重新排队，保留已完成的进度"""
+        job = self.get(job_id)
+        now = time.time()
+        if job.attempts < JobConfig.MAX_ATTEMPTS:
+            state, available_at, finished_at = JobState.PENDING, now + JobConfig.RETRY_DELAY * 2 ** (
+                    job.attempts - 1), None
+        else:
+            state, available_at, finished_at = JobState.FAILED, now, now
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, available_at = ?, finished_at = ? WHERE job_id = ?",
+                (state.value, error, available_at, finished_at, job_id))
+
+    def retry(self, job_id: str) -> Job:
+        """
+        手动重试失败的任务，从最后写入的知识块继续
+
+        Raises:
+            JobStateException: 任务不是失败状态
+        """
+        job = self.get(job_id)
+        if job.state != JobState.FAILED:
+            raise JobStateException(job_id=job_id, state=job.state.value)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, attempts = 0, available_at = ?, finished_at = NULL WHERE job_id = ?",
+                (JobState.PENDING.value, time.time(), job_id))
+        return self.get(job_id)
+
+
+__queue: Optional[JobQueue] = None
+
+
+def get_job_queue() -> JobQueue:
+    """获取当前进程的任务队列，首次使用时初始化"""
+    global __queue
+    if __queue is None:
+        __queue = JobQueue()
+    return __queue
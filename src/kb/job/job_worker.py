@@ -0,0 +1,154 @@
+"""
+入库任务工作进程，可以随 API 进程启动，也可以单独启动：
+
+    python -m kb.job.job_worker
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.synchronize import Event
+
+from kb.job.job_queue import Job, JobKind, JobQueue, JobState, get_job_queue
+from kb.kb_config import JobConfig
+from kb.kb_metrics import get_metrics_store
+from metrics import Counter
+
+JOB_FAILURES = Counter("kb_job_failures_total", "入库任务的失败次数，包含之后重试成功的", labelnames=("kind", "error"))
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def heartbeat(queue: JobQueue, job_id: str, interval: float = None):
+    """
+    任务执行期间在后台线程中定期发送心跳，单个解析或向量化步骤耗时很长、没有进度回调时任务也不会被视为超时
+    Args:
+        interval: 心跳间隔（秒），默认为 `JobConfig.STALE_SECONDS` 的三分之一
+    """
+    interval = JobConfig.STALE_SECONDS / 3 if interval is None else interval
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(interval):
+            try:
+                queue.heartbeat(job_id)
+            except Exception:
+                logger.exception(f"Job-[{job_id}] heartbeat failed")
+
+    thread = threading.Thread(target=beat, name=f"heartbeat-{job_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def run_job(queue: JobQueue, job: Job):
+    """执行单个入库任务，从上次写入的知识块继续，替换任务重新比对后继续"""
+    from kb.file.file_store import get_file_store
+    from kb.kb_file import replace_kb_docx, write_to_kb_with_docx
+
+    write_seconds = job.write_seconds
+    total = job.chunks_total
+
+    def on_progress(chunks_done: int, chunks_total: int, parse_seconds: float, seconds: float):
+        nonlocal total
+        total = chunks_total if chunks_total is not None else total
+        queue.progress(job.job_id, chunks_done=chunks_done, chunks_total=chunks_total,
+                       parse_seconds=parse_seconds, write_seconds=write_seconds + seconds)
+        # 长时间的任务执行中也定期写入指标
+        get_metrics_store().flush(force=False)
+
+    logger.info(f"Job-[{job.job_id}] start at chunk {job.chunks_done}, attempt {job.attempts}")
+    store = get_file_store()
+    store.set_status(job.file_id, JobState.RUNNING)
+    try:
+        with heartbeat(queue, job.job_id):
+            if job.kind == JobKind.REPLACE:
+                replace_kb_docx(filepath=job.filepath,
+                                kb_id=job.kb_id,
+                                filename=job.filename,
+                                file_id=job.file_id,
+                                on_progress=on_progress)
+            else:
+                write_to_kb_with_docx(filepath=job.filepath,
+                                      kb_id=job.kb_id,
+                                      filename=job.filename,
+                                      file_id=job.file_id,
+                                      skip=job.chunks_done,
+                                      on_progress=on_progress)
+    except Exception as e:
+        logger.exception(f"Job-[{job.job_id}] failed")
+        JOB_FAILURES.labels(kind=job.kind.value, error=type(e).__name__).inc()
+        queue.fail(job.job_id, error=repr(e))
+        # 未超过最大次数时任务重新排队，文档状态与任务一致
+        state = queue.get(job.job_id).state
+        store.set_status(job.file_id, state)
+    else:
+        queue.finish(job.job_id)
+        store.set_status(job.file_id, JobState.DONE, chunks=total)
+        state = JobState.DONE
+    if state != JobState.PENDING:
+        # 任务执行期间文档被替换或移除时旧文件保留到任务结束
+        store.remove_unreferenced(job.filepath)
+
+
+def work(stop_event: Event):
+    """工作进程主循环，直到收到停止信号"""
+    import config
+    config.logs_config(handlers=config.file_handle(tag='JOB'))
+    from kb import kb_parse_pool
+    queue = get_job_queue()
+    store = get_metrics_store()
+    try:
+        while not stop_event.is_set():
+            store.flush(force=False)
+            job = queue.claim()
+            if job is None:
+                stop_event.wait(JobConfig.POLL_INTERVAL)
+                continue
+            run_job(queue, job)
+    finally:
+        kb_parse_pool.shutdown()
+        store.flush()
+
+
+class WorkerPool:
+    """工作进程池，进程之间通过任务队列协调，不共享其它状态"""
+
+    def __init__(self, num: int = JobConfig.WORKER_NUM):
+        # 使用 spawn 避免子进程继承父进程中已经建立的网络连接
+        self._ctx = multiprocessing.get_context("spawn")
+        self._stop_event = self._ctx.Event()
+        self.num = num
+        self.processes: list[multiprocessing.Process] = []
+
+    def start(self):
+        for i in range(self.num):
+            p = self._ctx.Process(target=work, args=(self._stop_event,), name=f"kb-job-worker-{i}")
+            p.start()
+            self.processes.append(p)
+        logger.info(f"Started {self.num} ingest job workers")
+
+    def stop(self, timeout: float = 30):
+        """通知工作进程在当前任务结束后退出，超时则强制结束，未完成的任务会在下次启动后继续"""
+        self._stop_event.set()
+        deadline = time.monotonic() + timeout
+        for p in self.processes:
+            p.join(max(0., deadline - time.monotonic()))
+            if p.is_alive():
+                p.terminate()
+        self.processes.clear()
+
+
+if __name__ == '__main__':
+    pool = WorkerPool()
+    pool.start()
+    try:
+        for process in pool.processes:
+            process.join()
+    except KeyboardInterrupt:
+        pool.stop()
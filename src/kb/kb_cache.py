@@ -0,0 +1,113 @@
+"""
+查询缓存，包含查询向量的 LRU 缓存和查询结果的 TTL 缓存。
+知识库写入时增加知识库的版本号，查询结果按版本号缓存，写入后旧的结果自然失效。
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from kb.kb_config import CacheConfig
+from kb.kb_sqlite import connect
+from metrics import Counter
+
+CACHE_REQUESTS = Counter("kb_cache_requests_total", "查询缓存的请求次数", labelnames=("cache", "result"))
+
+_MISSING = object()
+
+
+class LRUCache:
+    """线程安全的 LRU 缓存，可以设置过期时间"""
+
+    def __init__(self, name: str, max_size: int, ttl: float = None):
+        """
+        Args:
+            name: 缓存名称，用于统计
+            max_size: 缓存数量上限
+            ttl: 过期时间（秒），为空时不过期
+        """
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and (self.ttl is None or item[0] > now):
+                self._data.move_to_end(key)
+                self.hits += 1
+                CACHE_REQUESTS.labels(cache=self.name, result="hit").inc()
+                return item[1]
+            if item is not _MISSING:
+                del self._data[key]
+            self.misses += 1
+        CACHE_REQUESTS.labels(cache=self.name, result="miss").inc()
+        return default
+
+    def put(self, key: Hashable, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else 0
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict[str, Any]:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.}
+
+
+class KBGeneration:
+    """知识库版本号，保存在本地数据库中，工作进程写入知识库后 API 进程也能感知"""
+
+    def __init__(self, path: str = CacheConfig.GENERATION_PATH):
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS generations ("
+                           "kb_id TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+
+    def current(self, kb_id: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT generation FROM generations WHERE kb_id = ?", (kb_id,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, kb_id: str):
+        """知识库内容发生变化"""
+        with self._lock:
+            self._conn.execute("INSERT INTO generations (kb_id, generation) VALUES (?, 1) "
+                               "ON CONFLICT (kb_id) DO UPDATE SET generation = generation + 1", (kb_id,))
+
+    async def acurrent(self, kb_id: str) -> int:
+        """在线程池中读取版本号，避免数据库读取阻塞事件循环"""
+        return await asyncio.to_thread(self.current, kb_id)
+
+    async def abump(self, kb_id: str):
+        await asyncio.to_thread(self.bump, kb_id)
+
+
+query_embeddings = LRUCache("query_embedding", max_size=CacheConfig.QUERY_EMBEDDING_SIZE)
+"""查询向量缓存，键为(模型id, 查询字符串)"""
+
+query_results = LRUCache("query_result", max_size=CacheConfig.RESULT_SIZE, ttl=CacheConfig.RESULT_TTL)
+"""查询结果缓存，键中包含知识库版本号"""
+
+__generation: Optional[KBGeneration] = None
+
+
+def get_generation() -> KBGeneration:
+    """获取知识库版本号，首次使用时初始化"""
+    global __generation
+    if __generation is None:
+        __generation = KBGeneration()
+    return __generation
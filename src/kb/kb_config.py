@@ -9,21 +9,110 @@ class UploadConfig(metaclass=BaseConfig):
     UPLOAD_SAVING_PATH: str = "upload"
     """上传文件保存路径"""
 
+    INDEX_PATH: str = "./data/files.db"
+    """上传文件索引数据库路径"""
+
     MAX_FILE_SIZE: int = 100
     """文件最大限制（MB）"""
 
+    CHUNK_SIZE: int = 1024 * 1024
+    """上传文件分块写入磁盘的块大小（字节）"""
+
+    MIME_SNIFF_SIZE: int = 64 * 1024
+    """检测 MIME 类型时读取的文件头部大小（字节）"""
+
     ALLOWED_MIME_TYPES = {
         "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ["docx"]
     }
     """允许的 MIME 类型"""
 
 
+class IngestConfig(metaclass=BaseConfig):
+    """知识入库配置"""
+
+    BATCH_SIZE: int = 32
+    """每批向量化并写入的知识块数量上限"""
+
+    BATCH_MAX_CHARS: int = 32000
+    """每批知识块的字符总数上限，避免单次 Embedding 请求过大"""
+
+
+class JobConfig(metaclass=BaseConfig):
+    """入库任务队列配置"""
+
+    DB_PATH: str = "./data/jobs.db"
+    """任务队列数据库路径，API 进程和工作进程需要指向同一个文件"""
+
+    WORKER_NUM: int = 2
+    """工作进程数量，也就是同时执行入库任务的最大数量"""
+
+    EMBEDDED_WORKERS: bool = True
+    """是否随 API 进程启动工作进程。使用多个 uvicorn worker 部署时建议关闭，
+    并通过 `python -m kb.job.job_worker` 单独启动工作进程"""
+
+    MAX_ATTEMPTS: int = 3
+    """任务最大执行次数，超过后标记为失败"""
+
+    RETRY_DELAY: float = 5
+    """失败重试的基础等待时间（秒），按执行次数指数增长"""
+
+    STALE_SECONDS: float = 300
+    """执行中任务的心跳超时时间（秒），超时视为工作进程已退出，任务会被重新领取"""
+
+    POLL_INTERVAL: float = 1.
+    """队列为空时工作进程的轮询间隔（秒）"""
+
+
+class CacheConfig(metaclass=BaseConfig):
+    """查询缓存配置"""
+
+    QUERY_EMBEDDING_SIZE: int = 10000
+    """查询向量缓存数量上限"""
+
+    RESULT_SIZE: int = 10000
+    """查询结果缓存数量上限"""
+
+    RESULT_TTL: float = 60
+    """查询结果缓存过期时间（秒），为0时不缓存查询结果"""
+
+    GENERATION_PATH: str = "./data/generations.db"
+    """知识库版本号数据库路径，API 进程和工作进程需要指向同一个文件"""
+
+
 class QdrantConfig(metaclass=BaseConfig):
     """Qdrant配置"""
 
     LOCATION: str = "http://192.168.100.111:6333"
     """Qdrant 连接地址"""
 
+    COLLECTION_CHECK_TTL: float = 60
+    """知识库集合检查结果的缓存时间（秒），期间不再重复检查集合是否存在及其向量大小和状态"""
+
+    PROFILE_PATH: str = "./data/profiles.db"
+    """知识库存储配置数据库路径，API 进程和工作进程需要指向同一个文件"""
+
+    EXPORT_BATCH_SIZE: int = 256
+    """导出知识库时每次滚动查询的数量"""
+
+    IMPORT_BATCH_SIZE: int = 512
+    """导入快照时每批写入的数量"""
+
+    IMPORT_WORKERS: int = 4
+    """导入快照时并行写入的线程数量"""
+
+    SNAPSHOT_PATH: str = "./data/snapshots"
+    """通过接口导出、导入快照时使用的目录"""
+
+
+class NumpyKBConfig(metaclass=BaseConfig):
+    """numpy 后端知识库配置"""
+
+    DATA_PATH: str = "./data/numpy_kb"
+    """知识库数据目录，API 进程和工作进程需要指向同一个目录"""
+
+    COMPACT_RATIO: float = 0.5
+    """已删除或被覆盖的向量占比超过该值时重写向量文件"""
+
 
 class EmbeddingConfig(metaclass=BaseConfig):
     """外部 Embedding 配置"""
@@ -37,6 +126,40 @@ class EmbeddingConfig(metaclass=BaseConfig):
     EMBEDDINGS: Union[str, list[str]] = "bge-m3"
     """Embedding模型，可以是单个或者列表，目前是单个，如果是列表需要更改知识库注册的代码"""
 
+    DIMENSIONS: Union[str, dict[str, int]] = {}
+    """各模型的向量维度，例如 `{"bge-m3": 1024}`，环境变量格式为 `bge-m3:1024`。配置后无需启动时请求模型探测维度"""
+
+    WARM_UP: bool = True
+    """启动后是否在后台预热（探测向量维度）所有模型"""
+
+    CACHE_MODELS: Union[str, list[str]] = []
+    """启用持久化缓存的Embedding模型，可以是单个、列表或者逗号分隔的字符串"""
+
+    CACHE_PATH: str = "./data/embedding_cache.db"
+    """Embedding 缓存数据库路径，多个进程可以共用"""
+
+    CACHE_MAX_ITEMS: int = 1000000
+    """Embedding 缓存的向量数量上限，超出后淘汰最久未使用的向量"""
+
+    CACHE_DTYPE: str = "float32"
+    """Embedding 缓存的向量精度，float16 占用空间减半，精度损失对余弦相似度影响很小"""
+
+    COALESCE_MAX_WAIT_MS: float = 5
+    """并发的异步 Embedding 请求合并时最多等待的时间（毫秒），为0时不合并"""
+
+    COALESCE_MAX_BATCH: int = 64
+    """合并的文本数量达到该值时立即发送"""
+
+
+class RetrieverConfig(metaclass=BaseConfig):
+    """父子文档检索配置"""
+
+    OVERFETCH: float = 3
+    """初始的多取倍数，检索的知识块数量为需要的段落数量乘以该倍数，之后按实际的重复程度调整"""
+
+    MAX_OVERFETCH: float = 20
+    """多取倍数的上限"""
+
 
 class DocxImageParserConfig(metaclass=BaseConfig):
     """Docx 文档解析配置"""
@@ -48,8 +171,41 @@ class DocxImageParserConfig(metaclass=BaseConfig):
     """用markdown图片代替文字时图片的前缀。
     主要是为了传递给前端的markdown能够正确请求到图片。
     这里需要注意相对|绝对路径的问题，正式环境建议使用一个图床服务或者OSS链接地址。
+    图片也可以通过 `/kb/file/img/{图片文件名}` 接口获取，此时前缀设置为该接口的地址即可。
     """
 
+    WRITE_WORKERS: int = 4
+    """写入图片的线程数量"""
+
+
+class ParseConfig(metaclass=BaseConfig):
+    """文档解析进程池配置"""
+
+    POOL_SIZE: int = 2
+    """解析进程数量，为0时在当前进程中解析"""
+
+    STREAMING: bool = False
+    """是否使用流式加载器，只保留当前标题栈，内存占用与文档大小基本无关，但知识块总数要在解析结束后才能确定"""
+
+    STREAM_BATCH_SIZE: int = 64
+    """解析进程每次传回的知识块数量"""
+
+    STREAM_QUEUE_SIZE: int = 8
+    """解析进程最多缓存的批次数量，消费过慢时解析进程会等待"""
+
+
+class MetricsConfig(metaclass=BaseConfig):
+    """运行指标配置"""
+
+    METRICS_PATH: str = "./data/metrics.db"
+    """各进程指标快照的数据库路径，API 进程和工作进程需要指向同一个文件，`/metrics` 输出所有进程合并后的指标"""
+
+    METRICS_FLUSH_INTERVAL: float = 10.
+    """进程写入指标快照的间隔（秒）"""
+
+    METRICS_RETENTION: float = 86400.
+    """超过该时间（秒）没有更新的进程快照视为进程已退出，不再合并并删除"""
+
 
 class DocxSchema:
     """向量数据库中payload的结构"""
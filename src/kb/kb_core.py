@@ -2,25 +2,78 @@
 知识库注册中心，负责管理知识库的注册和知识库和向量模型的对应关系
 """
 import abc
+import asyncio
 import functools
+import threading
+import time
 import uuid
+import weakref
 from abc import abstractmethod
 from logging import getLogger
 from typing import Tuple, Union, Any
 
-from qdrant_client import QdrantClient, models
+from qdrant_client import AsyncQdrantClient, QdrantClient, models
+from qdrant_client.http.exceptions import UnexpectedResponse
 from qdrant_client.http.models import CollectionStatus, UpdateStatus
 
 from kb.embedding.embedding_excep import EmbeddingNotFoundException
 from kb.embedding.kb_embedding import get_embedding_model, EmbeddingModel
+from kb.kb_cache import get_generation, query_embeddings
 from kb.kb_config import QdrantConfig, DocxSchema
-from kb.kb_excep import InvalidKBIdException
+from kb.kb_excep import BackendChangeException, InvalidKBIdException
+from kb.kb_profile import Backend, StorageProfile, get_profile_store
+from metrics import Histogram
 
-client = QdrantClient(location=QdrantConfig.LOCATION)
+STAGE_SECONDS = Histogram("kb_stage_seconds", "知识库查询和入库各阶段的耗时", labelnames=("stage", "kb_id", "model"))
 
 _logger = getLogger(__name__)
 
 
+class _LockedClient:
+    """内存模式的 Qdrant 不是线程安全的，入库线程与查询线程并发读写会破坏内部的向量数组，所有调用串行执行"""
+
+    def __init__(self, sync_client: QdrantClient):
+        self._client = sync_client
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+
+        return call
+
+
+client = QdrantClient(location=QdrantConfig.LOCATION)
+if QdrantConfig.LOCATION == ":memory:":
+    client = _LockedClient(client)
+
+
+class _ThreadedAsyncClient:
+    """内存模式的 Qdrant 无法在同步和异步客户端之间共享数据，此时异步调用转到线程中执行同步客户端"""
+
+    def __init__(self, sync_client: Union[QdrantClient, _LockedClient]):
+        self._client = sync_client
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+
+        return call
+
+
+async_client = _ThreadedAsyncClient(client) if QdrantConfig.LOCATION == ":memory:" else AsyncQdrantClient(
+    location=QdrantConfig.LOCATION)
+"""异步客户端，供异步路由使用，连接池在所有知识库之间共享"""
+
+
 class Document:
 
     def __init__(self, page_content, metadata=None):
@@ -51,6 +104,16 @@ class KnowledgeBase(abc.ABC):
         """
         pass
 
+    @abstractmethod
+    def add_kb_splits(self, docs: list[Document], ids: list[str] = None):
+        """
+        批量添加知识片段，一次向量化请求并一次写入
+        Args:
+            docs: 知识块列表
+            ids: 知识块id，与docs一一对应，为空时随机生成。相同id重复写入会覆盖，便于任务重试
+        """
+        pass
+
     @abstractmethod
     def query_doc(self, *args, query: str, filter_condition=None, limit=3, **kwargs) -> list[Document]:
         """
@@ -79,6 +142,27 @@ class KnowledgeBase(abc.ABC):
         """
         pass
 
+    # 以下为异步版本，默认在线程中执行同步方法，支持异步I/O的实现应当重写
+
+    async def aremove_kb_split(self, ids: Union[str, list[str]]) -> bool:
+        """异步版本的 `remove_kb_split`"""
+        return await asyncio.to_thread(self.remove_kb_split, ids)
+
+    async def aadd_kb_splits(self, docs: list[Document], ids: list[str] = None):
+        """异步版本的 `add_kb_splits`"""
+        return await asyncio.to_thread(self.add_kb_splits, docs, ids)
+
+    async def aquery_doc(self, *args, query: str, filter_condition=None, limit=3, **kwargs) -> list[Document]:
+        """异步版本的 `query_doc`"""
+        return await asyncio.to_thread(functools.partial(self.query_doc, *args, query=query,
+                                                         filter_condition=filter_condition, limit=limit,
+                                                         **kwargs))
+
+    async def afilter_by(self, *args, filter_condition=None, limit=3, offset=0, **kwargs):
+        """异步版本的 `filter_by`"""
+        return await asyncio.to_thread(functools.partial(self.filter_by, *args, filter_condition=filter_condition,
+                                                         limit=limit, offset=offset, **kwargs))
+
 
 def parse_kb_id(kb_id: str) -> Tuple[str, str]:
     """
@@ -100,67 +184,362 @@ def parse_kb_id(kb_id: str) -> Tuple[str, str]:
     return kb_name, embedding_model_id
 
 
+def is_collection_missing(e: Exception) -> bool:
+    """异常是否由知识库集合不存在引起（远程服务返回404，本地模式抛出ValueError）"""
+    if isinstance(e, UnexpectedResponse):
+        return e.status_code == 404
+    return isinstance(e, ValueError) and str(e).startswith("Collection ") and str(e).endswith(" not found")
+
+
 def ensure_kb_exist(method):
+    """
+    调用前保证知识库存在，检查结果会被缓存。如果集合在缓存期内被删除，清除缓存后重新检查并重试一次
+    """
+
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
         self._ensure_kb_with_size()
+        try:
+            return method(self, *args, **kwargs)
+        except Exception as e:
+            if not is_collection_missing(e):
+                raise
+            self.invalidate_collection_check()
+        self._ensure_kb_with_size()
         return method(self, *args, **kwargs)
 
     return wrapper
 
 
-class VectorKB(KnowledgeBase):
-    """向量化的知识库"""
+def aensure_kb_exist(method):
+    """异步版本的 `ensure_kb_exist`"""
 
-    def remove_kb_split(self, ids: Union[str, list[str]]) -> bool:
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        await self._aensure_kb_with_size()
+        try:
+            return await method(self, *args, **kwargs)
+        except Exception as e:
+            if not is_collection_missing(e):
+                raise
+            self.invalidate_collection_check()
+        await self._aensure_kb_with_size()
+        return await method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class BaseVectorKB(KnowledgeBase):
+    """
+    向量知识库的公共部分：知识库id、Embedding 模型及查询向量缓存、过滤条件和存储配置。
+    知识块的存储和检索由子类实现，见 `VectorKB` 和 `kb.numpy_kb.NumpyKB`
+    """
+
+    backend: Backend
+    """存储后端"""
+
+    def __init__(self, kb_id: Union[str, Tuple[str, str]]):
+        """
+        创建知识库代理
+        Args:
+            kb_id: kb_id或者(kb_name, embedding_model_id)
+        """
+        if isinstance(kb_id, str):
+            self.kb_id: str = kb_id
+            """知识库id"""
+            try:
+                kb_name, embedding_model_id = parse_kb_id(kb_id)
+            except ValueError as e:
+                raise InvalidKBIdException(kb_id=kb_id)
+        else:
+            kb_name, embedding_model_id = kb_id
+            self.kb_id: str = f"{kb_name};{embedding_model_id}"
+        self.kb_name: str = kb_name
+        """知识库名称"""
+        self.embedding_model_id = embedding_model_id
+        """Embedding模型的模型id，用id获取embedding模型对知识库Payload作向量化"""
+        self._profile = StorageProfile()
+        """存储配置"""
+        try:
+            self._get_embedding()
+        except EmbeddingNotFoundException as e:
+            _logger.warning(f"The EmbeddingModel-[{e.model_uid}] model used by KB-[{kb_name}] was not register. "
+                            f"Please ensure is has been register before using KB-[{kb_name}]")
+
+    def _get_embedding(self) -> EmbeddingModel:
+        return get_embedding_model(model_uid=self.embedding_model_id)
+
+    def _timer(self, stage: str):
+        """记录本知识库某个阶段耗时的上下文管理器，见 `STAGE_SECONDS`"""
+        return STAGE_SECONDS.labels(stage=stage, kb_id=self.kb_id, model=self.embedding_model_id).time()
+
+    def _embed_query(self, query: str) -> list[float]:
+        """查询向量化，同一模型的相同查询直接使用缓存的向量"""
+        key = (self.embedding_model_id, query)
+        vector = query_embeddings.get(key)
+        if vector is None:
+            with self._timer("embed_query"):
+                vector = self._get_embedding()(query).embedding
+            query_embeddings.put(key, vector)
+        return vector
+
+    async def _aembed_query(self, query: str) -> list[float]:
+        """异步版本的 `_embed_query`"""
+        key = (self.embedding_model_id, query)
+        vector = query_embeddings.get(key)
+        if vector is None:
+            with self._timer("embed_query"):
+                vector = (await self._get_embedding().aembed(query)).embedding
+            query_embeddings.put(key, vector)
+        return vector
+
+    def _embed_queries(self, queries: list[str]) -> list[list[float]]:
+        """批量的 `_embed_query`，缓存中没有的查询去重后一次向量化"""
+        vectors = {query: query_embeddings.get((self.embedding_model_id, query)) for query in queries}
+        missing = [query for query, vector in vectors.items() if vector is None]
+        if missing:
+            with self._timer("embed_query"):
+                ems = self._get_embedding().embed_batch(missing)
+            for query, em in zip(missing, ems):
+                vectors[query] = em.embedding
+                query_embeddings.put((self.embedding_model_id, query), em.embedding)
+        return [vectors[query] for query in queries]
+
+    async def _aembed_queries(self, queries: list[str]) -> list[list[float]]:
+        """异步版本的 `_embed_queries`"""
+        vectors = {query: query_embeddings.get((self.embedding_model_id, query)) for query in queries}
+        missing = [query for query, vector in vectors.items() if vector is None]
+        if missing:
+            with self._timer("embed_query"):
+                ems = await self._get_embedding().aembed_batch(missing)
+            for query, em in zip(missing, ems):
+                vectors[query] = em.embedding
+                query_embeddings.put((self.embedding_model_id, query), em.embedding)
+        return [vectors[query] for query in queries]
+
+    @property
+    def size(self):
+        return self._get_embedding().size
+
+    async def asize(self) -> int:
+        """异步版本的 `size`，模型维度未知时异步探测"""
+        return await self._get_embedding().asize()
+
+    @property
+    def profile(self) -> StorageProfile:
+        """知识库的存储配置"""
+        return self._profile
+
+    @staticmethod
+    def _file_selector(ids: Union[str, list[str]]) -> models.FilterSelector:
         ids = [ids] if isinstance(ids, str) else ids
+        return models.FilterSelector(
+            filter=models.Filter(
+                must=[BaseVectorKB.build_filter(f'{DocxSchema.METADATA}.{DocxSchema.FILE_ID}', ids)])
+        )
+
+    @staticmethod
+    def _build_query_filter(filter_condition: dict[str, Any] = None) -> Union[models.Filter, None]:
+        """将过滤条件转换为 Qdrant 的过滤器，所有条件需要同时成立"""
+        if not filter_condition:
+            return None
+        if isinstance(filter_condition, models.Filter):
+            return filter_condition
+        return models.Filter(
+            must=[BaseVectorKB.build_filter(f'{DocxSchema.METADATA}.{key}', match_value)
+                  for key, match_value in filter_condition.items()])
+
+    @staticmethod
+    def build_filter(key, match_value):
+        if isinstance(match_value, list):
+            match = models.MatchAny(any=match_value)
+        else:
+            match = models.MatchValue(value=match_value)
+        return models.FieldCondition(key=key, match=match)
+
+    @staticmethod
+    def _to_documents(points) -> list[Document]:
+        return [Document(point.payload[DocxSchema.PAGE_CONTENT], point.payload[DocxSchema.METADATA]) for
+                point in points]
+
+    def add_kb_split(self, doc: Document):
+        return self.add_kb_splits([doc])
+
+    @abstractmethod
+    def is_empty(self) -> bool:
+        """知识库中是否没有知识块，只有空的知识库可以切换存储后端"""
+
+    @abstractmethod
+    def apply_profile(self, profile: StorageProfile):
+        """
+        保存知识库的存储配置并应用到已有的数据
+        Args:
+            profile: 存储配置，存储后端与当前知识库相同
+        """
+
+    async def aapply_profile(self, profile: StorageProfile):
+        """异步版本的 `apply_profile`"""
+        await asyncio.to_thread(self.apply_profile, profile)
+
+
+class VectorKB(BaseVectorKB):
+    """向量化的知识库，存储在 Qdrant 中"""
+
+    backend = Backend.QDRANT
+
+    def remove_kb_split(self, ids: Union[str, list[str]]) -> bool:
         res = client.delete(
             collection_name=self.kb_id,
-            points_selector=models.FilterSelector(
-                filter=models.Filter(
-                    must=[VectorKB.build_filter(f'{DocxSchema.METADATA}.{DocxSchema.FILE_ID}', file_id)
-                          for file_id in ids])
-            )
+            points_selector=self._file_selector(ids)
         )
+        get_generation().bump(self.kb_id)
+        return res.status == UpdateStatus.COMPLETED
+
+    async def aremove_kb_split(self, ids: Union[str, list[str]]) -> bool:
+        res = await async_client.delete(
+            collection_name=self.kb_id,
+            points_selector=self._file_selector(ids)
+        )
+        await get_generation().abump(self.kb_id)
         return res.status == UpdateStatus.COMPLETED
 
+    @ensure_kb_exist
+    def file_points(self, file_id: str, batch_size: int = 256) -> list[models.Record]:
+        """
+        获取文档的全部知识块，不包含向量
+        Args:
+            file_id: 文档id
+            batch_size: 每次滚动查询的数量
+        """
+        points, offset = [], None
+        scroll_filter = self._file_selector(file_id).filter
+        while True:
+            res, offset = client.scroll(collection_name=self.kb_id, scroll_filter=scroll_filter, limit=batch_size,
+                                        offset=offset, with_payload=True, with_vectors=False)
+            points.extend(res)
+            if offset is None:
+                return points
+
+    @ensure_kb_exist
+    def remove_points(self, ids: list[Union[str, int]]) -> bool:
+        """按知识块id删除知识块"""
+        if not ids:
+            return True
+        res = client.delete(collection_name=self.kb_id, points_selector=models.PointIdsList(points=ids))
+        get_generation().bump(self.kb_id)
+        return res.status == UpdateStatus.COMPLETED
+
+    @ensure_kb_exist
+    def update_metadata(self, metadata: dict[Union[str, int], dict[str, Any]]):
+        """
+        替换知识块的元数据，不重新向量化
+        Args:
+            metadata: 知识块id到新元数据的映射
+        """
+        if not metadata:
+            return
+        client.batch_update_points(
+            collection_name=self.kb_id,
+            update_operations=[
+                models.SetPayloadOperation(set_payload=models.SetPayload(payload={DocxSchema.METADATA: value},
+                                                                         points=[point_id]))
+                for point_id, value in metadata.items()])
+        get_generation().bump(self.kb_id)
+
     @ensure_kb_exist
     def filter_by(self, *arg, filter_condition: Union[dict[str, Any], models.Filter] = None, limit=3, offset=0,
                   **kwargs):
-        query_filter = None
-        if filter_condition:
-            if len(filter_condition) == 0:
-                return []
-            else:
-                query_filter = models.Filter(
-                    must=[VectorKB.build_filter(f'{DocxSchema.METADATA}.{key}', match_value)
-                          for key, match_value in filter_condition.items()])
-
         res = client.scroll(
             collection_name=self.kb_id,
             limit=limit,
-            scroll_filter=query_filter,
+            scroll_filter=self._build_query_filter(filter_condition),
             offset=offset,
             **kwargs
         )
-        return [Document(point.payload[DocxSchema.PAGE_CONTENT], point.payload[DocxSchema.METADATA]) for
-                point in res[0]]
+        return self._to_documents(res[0])
 
-    @ensure_kb_exist
-    def add_kb_split(self, doc: Document):
-        em = self.__get_embedding()(doc.page_content)
-        res = client.upsert(
+    @aensure_kb_exist
+    async def afilter_by(self, *arg, filter_condition: Union[dict[str, Any], models.Filter] = None, limit=3,
+                         offset=0, **kwargs):
+        res = await async_client.scroll(
             collection_name=self.kb_id,
-            points=[
-                models.PointStruct(
-                    id=str(uuid.uuid4()),
-                    payload=vars(doc),
-                    vector=em.embedding
-                )
-            ]
+            limit=limit,
+            scroll_filter=self._build_query_filter(filter_condition),
+            offset=offset,
+            **kwargs
         )
+        return self._to_documents(res[0])
+
+    @ensure_kb_exist
+    def scroll_page(self, filter_condition: Union[dict[str, Any], models.Filter] = None, limit=10, offset=None,
+                    with_vectors=False) -> tuple[list[models.Record], Any]:
+        """
+        按游标分页遍历知识库
+        Args:
+            filter_condition: 过滤条件，见 `query_doc`
+            limit: 每页数量
+            offset: 上一页返回的下一页起点（Qdrant 的点id），为空时从头开始
+            with_vectors: 是否包含向量
+
+        Returns:
+            本页的记录，以及下一页的起点，没有更多记录时为空
+        """
+        with self._timer("scroll"):
+            return client.scroll(collection_name=self.kb_id,
+                                 scroll_filter=self._build_query_filter(filter_condition),
+                                 limit=limit, offset=offset, with_payload=True, with_vectors=with_vectors)
+
+    @aensure_kb_exist
+    async def ascroll_page(self, filter_condition: Union[dict[str, Any], models.Filter] = None, limit=10,
+                           offset=None, with_vectors=False) -> tuple[list[models.Record], Any]:
+        """异步版本的 `scroll_page`"""
+        with self._timer("scroll"):
+            return await async_client.scroll(collection_name=self.kb_id,
+                                             scroll_filter=self._build_query_filter(filter_condition),
+                                             limit=limit, offset=offset, with_payload=True,
+                                             with_vectors=with_vectors)
+
+    @ensure_kb_exist
+    def add_kb_splits(self, docs: list[Document], ids: list[str] = None):
+        if not docs:
+            # 没有知识块时不写入，也不使知识库的查询缓存失效
+            return None
+        with self._timer("embed_chunks"):
+            ems = self._get_embedding().embed_batch([doc.page_content for doc in docs])
+        with self._timer("upsert"):
+            res = client.upsert(
+                collection_name=self.kb_id,
+                points=self._to_points(docs, ids, ems)
+            )
+        get_generation().bump(self.kb_id)
+        return res
+
+    @aensure_kb_exist
+    async def aadd_kb_splits(self, docs: list[Document], ids: list[str] = None):
+        if not docs:
+            return None
+        with self._timer("embed_chunks"):
+            ems = await self._get_embedding().aembed_batch([doc.page_content for doc in docs])
+        with self._timer("upsert"):
+            res = await async_client.upsert(
+                collection_name=self.kb_id,
+                points=self._to_points(docs, ids, ems)
+            )
+        await get_generation().abump(self.kb_id)
         return res
 
+    @staticmethod
+    def _to_points(docs: list[Document], ids: Union[list[str], None], ems) -> list[models.PointStruct]:
+        ids = ids or [str(uuid.uuid4()) for _ in docs]
+        return [
+            models.PointStruct(
+                id=point_id,
+                payload=vars(doc),
+                vector=em.embedding
+            )
+            for point_id, doc, em in zip(ids, docs, ems)
+        ]
+
     @ensure_kb_exist
     def query_doc(self, *args, query: str, filter_condition: dict[str, Any] = None, limit=3, **kwargs) -> list[
         Document]:
@@ -174,90 +553,201 @@ class VectorKB(KnowledgeBase):
         Returns:
 
         """
-        query_filter = None
-        if filter_condition:
-            if len(filter_condition) == 0:
-                return []
-            else:
-                query_filter = models.Filter(
-                    must=[VectorKB.build_filter(f'{DocxSchema.METADATA}.{key}', match_value)
-                          for key, match_value in filter_condition.items()])
-
-        em = self.__get_embedding()(query)
-        res = client.search(
-            collection_name=self.kb_id,
-            query_vector=em.embedding,
-            limit=limit,
-            query_filter=query_filter,
-            **kwargs
-        )
-        return [Document(point.payload[DocxSchema.PAGE_CONTENT], point.payload[DocxSchema.METADATA]) for
-                point in res]
+        kwargs.setdefault("search_params", self._profile.search_params())
+        vector = self._embed_query(query)
+        with self._timer("search"):
+            res = client.search(
+                collection_name=self.kb_id,
+                query_vector=vector,
+                limit=limit,
+                query_filter=self._build_query_filter(filter_condition),
+                **kwargs
+            )
+        return self._to_documents(res)
+
+    @aensure_kb_exist
+    async def aquery_doc(self, *args, query: str, filter_condition: dict[str, Any] = None, limit=3,
+                         **kwargs) -> list[Document]:
+        kwargs.setdefault("search_params", self._profile.search_params())
+        vector = await self._aembed_query(query)
+        with self._timer("search"):
+            res = await async_client.search(
+                collection_name=self.kb_id,
+                query_vector=vector,
+                limit=limit,
+                query_filter=self._build_query_filter(filter_condition),
+                **kwargs
+            )
+        return self._to_documents(res)
 
-    @staticmethod
-    def build_filter(key, match_value):
-        if isinstance(match_value, list):
-            match = models.MatchAny(any=match_value)
-        else:
-            match = models.MatchValue(value=match_value)
-        return models.FieldCondition(key=key, match=match)
+    @ensure_kb_exist
+    def query_groups(self, query: str, group_by: str, filter_condition: dict[str, Any] = None, limit=3,
+                     group_size=1, **kwargs) -> list[tuple[str, list[Document]]]:
+        """
+        分组查询，由 Qdrant 按元数据字段分组，返回最相关的若干组，不需要多取后去重
+        Args:
+            query: 查询字符串
+            group_by: 分组的元数据字段，例如 `DocxSchema.FILE_ID`、`DocxSchema.PARENT_ID`
+            filter_condition: 过滤条件，见 `query_doc`
+            limit: 分组数量
+            group_size: 每组最多返回的知识块数量
+
+        Returns:
+            按相关度排序的 (分组的值, 组内知识块) 列表
+        """
+        kwargs.setdefault("search_params", self._profile.search_params())
+        vector = self._embed_query(query)
+        with self._timer("search_groups"):
+            res = client.search_groups(
+                collection_name=self.kb_id,
+                query_vector=vector,
+                group_by=f'{DocxSchema.METADATA}.{group_by}',
+                limit=limit,
+                group_size=group_size,
+                query_filter=self._build_query_filter(filter_condition),
+                **kwargs
+            )
+        return [(group.id, self._to_documents(group.hits)) for group in res.groups]
+
+    @aensure_kb_exist
+    async def aquery_groups(self, query: str, group_by: str, filter_condition: dict[str, Any] = None, limit=3,
+                            group_size=1, **kwargs) -> list[tuple[str, list[Document]]]:
+        """异步版本的 `query_groups`"""
+        kwargs.setdefault("search_params", self._profile.search_params())
+        vector = await self._aembed_query(query)
+        with self._timer("search_groups"):
+            res = await async_client.search_groups(
+                collection_name=self.kb_id,
+                query_vector=vector,
+                group_by=f'{DocxSchema.METADATA}.{group_by}',
+                limit=limit,
+                group_size=group_size,
+                query_filter=self._build_query_filter(filter_condition),
+                **kwargs
+            )
+        return [(group.id, self._to_documents(group.hits)) for group in res.groups]
+
+    @ensure_kb_exist
+    def query_batch(self, queries: list[str], filter_conditions: list[dict[str, Any]] = None,
+                    limits: list[int] = None) -> list[list[Document]]:
+        """
+        批量查询，所有查询一次向量化，并通过 Qdrant 的批量检索一次完成
+        Args:
+            queries: 查询字符串列表
+            filter_conditions: 每个查询的过滤条件，见 `query_doc`
+            limits: 每个查询的数量限制，默认为3
+
+        Returns:
+            与查询顺序一致的查询结果
+        """
+        vectors = self._embed_queries(queries)
+        with self._timer("search_batch"):
+            res = client.search_batch(collection_name=self.kb_id,
+                                      requests=self._search_requests(vectors, filter_conditions, limits))
+        return [self._to_documents(points) for points in res]
+
+    @aensure_kb_exist
+    async def aquery_batch(self, queries: list[str], filter_conditions: list[dict[str, Any]] = None,
+                           limits: list[int] = None) -> list[list[Document]]:
+        """异步版本的 `query_batch`"""
+        vectors = await self._aembed_queries(queries)
+        with self._timer("search_batch"):
+            res = await async_client.search_batch(collection_name=self.kb_id,
+                                                  requests=self._search_requests(vectors, filter_conditions,
+                                                                                 limits))
+        return [self._to_documents(points) for points in res]
+
+    def _search_requests(self, vectors: list[list[float]], filter_conditions: list[dict[str, Any]] = None,
+                         limits: list[int] = None) -> list[models.SearchRequest]:
+        filter_conditions = filter_conditions or [None] * len(vectors)
+        limits = limits or [3] * len(vectors)
+        return [models.SearchRequest(vector=vector, filter=self._build_query_filter(condition), limit=limit,
+                                     with_payload=True, params=self._profile.search_params())
+                for vector, condition, limit in zip(vectors, filter_conditions, limits)]
 
     def __init__(self, kb_id: Union[str, Tuple[str, str]]):
+        super().__init__(kb_id)
+        self._checked_until = 0.
+        """集合检查结果的有效期（monotonic 时间）"""
+        self._check_lock = threading.Lock()
+        self._acheck_locks: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock] = \
+            weakref.WeakKeyDictionary()
+
+    def is_empty(self) -> bool:
+        return (not client.collection_exists(collection_name=self.kb_id)
+                or client.count(collection_name=self.kb_id, exact=True).count == 0)
+
+    def apply_profile(self, profile: StorageProfile):
         """
-        创建知识库代理
+        保存知识库的存储配置，集合不存在时按配置创建，已存在时更新集合参数
         Args:
-            kb_id: kb_id或者(kb_name, embedding_model_id)
+            profile: 存储配置
         """
-        if isinstance(kb_id, str):
-            self.kb_id: str = kb_id
-            """知识库id"""
-            try:
-                kb_name, embedding_model_id = parse_kb_id(kb_id)
-            except ValueError as e:
-                raise InvalidKBIdException(kb_id=kb_id)
-        else:
-            kb_name, embedding_model_id = kb_id
-            self.kb_id: str = f"{kb_name};{embedding_model_id}"
-        self.kb_name: str = kb_name
-        """知识库名称"""
-        self.embedding_model_id = embedding_model_id
-        """Embedding模型的模型id，用id获取embedding模型对知识库Payload作向量化"""
-        try:
-            self.__get_embedding()
-        except EmbeddingNotFoundException as e:
-            _logger.warning(f"The EmbeddingModel-[{e.model_uid}] model used by KB-[{kb_name}] was not register. "
-                            f"Please ensure is has been register before using KB-[{kb_name}]")
+        get_profile_store().put(self.kb_id, profile)
+        self._profile = profile
+        if client.collection_exists(collection_name=self.kb_id):
+            client.update_collection(collection_name=self.kb_id, **profile.update_params())
+        self.invalidate_collection_check()
+        self._ensure_kb_with_size()
 
-    def __get_embedding(self) -> EmbeddingModel:
-        return get_embedding_model(model_uid=self.embedding_model_id)
+    async def aapply_profile(self, profile: StorageProfile):
+        """异步版本的 `apply_profile`"""
+        await get_profile_store().aput(self.kb_id, profile)
+        self._profile = profile
+        if await async_client.collection_exists(collection_name=self.kb_id):
+            await async_client.update_collection(collection_name=self.kb_id, **profile.update_params())
+        self.invalidate_collection_check()
+        await self._aensure_kb_with_size()
 
-    @property
-    def size(self):
-        return self.__get_embedding().size
+    def invalidate_collection_check(self):
+        """清除集合检查的缓存，下次操作前重新检查"""
+        self._checked_until = 0.
+
+    def _collection_checked(self) -> bool:
+        return time.monotonic() < self._checked_until
+
+    def _mark_collection_checked(self):
+        self._checked_until = time.monotonic() + QdrantConfig.COLLECTION_CHECK_TTL
 
     def _ensure_kb_with_size(self):
         """保证包含知识库的存在已经其大小相同，如果没有则创建，有则判断大小，如果大小不包含（多向量中没有），则抛出异常"""
-        kb_id = self.kb_id
-        size = self.size
-        if not client.collection_exists(collection_name=kb_id):
-            client.create_collection(
-                collection_name=kb_id,
-                vectors_config=models.VectorParams(size=size, distance=models.Distance.COSINE),
-            )
-            # 父亲节点id，加速父子查询
-            client.create_payload_index(
-                collection_name=kb_id,
-                field_name=f"{DocxSchema.METADATA}.{DocxSchema.PARENT_ID}",
-                field_schema="keyword"
-            )
-            # 文件id，加速文件过滤
-            client.create_payload_index(
-                collection_name=kb_id,
-                field_name=f"{DocxSchema.METADATA}.{DocxSchema.FILE_ID}",
-                field_schema="keyword"
-            )
-        # 无论创不创建都需要检查状态，因为我们保证创建之后没问题。
-        collection_info = client.get_collection(kb_id)
+        if self._collection_checked():
+            return
+        # 加锁避免并发的首次写入重复创建集合
+        with self._check_lock:
+            if self._collection_checked():
+                return
+            with self._timer("ensure_collection"):
+                kb_id = self.kb_id
+                size = self.size
+                # 存储配置可能被其它进程修改，随集合检查一起刷新
+                self._profile = get_profile_store().get(kb_id) or StorageProfile()
+                if not client.collection_exists(collection_name=kb_id):
+                    create_collection(kb_id, size, self._profile)
+                # 无论创不创建都需要检查状态，因为我们保证创建之后没问题。
+                self._check_collection(client.get_collection(kb_id), size)
+                self._mark_collection_checked()
+
+    async def _aensure_kb_with_size(self):
+        """异步版本的 `_ensure_kb_with_size`"""
+        if self._collection_checked():
+            return
+        # asyncio.Lock 只能在创建它的事件循环中使用
+        lock = self._acheck_locks.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+        async with lock:
+            if self._collection_checked():
+                return
+            with self._timer("ensure_collection"):
+                kb_id = self.kb_id
+                size = await self.asize()
+                self._profile = await get_profile_store().aget(kb_id) or StorageProfile()
+                if not await async_client.collection_exists(collection_name=kb_id):
+                    await acreate_collection(kb_id, size, self._profile)
+                self._check_collection(await async_client.get_collection(kb_id), size)
+                self._mark_collection_checked()
+
+    @staticmethod
+    def _check_collection(collection_info, size):
         # 大小检查
         assert collection_info.config.params.vectors.size == size
         # 状态检查
@@ -266,6 +756,39 @@ class VectorKB(KnowledgeBase):
     def scroll(self, *args, **kwargs):
         return client.scroll(collection_name=self.kb_id, *args, **kwargs)
 
+    async def ascroll(self, *args, **kwargs):
+        """异步版本的 `scroll`"""
+        return await async_client.scroll(collection_name=self.kb_id, *args, **kwargs)
+
+
+PAYLOAD_INDEXES = (
+    # 父亲节点id，加速父子查询
+    f"{DocxSchema.METADATA}.{DocxSchema.PARENT_ID}",
+    # 文件id，加速文件过滤
+    f"{DocxSchema.METADATA}.{DocxSchema.FILE_ID}",
+)
+"""知识库集合的 keyword 类型 payload 索引"""
+
+
+def create_collection(kb_id: str, size: int, profile: StorageProfile):
+    """
+    按存储配置创建知识库集合及其 payload 索引，知识库写入和快照导入共用
+    Args:
+        kb_id: 知识库id，即集合名称
+        size: 向量维度
+        profile: 存储配置
+    """
+    client.create_collection(collection_name=kb_id, **profile.create_params(size))
+    for field_name in PAYLOAD_INDEXES:
+        client.create_payload_index(collection_name=kb_id, field_name=field_name, field_schema="keyword")
+
+
+async def acreate_collection(kb_id: str, size: int, profile: StorageProfile):
+    """异步版本的 `create_collection`"""
+    await async_client.create_collection(collection_name=kb_id, **profile.create_params(size))
+    for field_name in PAYLOAD_INDEXES:
+        await async_client.create_payload_index(collection_name=kb_id, field_name=field_name, field_schema="keyword")
+
 
 __kb_register: dict[str, KnowledgeBase] = {}
 
@@ -274,5 +797,46 @@ def get_kb_by_id(kb_id):
     if kb_id in __kb_register:
         return __kb_register[kb_id]
     else:
-        __kb_register[kb_id] = VectorKB(kb_id)
+        __kb_register[kb_id] = _create_kb(kb_id)
+    return __kb_register[kb_id]
+
+
+async def aget_kb_by_id(kb_id):
+    """异步版本的 `get_kb_by_id`，首次创建知识库需要读取存储配置，在线程池中执行"""
+    if kb_id in __kb_register:
+        return __kb_register[kb_id]
+    return await asyncio.to_thread(get_kb_by_id, kb_id)
+
+
+def _create_kb(kb_id: str, backend: Backend = None) -> BaseVectorKB:
+    """按存储配置中的后端创建知识库，没有配置时使用 Qdrant"""
+    if backend is None:
+        profile = get_profile_store().get(kb_id)
+        backend = profile.backend if profile else Backend.QDRANT
+    if backend == Backend.NUMPY:
+        from kb.numpy_kb import NumpyKB
+        return NumpyKB(kb_id)
+    return VectorKB(kb_id)
+
+
+def switch_kb_backend(kb_id: str, backend: Backend) -> BaseVectorKB:
+    """
+    切换知识库的存储后端，替换已注册的知识库及其父子检索实例，不迁移数据
+    Args:
+        kb_id: 知识库id
+        backend: 新的存储后端
+
+    Returns:
+        新后端的知识库
+
+    Raises:
+        BackendChangeException: 知识库中已有知识块
+    """
+    kb = get_kb_by_id(kb_id)
+    if kb.backend == backend:
+        return kb
+    if not kb.is_empty():
+        raise BackendChangeException(kb_id=kb_id, backend=kb.backend.value)
+    __kb_register.pop(f"{kb_id};doc", None)
+    __kb_register[kb_id] = _create_kb(kb_id, backend)
     return __kb_register[kb_id]
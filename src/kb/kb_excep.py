@@ -5,3 +5,34 @@ class InvalidKBIdException(AbsException):
     def __init__(self, kb_id):
         self.kb_id = kb_id
         super().__init__(msg=f"Invalid Knowledge Id [{kb_id}]")
+
+
+class DocParseException(AbsException):
+    def __init__(self, file_path, reason):
+        self.file_path = file_path
+        super().__init__(msg=f"Failed to parse document [{file_path}]: {reason}")
+
+
+class InvalidCursorException(AbsException):
+    def __init__(self, cursor):
+        self.cursor = cursor
+        super().__init__(msg=f"Invalid cursor [{cursor}]")
+
+
+class InvalidConditionException(AbsException):
+    def __init__(self, condition, reason):
+        self.condition = condition
+        super().__init__(msg=f"Invalid filter condition [{condition}]: {reason}")
+
+
+class SnapshotException(AbsException):
+    def __init__(self, path, reason):
+        self.path = path
+        super().__init__(msg=f"Snapshot [{path}] failed: {reason}")
+
+
+class BackendChangeException(AbsException):
+    def __init__(self, kb_id, backend):
+        self.kb_id = kb_id
+        super().__init__(msg=f"Knowledge base [{kb_id}] already has data in backend [{backend}], "
+                             f"delete its documents before switching")
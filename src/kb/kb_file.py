@@ -1,56 +1,301 @@
+import hashlib
+import itertools
 import logging
 import os
+import time
+import uuid
+from typing import Callable, Iterable, Iterator, NamedTuple
 
-from fastapi import APIRouter, BackgroundTasks, Path, UploadFile, File
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Header, Path, Query, Request, UploadFile, File
+from fastapi.responses import FileResponse, Response
 
 from common import success, BaseResponse
-from kb.file.file_service import check_file_size, check_file_type, save_file, get_upload_file_path
-from kb.kb_config import DocxSchema
-from kb.kb_core import get_kb_by_id
-from kb.kb_loader import DocxLoader
+from kb.file.file_service import save_upload_file, get_upload_file_path, get_file_ext, file_range_response
+from kb.file.file_store import get_file_store
+from kb.file.image_store import get_image_store
+from kb.job.job_queue import get_job_queue, JobKind, JobState
+from kb.doc_retriever import get_doc_kb_by_id
+from kb.kb_config import DocxSchema, IngestConfig
+from kb.kb_core import get_kb_by_id, Document
+from kb.kb_metrics import MetricsRoute
+from kb.kb_parse_pool import parse_docx
+from metrics import Counter
+
+INGEST_CHUNKS = Counter("kb_ingest_chunks_total", "写入知识库的知识块数量", labelnames=("kb_id", "model"))
 
 router = APIRouter(prefix="/file",
-                   tags=["Knowledge File"])
+                   tags=["Knowledge File"],
+                   route_class=MetricsRoute)
 logger = logging.getLogger(__name__)
 
 
 @router.put("/{kb_id}",
             summary="知识库上传",
-            description="上传文档并且嵌入指定知识库，返回文档id", )
-async def upload_file(background_tasks: BackgroundTasks,
-                      kb_id: str = Path(..., examples=["Hello;bge-m3"], description="知识库id"),
+            description="上传文档并且提交入库任务，返回文档id和任务id，入库进度可以通过任务接口查询", )
+async def upload_file(kb_id: str = Path(..., examples=["Hello;bge-m3"], description="知识库id"),
                       file: UploadFile = File(..., description="知识库文件，当前仅支持docx")) -> BaseResponse:
     """
     文件上传接口
     """
-    byte = await file.read()
-    check_file_type(byte, file.filename)
-    check_file_size(byte)
-    file_id, save_path = save_file(byte, file.filename)
-    background_tasks.add_task(write_to_kb_with_docx,
-                              filepath=save_path,
-                              kb_id=kb_id,
-                              filename=file.filename,
-                              file_id=file_id)
-    return success(msg=f'{file.filename} upload success', data={'file_id': file_id})
-
-
-def write_to_kb_with_docx(filepath: str, kb_id: str, filename: str, file_id: str):
-    """docx文档写入知识库"""
-    loader = DocxLoader(file_path=filepath)
-    loader.root.value = filename
-    kb = get_kb_by_id(kb_id)
-    for doc in loader.lazy_load():
-        doc.metadata[DocxSchema.FILE_ID] = file_id
-        kb.add_kb_split(doc)
+    saved = await save_upload_file(file)
+    record, created = get_file_store().add(kb_id=kb_id, saved=saved, filename=file.filename)
+    queue = get_job_queue()
+    if created:
+        job = queue.submit(kb_id=kb_id, file_id=record.file_id, filename=file.filename, filepath=record.path)
+        get_file_store().set_job(record.file_id, job.job_id)
+    else:
+        # 相同内容已经上传过，不再重复解析入库，只有之前入库失败时才重新执行
+        job = queue.get(record.job_id) if record.job_id else None
+        if job and job.state == JobState.FAILED:
+            job = queue.retry(job.job_id)
+            get_file_store().set_status(record.file_id, job.state)
+    return success(msg=f'{file.filename} upload success',
+                   data={'file_id': record.file_id, 'job_id': job and job.job_id, 'duplicate': not created})
+
+
+@router.put("/{kb_id}/{file_id}",
+            summary="知识库文档替换",
+            description="上传文档的新版本并提交替换任务，只向量化新增或变化的知识块，删除不再存在的知识块，文档id不变")
+async def replace_file(kb_id: str = Path(..., examples=["Hello;bge-m3"], description="知识库id"),
+                       file_id: str = Path(..., description="被替换的文档id，上传文档时返回"),
+                       file: UploadFile = File(..., description="文档的新版本，当前仅支持docx")) -> BaseResponse:
+    saved = await save_upload_file(file)
+    store = get_file_store()
+    record, changed = store.replace(kb_id=kb_id, file_id=file_id, saved=saved, filename=file.filename)
+    queue = get_job_queue()
+    if changed:
+        # 沿用首次上传的文件名，知识块中的标题路径不变，未修改的知识块才能匹配
+        job = queue.submit(kb_id=kb_id, file_id=file_id, filename=record.filename, filepath=record.path,
+                           kind=JobKind.REPLACE)
+        store.set_job(file_id, job.job_id)
+    else:
+        job = queue.get(record.job_id) if record.job_id else None
+        if job and job.state == JobState.FAILED:
+            job = queue.retry(job.job_id)
+            store.set_status(file_id, job.state)
+    return success(msg=f'{file.filename} replace success',
+                   data={'file_id': file_id, 'job_id': job and job.job_id, 'changed': changed})
+
+
+@router.get('/jobs/{job_id}',
+            summary="入库任务查询",
+            description="查询上传文档的入库任务状态、知识块进度和耗时")
+async def get_job(job_id: str = Path(..., description="任务id，上传文档时返回")) -> BaseResponse:
+    return success(data=get_job_queue().get(job_id))
+
+
+@router.post('/jobs/{job_id}/retry',
+             summary="入库任务重试",
+             description="重新执行失败的入库任务，从最后写入的知识块继续")
+async def retry_job(job_id: str = Path(..., description="任务id，上传文档时返回")) -> BaseResponse:
+    job = get_job_queue().retry(job_id)
+    get_file_store().set_status(job.file_id, job.state)
+    return success(data=job)
+
+
+@router.get('/list/{kb_id}',
+            summary="知识库文档列表",
+            description="按上传时间列出知识库中的文档，包括文件大小、内容哈希、知识块数量和入库状态")
+async def list_files(kb_id: str = Path(..., examples=["Hello;bge-m3"], description="知识库id"),
+                     offset: int = Query(0, ge=0, description="跳过的文档数量"),
+                     limit: int = Query(100, ge=1, le=1000, description="返回的文档数量")) -> BaseResponse:
+    files, total = get_file_store().list(kb_id, offset=offset, limit=limit)
+    return success(data={'total': total, 'files': files})
+
+
+def write_to_kb_with_docx(filepath: str, kb_id: str, filename: str, file_id: str, skip: int = 0,
+                          on_progress: Callable[[int, int, float, float], None] = None):
+    """
+    docx文档写入知识库
+    Args:
+        filepath: 文件路径
+        kb_id: 知识库id
+        filename: 文档名称
+        file_id: 文档id
+        skip: 跳过已经写入的知识块数量，任务重试时从断点继续
+        on_progress: 解析完成及每批写入后的回调，参数为(已写入数量, 知识块总数, 解析耗时, 写入耗时)
+    """
+    # 指定文档id使解析结果稳定，重试时知识块及其id与上次一致
+    parsed = parse_docx(file_path=filepath, filename=filename, doc_id=file_id)
+    try:
+        write_seconds = 0.
+        # 流式解析时知识块总数未知，任务进度中的总数在解析结束后补上
+        done = skip if parsed.total is None else min(skip, parsed.total)
+        if on_progress:
+            on_progress(done, parsed.total, parsed.parse_seconds, write_seconds)
+        kb = get_kb_by_id(kb_id)
+        ingested = INGEST_CHUNKS.labels(kb_id=kb.kb_id, model=kb.embedding_model_id)
+        namespace = uuid.UUID(parsed.root_id)
+        for batch in split_batches(itertools.islice(parsed, done, None)):
+            start = time.perf_counter()
+            for doc in batch:
+                doc.metadata[DocxSchema.FILE_ID] = file_id
+            kb.add_kb_splits(batch,
+                             ids=[str(uuid.uuid5(namespace, str(n))) for n in range(done, done + len(batch))])
+            ingested.inc(len(batch))
+            done += len(batch)
+            write_seconds += time.perf_counter() - start
+            if on_progress:
+                on_progress(done, parsed.total, parsed.parse_seconds, write_seconds)
+        if on_progress and parsed.streaming:
+            on_progress(parsed.total, parsed.total, parsed.parse_seconds, write_seconds)
+    finally:
+        parsed.close()
+    get_doc_kb_by_id(kb_id).build_sections(file_id)
     logger.info(f"Finish the doc-[{filename}] embed to kb-[{kb_id}]")
     return kb_id
 
 
+class ReplaceStats(NamedTuple):
+    """文档替换的结果"""
+    added: int
+    """新增或内容变化、重新向量化的知识块数量"""
+    updated: int
+    """内容不变、只更新了元数据（顺序、父节点）的知识块数量"""
+    unchanged: int
+    """完全不变的知识块数量"""
+    removed: int
+    """删除的知识块数量"""
+
+
+def chunk_hash(page_content: str) -> str:
+    """
+    知识块内容哈希，只有哈希变化的知识块才需要重新向量化。
+    知识块内容以完整的标题路径开头，因此标题路径变化也会改变哈希
+    """
+    return hashlib.sha256(page_content.encode('utf-8')).hexdigest()
+
+
+def replace_kb_docx(filepath: str, kb_id: str, filename: str, file_id: str,
+                    on_progress: Callable[[int, int, float, float], None] = None) -> ReplaceStats:
+    """
+    用文档的新版本替换知识库中的知识块。重新解析文档后按内容哈希与已有的知识块比对：
+    新增或变化的知识块向量化写入，顺序或父节点变化的只更新元数据，不再存在的删除。
+    先写入后删除，替换过程中查询不会出现文档内容缺失；重复执行的结果相同，可以直接重试
+    Args:
+        filepath: 新版本的文件路径
+        kb_id: 知识库id
+        filename: 文档名称，应当与首次入库时一致
+        file_id: 文档id
+        on_progress: 见 `write_to_kb_with_docx`，已处理数量包含未变化的知识块
+
+    Returns:
+        替换结果
+    """
+    kb = get_kb_by_id(kb_id)
+    existing: dict[str, list] = {}
+    used_ids = set()
+    for point in kb.file_points(file_id):
+        existing.setdefault(chunk_hash(point.payload[DocxSchema.PAGE_CONTENT]), []).append(point)
+        used_ids.add(str(point.id))
+
+    parsed = parse_docx(file_path=filepath, filename=filename, doc_id=file_id)
+    namespace = uuid.UUID(parsed.root_id)
+    metadata_updates = {}
+    new_ids = []
+    counts = {"done": 0, "unchanged": 0}
+    write_seconds = 0.
+
+    def new_point_id(digest: str) -> str:
+        # 相同内容的知识块可能出现多次，按出现次序区分并跳过已被占用的id
+        for n in itertools.count():
+            point_id = str(uuid.uuid5(namespace, f"{digest}:{n}"))
+            if point_id not in used_ids:
+                used_ids.add(point_id)
+                return point_id
+
+    def changed_docs() -> Iterator[Document]:
+        for doc in parsed:
+            doc.metadata[DocxSchema.FILE_ID] = file_id
+            digest = chunk_hash(doc.page_content)
+            matches = existing.get(digest)
+            counts["done"] += 1
+            if matches:
+                point = matches.pop(0)
+                if point.payload.get(DocxSchema.METADATA) != doc.metadata:
+                    metadata_updates[point.id] = doc.metadata
+                else:
+                    counts["unchanged"] += 1
+                continue
+            new_ids.append(new_point_id(digest))
+            yield doc
+
+    try:
+        if on_progress:
+            on_progress(0, parsed.total, parsed.parse_seconds, write_seconds)
+        written = 0
+        ingested = INGEST_CHUNKS.labels(kb_id=kb.kb_id, model=kb.embedding_model_id)
+        for batch in split_batches(changed_docs()):
+            start = time.perf_counter()
+            kb.add_kb_splits(batch, ids=new_ids[written:written + len(batch)])
+            ingested.inc(len(batch))
+            written += len(batch)
+            write_seconds += time.perf_counter() - start
+            if on_progress:
+                on_progress(counts["done"], parsed.total, parsed.parse_seconds, write_seconds)
+    finally:
+        parsed.close()
+    start = time.perf_counter()
+    kb.update_metadata(metadata_updates)
+    removed = [point.id for points in existing.values() for point in points]
+    kb.remove_points(removed)
+    get_doc_kb_by_id(kb_id).build_sections(file_id)
+    write_seconds += time.perf_counter() - start
+    if on_progress:
+        on_progress(counts["done"], parsed.total, parsed.parse_seconds, write_seconds)
+    stats = ReplaceStats(added=written, updated=len(metadata_updates), unchanged=counts["unchanged"],
+                         removed=len(removed))
+    logger.info(f"Finish the doc-[{filename}] replace in kb-[{kb_id}]: {stats}")
+    return stats
+
+
+def split_batches(docs: Iterable[Document],
+                  batch_size: int = None,
+                  max_chars: int = None) -> Iterator[list[Document]]:
+    """
+    将知识块按数量和字符总数切分为批次
+    Args:
+        docs: 知识块
+        batch_size: 每批数量上限，默认为 `IngestConfig.BATCH_SIZE`
+        max_chars: 每批字符总数上限，默认为 `IngestConfig.BATCH_MAX_CHARS`，单个超长的知识块独立成批
+
+    Returns:
+        知识块批次
+    """
+    batch_size = batch_size or IngestConfig.BATCH_SIZE
+    max_chars = max_chars or IngestConfig.BATCH_MAX_CHARS
+    batch, chars = [], 0
+    for doc in docs:
+        length = len(doc.page_content)
+        if batch and (len(batch) >= batch_size or chars + length > max_chars):
+            yield batch
+            batch, chars = [], 0
+        batch.append(doc)
+        chars += length
+    if batch:
+        yield batch
+
+
+@router.get('/img/{name}',
+            summary="文档图片",
+            description="获取文档中的图片，图片按内容命名，内容不会变化，客户端可以长期缓存")
+async def get_image(name: str = Path(..., description="图片文件名，即知识块中图片链接的文件名"),
+                    if_none_match: str = Header(None, include_in_schema=False)):
+    file_path = get_image_store().path_of(name)
+    etag = f'"{name.split(".")[0]}"'
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": etag}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path=file_path, headers=headers)
+
+
 @router.get('/{file_id}',
             summary="文档下载",
             description="通过上传时返回的文件id，将上传的文档下载")
-async def get_doc(file_id: str = Path(..., description="文件路径")):
-    file_path = get_upload_file_path(file_id=file_id)
-    return FileResponse(path=file_path, filename=os.path.basename(file_path))
+async def get_doc(request: Request, file_id: str = Path(..., description="文件路径")):
+    record = get_file_store().find(file_id)
+    if record is not None and os.path.exists(record.path):
+        file_path, etag = record.path, record.sha256
+    else:
+        file_path, etag = get_upload_file_path(file_id=file_id), None
+    return file_range_response(request, path=file_path, filename=f"{file_id}.{get_file_ext(file_path)}", etag=etag)
@@ -1,10 +1,17 @@
 import os
+import posixpath
 import random
 import uuid
-from typing import Iterable, Iterator
+import zipfile
+from collections import deque
+from typing import Iterable, Iterator, NamedTuple, Optional, Union
 
+from kb.file.image_store import get_image_store
 from kb.kb_config import DocxImageParserConfig, DocxSchema
 from kb.kb_core import Document
+from metrics import Histogram
+
+LOADER_SECONDS = Histogram("kb_loader_seconds", "docx 加载器各阶段的耗时", labelnames=("stage",))
 
 
 class Node:
@@ -42,6 +49,11 @@ class Node:
 
 
 def convert_table_to_markdown(table):
+    with LOADER_SECONDS.labels(stage="table").time():
+        return _table_to_markdown(table)
+
+
+def _table_to_markdown(table):
     markdown = "|"
     for cell in table.rows[0].cells:
         markdown += f"{cell.text}|"
@@ -60,14 +72,26 @@ def convert_table_to_markdown(table):
 class DocxLoader(Iterable[Node]):
 
     def __init__(self, file_path, img_path=DocxImageParserConfig.IMG_SAVE_PATH,
-                 img_prefix=DocxImageParserConfig.IMG_PREFIX):
+                 img_prefix=DocxImageParserConfig.IMG_PREFIX, doc_id: str = None):
+        """
+        Args:
+            file_path: docx文件路径
+            img_path: 图片保存路径
+            img_prefix: 图片链接前缀
+            doc_id: 文档id，指定时节点id和知识块顺序由文档内容确定，重复解析同一文档得到相同的结果
+        """
         self.img_prefix = img_prefix
         self.file_path = file_path
         self.filename = file_path.split('/')[-1]
         self.img_path = img_path
+        self.doc_id = doc_id
         from docx import Document
-        self.document = Document(self.file_path)
-        self.root = self.parse_to_tree()
+        with LOADER_SECONDS.labels(stage="open").time():
+            self.document = Document(self.file_path)
+        with LOADER_SECONDS.labels(stage="parse_to_tree").time():
+            self.root = self.parse_to_tree()
+        if doc_id is not None:
+            self._assign_stable_ids(doc_id)
 
     def parse_to_tree(self):
         root = Node(float('inf'), self.filename)
@@ -105,23 +129,37 @@ class DocxLoader(Iterable[Node]):
                 point = point.add_child(Node(0, text))
         return root
 
+    def _assign_stable_ids(self, doc_id: str):
+        """按照标题路径生成节点id，同名兄弟节点按出现次序区分"""
+
+        def assign(node: Node):
+            namespace = uuid.UUID(node.uuid)
+            seen: dict[str, int] = {}
+            for child in node.children:
+                n = seen[child.value] = seen.get(child.value, 0) + 1
+                child.uuid = str(uuid.uuid5(namespace, f"{n}:{child.value}"))
+                assign(child)
+
+        self.root.uuid = str(uuid.uuid5(uuid.NAMESPACE_URL, doc_id))
+        assign(self.root)
+
+    def _image_blob(self, r_id: str) -> tuple[bytes, str]:
+        """图片关系id对应的图片内容及其扩展名"""
+        part = self.document.part.related_parts[r_id]
+        return part.image.blob, part.partname.ext
+
     def _images_handle(self, name, images):
+        return self._save_images(name, [image.xpath('.//a:blip/@r:embed')[0] for image in images])
+
+    def _save_images(self, name, r_ids: list[str]):
+        """提交图片写入并返回替代图片的 markdown 文本，图片按内容命名，在后台写入"""
+        store = get_image_store(self.img_path)
         res = ''
-        for i, image in enumerate(images):
-            image_data = image.xpath('.//a:blip/@r:embed')[0]
-            related_part = self.document.part.related_parts[image_data]
-            img = related_part.image
-            n = f'{name}_{i}.png'
-            import uuid
-            filename = f'{uuid.uuid4()}.png'
-            from os import path
-            if not path.exists(self.img_path):
-                os.makedirs(self.img_path)
-            file_path = path.join(self.img_path, filename)
-            fw = open(file_path, "wb")
-            fw.write(img.blob)
-            fw.close()
-            res += f'\n![{n}]({self.img_prefix}{filename})\n'
+        with LOADER_SECONDS.labels(stage="images").time():
+            for i, image_data in enumerate(r_ids):
+                filename = store.save(*self._image_blob(image_data))
+                n = f'{name}_{i}.png'
+                res += f'\n![{n}]({self.img_prefix}{filename})\n'
         return res
 
     def __iter__(self):
@@ -136,10 +174,235 @@ class DocxLoader(Iterable[Node]):
         yield from traverse(self.root)
 
     def lazy_load(self) -> Iterator[Document]:
-        base_id = random.randint(-2 ** 31, 2 ** 31 - 1) * 100
+        base_id = 0 if self.doc_id is not None else random.randint(-2 ** 31, 2 ** 31 - 1) * 100
         for node in self:
             base_id += 1
             yield Document(page_content=node.get_value_from_tree(),
                            metadata={DocxSchema.PARENT_ID: node.parent.uuid,
                                      DocxSchema.ORDER_BY: base_id,
                                      DocxSchema.DOC_FILENAME: self.root.value})
+        # 知识块全部返回时引用的图片也已经写入
+        with LOADER_SECONDS.labels(stage="image_flush").time():
+            get_image_store(self.img_path).flush()
+
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_RT = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/"
+
+
+class _Paragraph(NamedTuple):
+    """流式解析时正文中的段落，只保留建树需要的信息"""
+    text: str
+    empty: bool
+    """没有文字（没有 run 或者只有空白），这样的段落只可能作为图片"""
+    tag: int
+    """段落样式的字号，作为标题级别"""
+    images: list[str]
+    """空段落中图片的关系id"""
+
+
+class _Table(NamedTuple):
+    """流式解析时正文中的表格"""
+    text: str
+
+
+class _Frame:
+    """标题栈中的节点，只记录生成知识块需要的信息"""
+    __slots__ = ("node", "path", "depth", "has_children", "seen")
+
+    def __init__(self, node: Node, path: str, depth: int):
+        self.node = node
+        self.path = path
+        """包含该节点在内的标题路径，即子节点知识块的前缀"""
+        self.depth = depth
+        """标题路径中的标题数量"""
+        self.has_children = False
+        self.seen: dict[str, int] = {}
+        """同名子节点的出现次数，用于生成稳定的节点id"""
+
+
+class DocxStreamLoader(DocxLoader):
+    """
+    流式的 docx 加载器，逐个读取 `word/document.xml` 中的正文元素并立即释放，内存中只保留当前的标题栈，
+    不构建完整的 python-docx 文档和知识树，适合很大的文档。知识块与 `DocxLoader.lazy_load` 的结果一致。
+
+    文档在迭代时才解析，图片也在迭代时保存，知识块总数只有迭代结束后才能确定
+    """
+
+    def __init__(self, file_path, img_path=DocxImageParserConfig.IMG_SAVE_PATH,
+                 img_prefix=DocxImageParserConfig.IMG_PREFIX, doc_id: str = None):
+        self.img_prefix = img_prefix
+        self.file_path = file_path
+        self.filename = file_path.split('/')[-1]
+        self.img_path = img_path
+        self.doc_id = doc_id
+        self.root = Node(float('inf'), self.filename)
+        if doc_id is not None:
+            self.root.uuid = str(uuid.uuid5(uuid.NAMESPACE_URL, doc_id))
+        self._zip: Optional[zipfile.ZipFile] = None
+        with LOADER_SECONDS.labels(stage="open").time():
+            self._document_path, self._rels, styles_path = self._read_package()
+            self._styles = self._read_styles(styles_path)
+        self._style_sizes: dict[Optional[str], int] = {}
+
+    def _read_package(self) -> tuple[str, dict[str, str], Optional[str]]:
+        """
+        读取文档包的关系
+
+        Returns:
+            正文部件路径，正文引用的部件（关系id到部件路径），样式部件路径
+        """
+        from lxml import etree
+        with zipfile.ZipFile(self.file_path) as z:
+            package_rels = etree.fromstring(z.read("_rels/.rels"))
+            document_path = next(rel.get("Target") for rel in package_rels.iter(f"{_REL}Relationship")
+                                 if rel.get("Type") == _RT + "officeDocument").lstrip("/")
+            base, name = posixpath.split(document_path)
+            rels_path = posixpath.join(base, "_rels", f"{name}.rels")
+            rels, styles_path = {}, None
+            if rels_path in z.namelist():
+                for rel in etree.fromstring(z.read(rels_path)).iter(f"{_REL}Relationship"):
+                    if rel.get("TargetMode") == "External":
+                        continue
+                    target = posixpath.normpath(posixpath.join(base, rel.get("Target")))
+                    rels[rel.get("Id")] = target
+                    if rel.get("Type") == _RT + "styles":
+                        styles_path = target
+        return document_path, rels, styles_path
+
+    def _read_styles(self, styles_path: Optional[str]):
+        """读取样式部件，文档没有样式时与 python-docx 一样使用默认样式"""
+        import docx
+        from docx.oxml.parser import parse_xml
+        from docx.styles.styles import Styles
+        if styles_path is not None:
+            with zipfile.ZipFile(self.file_path) as z:
+                blob = z.read(styles_path)
+        else:
+            with open(os.path.join(os.path.dirname(docx.__file__), "templates", "default-styles.xml"), "rb") as f:
+                blob = f.read()
+        return Styles(parse_xml(blob))
+
+    def _style_size(self, style_id: Optional[str]) -> int:
+        """段落样式的字号，与 `paragraph.style.font.size or 0` 一致"""
+        if style_id not in self._style_sizes:
+            from docx.enum.style import WD_STYLE_TYPE
+            style = self._styles.get_by_id(style_id, WD_STYLE_TYPE.PARAGRAPH)
+            self._style_sizes[style_id] = style.font.size or 0
+        return self._style_sizes[style_id]
+
+    def _image_blob(self, r_id: str) -> tuple[bytes, str]:
+        path = self._rels[r_id]
+        return self._zip.read(path), posixpath.splitext(path)[1].lstrip(".")
+
+    def _elements(self) -> Iterator[Union[_Paragraph, _Table]]:
+        """按顺序读取正文中的段落和表格，读取后立即释放对应的 XML 元素"""
+        from lxml import etree
+        from docx.oxml.parser import element_class_lookup
+        from docx.table import Table
+        from docx.text.paragraph import Paragraph
+        with self._zip.open(self._document_path) as f:
+            events = etree.iterparse(f, events=("end",), tag=(f"{_W}p", f"{_W}tbl"), remove_blank_text=True)
+            # 与 python-docx 使用相同的元素类，段落和表格的文本提取规则保持一致
+            events.set_element_class_lookup(element_class_lookup)
+            for _, element in events:
+                parent = element.getparent()
+                # 只处理正文的直接子元素，表格中的段落随表格一起处理
+                if parent is None or parent.tag != f"{_W}body":
+                    continue
+                if element.tag == f"{_W}p":
+                    para = Paragraph(element, None)
+                    text = para.text
+                    empty = len(para.runs) == 0 or text.strip() == ''
+                    images = [image.xpath('.//a:blip/@r:embed')[0] for image in element.xpath('.//pic:pic')] \
+                        if empty else []
+                    yield _Paragraph(text=text, empty=empty, tag=self._style_size(element.style), images=images)
+                else:
+                    yield _Table(text=convert_table_to_markdown(Table(element, None)))
+                element.clear()
+                while element.getprevious() is not None:
+                    del parent[0]
+
+    def _leaves(self) -> Iterator[tuple[Node, _Frame]]:
+        """
+        按 `DocxLoader.parse_to_tree` 的规则建树，但只保留当前的标题栈。
+        节点出栈时子节点已经确定，没有子节点的就是叶子节点，出栈顺序即树的深度优先遍历顺序
+
+        Returns:
+            叶子节点及其父节点
+        """
+        root = self.root
+        stack = [_Frame(root, f"# {root.value}" if root.value else "", 1 if root.value else 0)]
+        stable = self.doc_id is not None
+
+        def push(tag, value):
+            parent = stack[-1]
+            parent.has_children = True
+            node = Node(tag, value)
+            node.parent = parent.node
+            if stable:
+                n = parent.seen[value] = parent.seen.get(value, 0) + 1
+                node.uuid = str(uuid.uuid5(uuid.UUID(parent.node.uuid), f"{n}:{value}"))
+            if value:
+                heading = f"{'#' * (parent.depth + 1)} {value}"
+                stack.append(_Frame(node, f"{parent.path}\n{heading}" if parent.path else heading, parent.depth + 1))
+            else:
+                stack.append(_Frame(node, parent.path, parent.depth))
+
+        def pop() -> Iterator[tuple[Node, _Frame]]:
+            frame = stack.pop()
+            if not frame.has_children:
+                yield frame.node, stack[-1]
+
+        with zipfile.ZipFile(self.file_path) as self._zip:
+            elements = self._elements()
+            lookahead: deque[Union[_Paragraph, _Table]] = deque()
+
+            def next_paragraph() -> Optional[_Paragraph]:
+                """向后查找下一个段落（跳过表格），查找过的元素留待之后处理"""
+                for item in lookahead:
+                    if isinstance(item, _Paragraph):
+                        return item
+                for item in elements:
+                    lookahead.append(item)
+                    if isinstance(item, _Paragraph):
+                        return item
+                return None
+
+            while True:
+                item = lookahead.popleft() if lookahead else next(elements, None)
+                if item is None:
+                    break
+                if isinstance(item, _Table):
+                    if len(stack) > 1:
+                        yield from pop()
+                    push(0, item.text)
+                elif not item.empty:
+                    while stack[-1].node.tag <= item.tag:
+                        yield from pop()
+                    push(item.tag, item.text)
+                elif item.images:
+                    caption = next_paragraph()
+                    if caption is not None and caption.text.startswith('图'):
+                        while stack[-1].node.tag <= caption.tag:
+                            yield from pop()
+                        push(caption.tag, self._save_images(caption.text, item.images))
+            while len(stack) > 1:
+                yield from pop()
+        self._zip = None
+
+    def __iter__(self) -> Iterator[Node]:
+        for node, _ in self._leaves():
+            yield node
+
+    def lazy_load(self) -> Iterator[Document]:
+        base_id = 0 if self.doc_id is not None else random.randint(-2 ** 31, 2 ** 31 - 1) * 100
+        for node, parent in self._leaves():
+            base_id += 1
+            yield Document(page_content=f"{parent.path}\n{node.value}",
+                           metadata={DocxSchema.PARENT_ID: node.parent.uuid,
+                                     DocxSchema.ORDER_BY: base_id,
+                                     DocxSchema.DOC_FILENAME: self.root.value})
+        with LOADER_SECONDS.labels(stage="image_flush").time():
+            get_image_store(self.img_path).flush()
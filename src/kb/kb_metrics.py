@@ -0,0 +1,161 @@
+"""
+运行指标的跨进程汇总和接口耗时统计。
+API 进程、入库工作进程和解析进程各自在内存中记录指标，定期把快照写入本地数据库，
+`/metrics` 读取所有进程的快照合并后输出，进程内记录指标只是加锁累加，可以在生产环境常开。
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Optional
+
+from fastapi.routing import APIRoute
+from starlette.requests import Request
+from starlette.responses import Response
+
+import metrics
+from kb.kb_config import MetricsConfig
+from kb.kb_sqlite import connect
+from metrics import Counter, Histogram
+
+REQUEST_SECONDS = Histogram("kb_http_request_seconds", "接口的处理耗时，不含响应体的发送",
+                            labelnames=("route", "method", "status"))
+ENCODE_SECONDS = Histogram("kb_http_encode_seconds", "接口函数返回后校验和序列化响应的耗时", labelnames=("route",))
+REQUEST_ERRORS = Counter("kb_http_errors_total", "接口抛出异常的次数", labelnames=("route", "error"))
+
+
+class MetricsStore:
+    """各进程的指标快照，每个进程一行，按进程合并后输出"""
+
+    def __init__(self, path: str = MetricsConfig.METRICS_PATH):
+        self.process = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        """进程标识，进程id可能被复用，加上随机后缀区分"""
+        self._lock = threading.Lock()
+        self._flushed_at = 0.
+        self._conn = connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS metrics ("
+                           "process TEXT PRIMARY KEY, pid INTEGER NOT NULL, updated_at REAL NOT NULL, "
+                           "data TEXT NOT NULL)")
+
+    def flush(self, force: bool = True):
+        """
+        写入当前进程的指标快照，并删除长时间没有更新的进程快照
+        Args:
+            force: 为False时距离上次写入不足 `MetricsConfig.METRICS_FLUSH_INTERVAL` 则跳过
+        """
+        now = time.time()
+        if not force and now - self._flushed_at < MetricsConfig.METRICS_FLUSH_INTERVAL:
+            return
+        data = json.dumps(metrics.snapshot(), ensure_ascii=False)
+        with self._lock:
+            self._flushed_at = now
+            self._conn.execute("INSERT INTO metrics (process, pid, updated_at, data) VALUES (?, ?, ?, ?) "
+                               "ON CONFLICT (process) DO UPDATE SET updated_at = excluded.updated_at, "
+                               "data = excluded.data", (self.process, os.getpid(), now, data))
+            self._conn.execute("DELETE FROM metrics WHERE updated_at < ?", (now - MetricsConfig.METRICS_RETENTION,))
+
+    def collect(self) -> dict[str, dict[str, Any]]:
+        """当前进程的实时指标与其它进程最近一次写入的快照合并"""
+        since = time.time() - MetricsConfig.METRICS_RETENTION
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM metrics WHERE process != ? AND updated_at >= ?",
+                                      (self.process, since)).fetchall()
+        return metrics.merge(metrics.snapshot(), *(json.loads(row[0]) for row in rows))
+
+
+__store: Optional[MetricsStore] = None
+__store_lock = threading.Lock()
+
+
+def get_metrics_store() -> MetricsStore:
+    """获取当前进程的指标快照存储，首次使用时初始化"""
+    global __store
+    if __store is None:
+        with __store_lock:
+            if __store is None:
+                __store = MetricsStore()
+    return __store
+
+
+async def aflush_periodically():
+    """API 进程中定期写入指标快照，随应用关闭取消"""
+    store = get_metrics_store()
+    try:
+        while True:
+            await asyncio.sleep(MetricsConfig.METRICS_FLUSH_INTERVAL)
+            await asyncio.to_thread(store.flush)
+    finally:
+        store.flush()
+
+
+_returned_at: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("returned_at", default=None)
+"""当前请求的接口函数返回的时间，用于区分业务耗时和响应序列化耗时"""
+
+
+def _mark_return(endpoint: Callable) -> Callable:
+    """包装接口函数，在返回时记录时间"""
+    if getattr(endpoint, "_marks_return", False):
+        return endpoint
+
+    def mark():
+        holder = _returned_at.get()
+        if holder is not None:
+            holder.append(time.perf_counter())
+
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                mark()
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            # 同步接口在线程池中执行，上下文被复制，但列表本身是同一个对象
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                mark()
+    wrapper._marks_return = True
+    return wrapper
+
+
+class MetricsRoute(APIRoute):
+    """
+    记录接口耗时的路由，按路由模板而不是实际路径统计，标签数量有限。
+    路由器通过 `route_class` 指定，`include_router` 时保留路由类型
+    """
+
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs):
+        super().__init__(path, _mark_return(endpoint), **kwargs)
+
+    def get_route_handler(self) -> Callable[[Request], Any]:
+        handler = super().get_route_handler()
+        route = self.path_format
+
+        async def app(request: Request) -> Response:
+            holder = []
+            token = _returned_at.set(holder)
+            start = time.perf_counter()
+            try:
+                response = await handler(request)
+            except Exception as e:
+                REQUEST_SECONDS.labels(route=route, method=request.method, status="error").observe(
+                    time.perf_counter() - start)
+                REQUEST_ERRORS.labels(route=route, error=type(e).__name__).inc()
+                raise
+            finally:
+                _returned_at.reset(token)
+            end = time.perf_counter()
+            REQUEST_SECONDS.labels(route=route, method=request.method, status=response.status_code).observe(
+                end - start)
+            if holder:
+                ENCODE_SECONDS.labels(route=route).observe(end - holder[0])
+            return response
+
+        return app
@@ -0,0 +1,205 @@
+"""
+文档解析进程池。docx 解析是纯 Python 的 CPU 密集操作，放在独立进程中执行，
+解析结果以知识块批次的形式流式传回，调用方可以边解析边向量化。
+"""
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional
+
+from kb.kb_config import ParseConfig
+from kb.kb_core import Document
+from kb.kb_excep import DocParseException
+from metrics import Histogram
+
+PARSE_QUEUE_WAIT = Histogram("kb_parse_queue_wait_seconds", "解析任务在进程池中的排队时间")
+PARSE_SECONDS = Histogram("kb_parse_seconds", "文档解析为知识树的耗时")
+
+_START, _BATCH, _DONE, _ERROR = "start", "batch", "done", "error"
+
+_lock = threading.Lock()
+_executor: Optional[ProcessPoolExecutor] = None
+_manager = None
+
+
+def _get_pool():
+    """懒加载进程池和用于跨进程传递批次的队列管理器"""
+    global _executor, _manager
+    with _lock:
+        if _executor is None:
+            import multiprocessing
+            ctx = multiprocessing.get_context("spawn")
+            _manager = ctx.Manager()
+            _executor = ProcessPoolExecutor(max_workers=ParseConfig.POOL_SIZE, mp_context=ctx)
+        return _executor, _manager
+
+
+def shutdown():
+    """关闭进程池"""
+    global _executor, _manager
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(cancel_futures=True)
+            _manager.shutdown()
+        _executor, _manager = None, None
+
+
+def _put(out, cancel, item) -> bool:
+    """向结果队列写入，消费方取消时返回False"""
+    while not cancel.is_set():
+        try:
+            out.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _open(file_path: str, filename: str, doc_id: Optional[str], streaming: bool):
+    """
+    创建文档加载器，流式加载器在迭代时才解析
+
+    Returns:
+        加载器，以及知识块总数（流式解析时为None）
+    """
+    from kb.kb_loader import DocxLoader, DocxStreamLoader
+    loader = (DocxStreamLoader if streaming else DocxLoader)(file_path=file_path, doc_id=doc_id)
+    loader.root.value = filename
+    return loader, None if streaming else sum(1 for _ in loader)
+
+
+def _produce(loader) -> Iterator[tuple]:
+    """按批次产生知识块，最后产生知识块总数和生成知识块的耗时（不含等待消费的时间）"""
+    docs = loader.lazy_load()
+    seconds, count, batch = 0., 0, []
+    while True:
+        start = time.perf_counter()
+        doc = next(docs, None)
+        seconds += time.perf_counter() - start
+        if doc is None:
+            break
+        batch.append(doc)
+        count += 1
+        if len(batch) >= ParseConfig.STREAM_BATCH_SIZE:
+            yield _BATCH, batch
+            batch = []
+    if batch:
+        yield _BATCH, batch
+    yield _DONE, count, seconds
+
+
+def _parse(file_path: str, filename: str, doc_id: Optional[str], streaming: bool, out, cancel,
+           submitted_at: float):
+    """在解析进程中执行：解析文档并按批次写入结果队列"""
+    started_at = time.time()
+    try:
+        loader, total = _open(file_path, filename, doc_id, streaming)
+        if not _put(out, cancel, (_START, loader.root.uuid, total,
+                                  started_at - submitted_at, time.time() - started_at)):
+            return
+        for item in _produce(loader):
+            if not _put(out, cancel, item):
+                return
+    except Exception as e:
+        # 异常对象不一定能够跨进程反序列化，这里只传递异常信息
+        _put(out, cancel, (_ERROR, f"{e!r}\n{traceback.format_exc()}"))
+    finally:
+        # 解析进程中记录的加载器指标通过指标数据库汇总，每个文档写入一次
+        from kb.kb_metrics import get_metrics_store
+        get_metrics_store().flush()
+
+
+class ParsedDocx(Iterator[Document]):
+    """解析中的文档，迭代时按顺序返回知识块"""
+
+    def __init__(self, file_path: str, root_id: str, total: Optional[int], parse_seconds: float,
+                 stream: Iterator[tuple]):
+        self.file_path = file_path
+        self.root_id = root_id
+        """根节点id"""
+        self.streaming = total is None
+        """是否为流式解析"""
+        self.total = total
+        """知识块总数，流式解析时迭代结束后才能确定"""
+        self.parse_seconds = parse_seconds
+        """解析为知识树的耗时，流式解析时迭代结束后为解析的总耗时"""
+        self._stream = stream
+        self._docs = self._iter_docs()
+
+    def _iter_docs(self) -> Iterator[Document]:
+        for item in self._stream:
+            if item[0] == _BATCH:
+                yield from item[1]
+            elif item[0] == _DONE:
+                self.total = item[1]
+                if self.streaming:
+                    self.parse_seconds = item[2]
+                    PARSE_SECONDS.observe(item[2])
+
+    def __next__(self) -> Document:
+        return next(self._docs)
+
+    def close(self):
+        """停止读取，解析进程随之退出"""
+        self._docs.close()
+        if hasattr(self._stream, "close"):
+            self._stream.close()
+
+
+def _stream(file_path: str, out, cancel, future) -> Iterator[tuple]:
+    """读取解析进程的结果，消费结束或中断时通知解析进程退出"""
+    try:
+        while True:
+            try:
+                item = out.get(timeout=1)
+            except queue.Empty:
+                if future.done():
+                    # 解析进程异常退出，没有写入结束标记
+                    future.result()
+                    raise DocParseException(file_path, "parse process exited unexpectedly")
+                continue
+            if item[0] == _ERROR:
+                raise DocParseException(file_path, item[1])
+            yield item
+            if item[0] == _DONE:
+                return
+    finally:
+        cancel.set()
+
+
+def parse_docx(file_path: str, filename: str, doc_id: str = None, streaming: bool = None) -> ParsedDocx:
+    """
+    在解析进程池中解析docx文档
+    Args:
+        file_path: 文件路径
+        filename: 文档名称，作为知识树的根节点
+        doc_id: 文档id，见 `DocxLoader`
+        streaming: 是否使用流式加载器 `DocxStreamLoader`，默认为 `ParseConfig.STREAMING`
+
+    Returns:
+        解析中的文档，知识块在迭代时流式返回
+
+    Raises:
+        DocParseException: 文档解析失败
+    """
+    streaming = ParseConfig.STREAMING if streaming is None else streaming
+    if ParseConfig.POOL_SIZE <= 0:
+        start = time.perf_counter()
+        loader, total = _open(file_path, filename, doc_id, streaming)
+        parse_seconds = time.perf_counter() - start
+        if not streaming:
+            PARSE_SECONDS.observe(parse_seconds)
+        return ParsedDocx(file_path, loader.root.uuid, total, parse_seconds, _produce(loader))
+
+    executor, manager = _get_pool()
+    out = manager.Queue(maxsize=ParseConfig.STREAM_QUEUE_SIZE)
+    cancel = manager.Event()
+    future = executor.submit(_parse, file_path, filename, doc_id, streaming, out, cancel, time.time())
+    stream = _stream(file_path, out, cancel, future)
+    _, root_id, total, queue_wait, parse_seconds = next(stream)
+    PARSE_QUEUE_WAIT.observe(queue_wait)
+    if total is not None:
+        PARSE_SECONDS.observe(parse_seconds)
+    return ParsedDocx(file_path, root_id, total, parse_seconds, stream)
@@ -0,0 +1,132 @@
+"""
+知识库存储配置：向量量化、向量和 payload 是否保存在磁盘、HNSW 索引参数及优化器阈值。
+配置保存在本地数据库中，创建集合时使用，修改后同步更新已有的集合。
+"""
+import asyncio
+import threading
+from enum import Enum
+from typing import Any, Optional
+
+from pydantic import BaseModel, Field
+from qdrant_client import models
+
+from kb.kb_config import QdrantConfig
+from kb.kb_sqlite import connect
+
+
+class Quantization(str, Enum):
+    """向量量化方式"""
+    NONE = "none"
+    """不量化，float32"""
+    INT8 = "int8"
+    """标量量化，内存约为原来的 1/4，召回率损失很小"""
+    BINARY = "binary"
+    """二值量化，内存约为原来的 1/32，适合维度较高的模型，需要配合重排序"""
+
+
+class Backend(str, Enum):
+    """知识库存储后端"""
+    QDRANT = "qdrant"
+    NUMPY = "numpy"
+    """进程内的内存映射矩阵，精确检索，适合几千个知识块以内的小知识库和没有 Qdrant 的测试环境"""
+
+
+class StorageProfile(BaseModel):
+    """知识库存储配置，为空的参数使用 Qdrant 的默认值，numpy 后端忽略 Qdrant 的参数"""
+    backend: Backend = Field(Backend.QDRANT, description="存储后端，只有空的知识库可以切换")
+    quantization: Quantization = Field(Quantization.NONE, description="向量量化方式")
+    quantization_always_ram: bool = Field(True, description="量化后的向量是否常驻内存")
+    rescore: bool = Field(True, description="量化检索后是否使用原始向量重新打分")
+    oversampling: Optional[float] = Field(None, ge=1, description="量化检索时的多取倍数，配合重新打分提高召回率")
+    on_disk: bool = Field(False, description="原始向量是否保存在磁盘（内存映射），量化时建议开启")
+    on_disk_payload: bool = Field(False, description="payload 是否保存在磁盘")
+    hnsw_m: Optional[int] = Field(None, ge=0, description="HNSW 每个节点的边数，越大召回率越高、内存越大")
+    hnsw_ef_construct: Optional[int] = Field(None, ge=4, description="HNSW 构建时的候选数量，越大索引质量越高、构建越慢")
+    hnsw_on_disk: Optional[bool] = Field(None, description="HNSW 索引是否保存在磁盘")
+    indexing_threshold: Optional[int] = Field(None, ge=0, description="段的向量数量（KB）超过该值时建立 HNSW 索引")
+    memmap_threshold: Optional[int] = Field(None, ge=0, description="段的大小（KB）超过该值时转为内存映射")
+
+    def vectors_config(self, size: int) -> models.VectorParams:
+        return models.VectorParams(size=size, distance=models.Distance.COSINE, on_disk=self.on_disk or None)
+
+    def hnsw_config(self) -> Optional[models.HnswConfigDiff]:
+        if self.hnsw_m is None and self.hnsw_ef_construct is None and self.hnsw_on_disk is None:
+            return None
+        return models.HnswConfigDiff(m=self.hnsw_m, ef_construct=self.hnsw_ef_construct, on_disk=self.hnsw_on_disk)
+
+    def optimizers_config(self) -> Optional[models.OptimizersConfigDiff]:
+        if self.indexing_threshold is None and self.memmap_threshold is None:
+            return None
+        return models.OptimizersConfigDiff(indexing_threshold=self.indexing_threshold,
+                                           memmap_threshold=self.memmap_threshold)
+
+    def quantization_config(self) -> Optional[models.QuantizationConfig]:
+        if self.quantization == Quantization.INT8:
+            return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8, quantile=0.99, always_ram=self.quantization_always_ram))
+        if self.quantization == Quantization.BINARY:
+            return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(
+                always_ram=self.quantization_always_ram))
+        return None
+
+    def create_params(self, size: int) -> dict[str, Any]:
+        """创建集合的参数"""
+        return {"vectors_config": self.vectors_config(size),
+                "on_disk_payload": self.on_disk_payload,
+                "hnsw_config": self.hnsw_config(),
+                "optimizers_config": self.optimizers_config(),
+                "quantization_config": self.quantization_config()}
+
+    def update_params(self) -> dict[str, Any]:
+        """更新已有集合的参数，Qdrant 会在后台按新的参数重新优化"""
+        return {"vectors_config": {"": models.VectorParamsDiff(on_disk=self.on_disk)},
+                "collection_params": models.CollectionParamsDiff(on_disk_payload=self.on_disk_payload),
+                "hnsw_config": self.hnsw_config(),
+                "optimizers_config": self.optimizers_config(),
+                "quantization_config": self.quantization_config() or models.Disabled.DISABLED}
+
+    def search_params(self) -> Optional[models.SearchParams]:
+        """检索参数，量化时控制重新打分和多取倍数"""
+        if self.quantization == Quantization.NONE:
+            return None
+        return models.SearchParams(quantization=models.QuantizationSearchParams(rescore=self.rescore,
+                                                                                oversampling=self.oversampling))
+
+
+class ProfileStore:
+    """知识库存储配置，保存在本地数据库中，API 进程和工作进程共用"""
+
+    def __init__(self, path: str = QdrantConfig.PROFILE_PATH):
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS profiles (kb_id TEXT PRIMARY KEY, profile TEXT NOT NULL)")
+
+    def get(self, kb_id: str) -> Optional[StorageProfile]:
+        """知识库的存储配置，没有设置时返回None"""
+        with self._lock:
+            row = self._conn.execute("SELECT profile FROM profiles WHERE kb_id = ?", (kb_id,)).fetchone()
+        return StorageProfile.model_validate_json(row["profile"]) if row else None
+
+    def put(self, kb_id: str, profile: StorageProfile):
+        with self._lock:
+            self._conn.execute("INSERT INTO profiles (kb_id, profile) VALUES (?, ?) "
+                               "ON CONFLICT (kb_id) DO UPDATE SET profile = excluded.profile",
+                               (kb_id, profile.model_dump_json()))
+
+    async def aget(self, kb_id: str) -> Optional[StorageProfile]:
+        """在线程池中读取存储配置，避免数据库读取阻塞事件循环"""
+        return await asyncio.to_thread(self.get, kb_id)
+
+    async def aput(self, kb_id: str, profile: StorageProfile):
+        await asyncio.to_thread(self.put, kb_id, profile)
+
+
+__store: Optional[ProfileStore] = None
+
+
+def get_profile_store() -> ProfileStore:
+    """获取知识库存储配置，首次使用时初始化"""
+    global __store
+    if __store is None:
+        __store = ProfileStore()
+    return __store
@@ -1,17 +1,32 @@
 """知识库API"""
+import asyncio
+import base64
+import json
 import logging
-from typing import Any
+from typing import Any, Literal, Optional
+from urllib.parse import quote
 
 from fastapi import APIRouter, Path, Query, Body
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 
 import kb.kb_file
 from common import success, failed
-from kb.doc_retriever import get_doc_kb_by_id
-from kb.kb_config import DocxSchema
-from kb.kb_core import get_kb_by_id
+from kb.doc_retriever import aget_doc_kb_by_id
+from kb.embedding.embedding_cache import CachedEmbedding
+from kb.embedding.kb_embedding import get_all_embeddings, find_wrapped
+from kb.file.file_store import get_file_store
+from kb.kb_cache import get_generation, query_embeddings, query_results
+from kb.kb_config import DocxSchema, CacheConfig, QdrantConfig
+from kb.kb_core import Document, VectorKB, aget_kb_by_id, switch_kb_backend
+from kb.kb_excep import InvalidConditionException, InvalidCursorException
+from kb.kb_profile import StorageProfile, get_profile_store
+from kb import kb_snapshot
+from kb.kb_metrics import MetricsRoute
 
 router = APIRouter(prefix="/kb",
-                   tags=["Knowledge Base"])
+                   tags=["Knowledge Base"],
+                   route_class=MetricsRoute)
 
 router.include_router(kb.kb_file.router
                       )
@@ -19,6 +34,19 @@ router.include_router(kb.kb_file.router
 logger = logging.getLogger(__name__)
 
 
+@router.get("/cache/stats",
+            summary="查询缓存统计",
+            description="查询向量缓存、查询结果缓存和 Embedding 持久化缓存的命中情况，用于调整缓存容量")
+async def cache_stats():
+    data = {cache.name: cache.stats() for cache in (query_embeddings, query_results)}
+    for model_uid, model in get_all_embeddings().items():
+        model = find_wrapped(model, CachedEmbedding)
+        if model:
+            data[f"embedding:{model_uid}"] = {"hits": model.hits, "misses": model.misses,
+                                              "hit_ratio": model.hit_ratio}
+    return success(data=data)
+
+
 @router.get("/{kb_id}",
             summary="知识库相似查询",
             description="指定知识库查询相关结果，当前支持\n - 数量限制\n - 指定文档\n - 使用父子关联查询")
@@ -28,57 +56,270 @@ async def query_kb(kb_id: str = Path(..., examples=["Hello;bge-m3"], description
                    limit: int = Query(3, description="查询条数", ge=1),
                    relevant: bool = Query(False, description="是否使用关联父子文档")):
     """知识库的向是查寻"""
-    docs = get_relevant_doc_from_kb(query, kb_id, limit, docs, relevant)
+    docs = await get_relevant_doc_from_kb(query, kb_id, limit, docs, relevant)
     data = [vars(doc) for doc in docs]
     return success(msg=f"Query [{query}] has found some relative documents", data=data)
 
 
+_GROUP_FIELDS = {"file_id": DocxSchema.FILE_ID, "parent": DocxSchema.PARENT_ID}
+"""分组查询支持的分组方式及其对应的元数据字段"""
+
+
+@router.put("/{kb_id}",
+            summary="知识库创建或更新",
+            description="设置知识库的存储配置（存储后端、向量量化、磁盘存储、HNSW 参数、优化器阈值），"
+                        "知识库不存在时按配置创建，已存在时更新，Qdrant 会在后台按新配置重新优化。"
+                        "只有空的知识库可以切换存储后端")
+async def put_kb(kb_id: str = Path(..., examples=["Hello;bge-m3"], description="知识库id"),
+                 profile: StorageProfile = Body(StorageProfile(), description="存储配置")):
+    kb = await asyncio.to_thread(switch_kb_backend, kb_id, profile.backend)
+    await kb.aapply_profile(profile)
+    return success(msg=f"Knowledge base {kb_id} saved", data=profile)
+
+
+@router.get("/{kb_id}/profile",
+            summary="知识库存储配置",
+            description="查询知识库的存储配置，没有设置时为默认配置")
+async def get_kb_profile(kb_id: str = Path(..., examples=["Hello;bge-m3"], description="知识库id")):
+    return success(data=await get_profile_store().aget(kb_id) or StorageProfile())
+
+
+@router.get("/{kb_id}/grouped",
+            summary="知识库分组查询",
+            description="按文档或父节点分组查询，返回最相关的若干个不同的文档（或段落），每组包含最相关的若干知识块")
+async def query_kb_grouped(kb_id: str = Path(..., examples=["Hello;bge-m3"], description="知识库id"),
+                           query: str = Query(..., examples=["Hello"], description="查询相关文档"),
+                           group_by: Literal["file_id", "parent"] = Query("file_id",
+                                                                          description="分组方式：文档或父节点"),
+                           docs: list[str] = Query(None, description="指定相关文档id"),
+                           limit: int = Query(3, description="分组数量", ge=1),
+                           group_size: int = Query(1, description="每组的知识块数量", ge=1)):
+    groups = await get_grouped_doc_from_kb(query, kb_id, _GROUP_FIELDS[group_by], limit, group_size, docs)
+    data = [{"id": group_id, "docs": [vars(doc) for doc in group]} for group_id, group in groups]
+    return success(msg=f"Query [{query}] has found some relative groups", data=data)
+
+
+class BatchQuery(BaseModel):
+    """批量查询中的单个查询"""
+    query: str = Field(description="查询相关文档", examples=["Hello"])
+    docs: Optional[list[str]] = Field(None, description="指定相关文档id")
+    condition: Optional[dict[str, list[str]]] = Field(None, description="过滤条件，与条件查询接口相同")
+    limit: int = Field(3, description="查询条数", ge=1)
+
+
+@router.post("/{kb_id}/batch_query",
+             summary="知识库批量查询",
+             description="一次提交多个查询（例如同一个问题的多种改写），一次向量化、一次检索，"
+                         "返回每个查询的结果，可选返回融合去重后的结果")
+async def batch_query_kb(kb_id: str = Path(..., examples=["Hello;bge-m3"], description="知识库id"),
+                         queries: list[BatchQuery] = Body(..., embed=True, min_length=1, description="查询列表"),
+                         fuse: bool = Body(False, embed=True, description="是否返回按倒数排名融合并去重的结果"),
+                         fuse_limit: int = Body(10, embed=True, ge=1, description="融合结果的条数")):
+    conditions = []
+    for q in queries:
+        condition = dict(q.condition or {})
+        if q.docs:
+            condition[DocxSchema.FILE_ID] = q.docs
+        conditions.append(condition or None)
+    kb = await aget_kb_by_id(kb_id)
+    results = await kb.aquery_batch(queries=[q.query for q in queries], filter_conditions=conditions,
+                                    limits=[q.limit for q in queries])
+    data = {"results": [[vars(doc) for doc in docs] for docs in results],
+            "fused": [vars(doc) for doc in fuse_results(results, fuse_limit)] if fuse else None}
+    return success(msg=f"Batch query [{len(queries)}] from knowledge base {kb_id}", data=data)
+
+
+def fuse_results(results: list[list[Document]], limit: int, k: int = 60) -> list[Document]:
+    """
+    倒数排名融合（RRF）：知识块的得分为它在各个查询结果中 1 / (k + 排名) 之和，相同知识块只保留一个
+    Args:
+        results: 多个查询的结果
+        limit: 返回的数量
+        k: 平滑常数，越大排名靠后的结果影响越大
+    """
+    scores: dict[Any, float] = {}
+    docs: dict[Any, Document] = {}
+    for result in results:
+        for rank, doc in enumerate(result):
+            key = (doc.metadata.get(DocxSchema.FILE_ID), doc.metadata.get(DocxSchema.ORDER_BY), doc.page_content)
+            scores[key] = scores.get(key, 0.) + 1 / (k + rank + 1)
+            docs.setdefault(key, doc)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)[:limit]]
+
+
 @router.post("/{kb_id}",
              summary="知识库条件查询",
-             description="筛选查询知识库中的数据")
+             description="筛选查询知识库中的数据，按游标分页：返回的 next_cursor 作为下一次请求的 cursor，为空时没有更多数据")
 async def filter_kb(kb_id: str = Path(..., examples=["Hello;bge-m3"],
                                       description="知识库id"),
                     condition: dict[str, list[str]] = Body(None,
                                                            description="过滤条件，前面为元数据中的键，后买了为匹配的值。"
                                                                        "\n最终条件为(key1.value in (targets1) and key2.value in (targets2))"),
                     limit: int = Query(10, description="限制条数", ge=1),
-                    offset: int = Query(0, description="偏移量", ge=0)):
+                    cursor: str = Query(None, description="分页游标，上一页返回的 next_cursor，为空时从头开始")):
     """知识库的条件查询"""
-    docs = scroll_kb_with_filter(kb_id, condition, limit, offset)
-    data = [vars(doc) for doc in docs]
+    kb = await aget_kb_by_id(kb_id)
+    records, next_offset = await kb.ascroll_page(filter_condition=condition, limit=limit,
+                                                 offset=decode_cursor(cursor))
+    data = {"records": [vars(doc) for doc in VectorKB._to_documents(records)],
+            "next_cursor": encode_cursor(next_offset)}
     return success(msg=f"Filter from knowledge base {kb_id}", data=data)
 
 
+@router.get("/{kb_id}/export",
+            summary="知识库导出",
+            description="以 NDJSON 流式导出知识库中符合条件的全部知识块，每行一个知识块，内存占用与知识库大小无关")
+async def export_kb(kb_id: str = Path(..., examples=["Hello;bge-m3"], description="知识库id"),
+                    with_vectors: bool = Query(False, description="是否包含向量"),
+                    condition: str = Query(None, description="过滤条件，JSON 格式，与条件查询接口相同，"
+                                                             "例如 {\"file_id\": [\"xxx\"]}")):
+    kb = await aget_kb_by_id(kb_id)
+    filter_condition = parse_condition(condition)
+    # 先取第一页，知识库不存在等错误在开始响应前抛出
+    first = await kb.ascroll_page(filter_condition=filter_condition, limit=QdrantConfig.EXPORT_BATCH_SIZE,
+                                  with_vectors=with_vectors)
+
+    async def lines():
+        records, next_offset = first
+        while True:
+            for record in records:
+                line = {"id": record.id, **record.payload}
+                if with_vectors:
+                    line["vector"] = record.vector
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+            if next_offset is None:
+                return
+            records, next_offset = await kb.ascroll_page(filter_condition=filter_condition,
+                                                         limit=QdrantConfig.EXPORT_BATCH_SIZE, offset=next_offset,
+                                                         with_vectors=with_vectors)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{quote(kb_id)}.ndjson"'})
+
+
+@router.post("/{kb_id}/snapshot",
+             summary="知识库快照导出",
+             description="将知识库的向量、知识块和父节点段落导出为服务端的快照目录，"
+                         "可以在其它环境中导入而不需要重新上传文档和向量化，不包含上传的原始文档")
+async def export_kb_snapshot(kb_id: str = Path(..., examples=["Hello;bge-m3"], description="知识库id"),
+                             name: str = Query(..., examples=["hello-20240801"], description="快照名称"),
+                             dtype: Literal[kb_snapshot.DTYPES] = Query("float32", description="向量精度")):
+    manifest = await asyncio.to_thread(kb_snapshot.export_kb, kb_id, kb_snapshot.snapshot_path(name), dtype)
+    return success(msg=f"Knowledge base {kb_id} exported to snapshot {name}", data=manifest)
+
+
+@router.post("/{kb_id}/snapshot/import",
+             summary="知识库快照导入",
+             description="将服务端的快照导入知识库，不调用 Embedding 模型，知识库与快照的 Embedding 模型必须相同")
+async def import_kb_snapshot(kb_id: str = Path(..., examples=["Hello;bge-m3"], description="知识库id"),
+                             name: str = Query(..., examples=["hello-20240801"], description="快照名称")):
+    manifest = await asyncio.to_thread(kb_snapshot.import_kb, kb_snapshot.snapshot_path(name), kb_id)
+    return success(msg=f"Snapshot {name} imported to knowledge base {kb_id}", data=manifest)
+
+
+def encode_cursor(offset) -> Optional[str]:
+    """将 Qdrant 的下一页起点（点id）编码为不透明的游标"""
+    if offset is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(offset).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]):
+    """
+    解析 `encode_cursor` 生成的游标
+
+    Raises:
+        InvalidCursorException: 游标不合法
+    """
+    if not cursor:
+        return None
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise InvalidCursorException(cursor=cursor)
+    if not isinstance(offset, (str, int)) or isinstance(offset, bool):
+        raise InvalidCursorException(cursor=cursor)
+    return offset
+
+
+def parse_condition(condition: Optional[str]) -> Optional[dict[str, Any]]:
+    """
+    解析 JSON 格式的过滤条件
+
+    Raises:
+        InvalidConditionException: 不是 JSON 对象
+    """
+    if not condition:
+        return None
+    try:
+        res = json.loads(condition)
+    except ValueError as e:
+        raise InvalidConditionException(condition=condition, reason=str(e))
+    if not isinstance(res, dict):
+        raise InvalidConditionException(condition=condition, reason="must be a JSON object")
+    return res
+
+
 @router.delete("/{kb_id}",
                summary="从知识库中删除文档",
                description="指定文档id（上传文档时生成）和知识库，从指定知识库中删除文档")
 async def delete_doc(kb_id: str = Path(..., examples=["Hello;bge-m3"],
                                        description="知识库id"),
                      file_ids: list[str] = Query(..., description="指定相关文档id，上传时返回，具体可见上传文档接口 ")):
-    res = delete_doc_from_kb(kb_id=kb_id, doc_ids=file_ids)
+    res = await delete_doc_from_kb(kb_id=kb_id, doc_ids=file_ids)
     return success("成功删除") if res else failed("删除失败")
 
 
-def delete_doc_from_kb(kb_id: str, doc_ids: list[str]):
-    kb = get_kb_by_id(kb_id=kb_id)
-    res = kb.remove_kb_split(ids=doc_ids)
+async def delete_doc_from_kb(kb_id: str, doc_ids: list[str]):
+    kb = await aget_kb_by_id(kb_id)
+    res = await kb.aremove_kb_split(ids=doc_ids)
+    doc_kb = await aget_doc_kb_by_id(kb_id)
+    await doc_kb.aremove_sections(doc_ids)
+    if res:
+        # 释放文档对上传文件的引用，没有其它知识库引用时删除文件，数据库事务和文件删除在线程池中执行
+        await asyncio.to_thread(release_files, kb_id, doc_ids)
     return res
 
 
-def scroll_kb_with_filter(kb_id: str, condition: dict[str, Any] = None, limit: int = 10, offset=0):
-    """遍历检索知识库，可以按条件查询"""
-    kb = get_kb_by_id(kb_id)
-    return kb.filter_by(filter_condition=condition, limit=limit, offset=offset)
+def release_files(kb_id: str, doc_ids: list[str]):
+    store = get_file_store()
+    for doc_id in doc_ids:
+        store.release(kb_id=kb_id, file_id=doc_id)
+
+
+async def get_grouped_doc_from_kb(query: str, kb_id: str, group_by: str, limit: int, group_size: int,
+                                  docs: list[str] = None):
+    """分组查询知识库，结果与普通查询一样按知识库版本缓存"""
+    cache_key = None
+    if CacheConfig.RESULT_TTL > 0:
+        cache_key = (kb_id, await get_generation().acurrent(kb_id), query, tuple(sorted(docs or ())), limit,
+                     "grouped", group_by, group_size)
+        res = query_results.get(cache_key)
+        if res is not None:
+            return res
+    filter_condition = {DocxSchema.FILE_ID: docs} if docs else None
+    kb = await aget_kb_by_id(kb_id)
+    res = await kb.aquery_groups(query=query, group_by=group_by, limit=limit, group_size=group_size,
+                                 filter_condition=filter_condition)
+    if cache_key:
+        query_results.put(cache_key, res)
+    return res
 
 
-def get_relevant_doc_from_kb(query: str, kb_id: str, limit: int, docs: list[str] = None, relevant=False):
-    """从知识库中获取相关文档片段"""
+async def get_relevant_doc_from_kb(query: str, kb_id: str, limit: int, docs: list[str] = None, relevant=False):
+    """从知识库中获取相关文档片段，结果按知识库版本缓存，知识库写入后重新查询"""
+    cache_key = None
+    if CacheConfig.RESULT_TTL > 0:
+        cache_key = (kb_id, await get_generation().acurrent(kb_id), query, tuple(sorted(docs or ())), limit, relevant)
+        res = query_results.get(cache_key)
+        if res is not None:
+            return res
     if docs:
         filter_condition = {DocxSchema.FILE_ID: docs}
     else:
         filter_condition = None
-    kb = get_kb_by_id(kb_id)
-    if relevant:
-        kb = get_doc_kb_by_id(kb_id=kb_id)
-    res = kb.query_doc(query=query, limit=limit, filter_condition=filter_condition)
+    kb = await aget_doc_kb_by_id(kb_id) if relevant else await aget_kb_by_id(kb_id)
+    res = await kb.aquery_doc(query=query, limit=limit, filter_condition=filter_condition)
+    if cache_key:
+        query_results.put(cache_key, res)
     return res
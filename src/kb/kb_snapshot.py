@@ -0,0 +1,291 @@
+"""
+知识库快照：导出知识库中的全部知识块，在其它环境中导入，不需要重新上传文档和向量化。
+快照是一个目录，包含：
+
+- manifest.json：知识库id、Embedding 模型id、向量维度、数量、存储配置等
+- vectors.npy：全部向量，一个连续的 float32/float16 矩阵，可以内存映射读取
+- points.jsonl.gz：与向量逐行对应的知识块id和 payload
+- sections.jsonl.gz：父子检索使用的父节点段落
+
+命令行使用：
+
+    python -m kb.kb_snapshot export Hello;bge-m3 ./snapshots/hello
+    python -m kb.kb_snapshot import ./snapshots/hello --kb-id Hello2;bge-m3
+"""
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Iterator, Optional
+
+import numpy as np
+from qdrant_client import models
+
+from kb.doc_retriever import get_doc_kb_by_id
+from kb.embedding.embedding_excep import EmbeddingNotFoundException
+from kb.embedding.kb_embedding import get_embedding_model
+from kb.kb_cache import get_generation
+from kb.kb_config import QdrantConfig
+from kb.kb_core import client, create_collection, get_kb_by_id
+from kb.kb_excep import SnapshotException
+from kb.kb_profile import Backend, StorageProfile, get_profile_store
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+VECTORS = "vectors.npy"
+POINTS = "points.jsonl.gz"
+SECTIONS = "sections.jsonl.gz"
+FORMAT_VERSION = 1
+DTYPES = ("float32", "float16")
+_NAME_PATTERN = re.compile(r"^\w[\w.-]{0,127}$")
+
+
+def export_kb(kb_id: str, path: str, dtype: str = "float32", batch_size: int = None) -> dict[str, Any]:
+    """
+    导出知识库快照，向量直接写入内存映射的矩阵，内存占用与知识库大小无关。
+    导出期间知识库不应写入，数量发生变化时导出失败
+    Args:
+        kb_id: 知识库id
+        path: 快照目录，不存在时创建
+        dtype: 向量精度，float16 体积减半，对余弦相似度的影响很小
+        batch_size: 每次滚动查询的数量
+
+    Returns:
+        快照清单
+
+    Raises:
+        SnapshotException: 知识库不存在、精度不支持或导出期间知识库发生变化
+    """
+    if dtype not in DTYPES:
+        raise SnapshotException(path, f"dtype must be one of {DTYPES}")
+    kb = get_doc_kb_by_id(kb_id)
+    _check_backend(path, kb)
+    if not client.collection_exists(collection_name=kb_id):
+        raise SnapshotException(path, f"knowledge base {kb_id} does not exist")
+    batch_size = batch_size or QdrantConfig.EXPORT_BATCH_SIZE
+    start = time.perf_counter()
+    dim = client.get_collection(collection_name=kb_id).config.params.vectors.size
+    count = client.count(collection_name=kb_id, exact=True).count
+    os.makedirs(path, exist_ok=True)
+    vectors = np.lib.format.open_memmap(os.path.join(path, VECTORS), mode="w+", dtype=dtype, shape=(count, dim))
+    n = 0
+    with gzip.open(os.path.join(path, POINTS), "wt", encoding="utf-8") as f:
+        for records in _scroll(kb_id, batch_size, with_vectors=True):
+            if n + len(records) > count:
+                raise SnapshotException(path, "knowledge base changed during export")
+            vectors[n:n + len(records)] = [record.vector for record in records]
+            for record in records:
+                f.write(json.dumps({"id": record.id, "payload": record.payload}, ensure_ascii=False) + "\n")
+            n += len(records)
+    vectors.flush()
+    del vectors
+    if n != count:
+        raise SnapshotException(path, "knowledge base changed during export")
+    sections = 0
+    if client.collection_exists(collection_name=kb.sections_id):
+        with gzip.open(os.path.join(path, SECTIONS), "wt", encoding="utf-8") as f:
+            for records in _scroll(kb.sections_id, batch_size, with_vectors=False):
+                for record in records:
+                    f.write(json.dumps({"id": record.id, "payload": record.payload}, ensure_ascii=False) + "\n")
+                sections += len(records)
+    profile = get_profile_store().get(kb_id)
+    manifest = {"version": FORMAT_VERSION, "kb_id": kb_id, "embedding_model_id": kb.embedding_model_id,
+                "dimension": dim, "dtype": dtype, "count": count, "sections": sections,
+                "profile": profile.model_dump(mode="json") if profile else None, "created_at": time.time()}
+    with open(os.path.join(path, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    logger.info(f"Exported {count} points of kb-[{kb_id}] to {path} in {time.perf_counter() - start:.1f}s")
+    return manifest
+
+
+def import_kb(path: str, kb_id: str = None, workers: int = None, batch_size: int = None) -> dict[str, Any]:
+    """
+    导入知识库快照，向量按批次并行写入，不调用 Embedding 模型。相同id的知识块会被覆盖
+    Args:
+        path: 快照目录
+        kb_id: 导入的知识库id，为空时使用快照中的知识库id，两者的 Embedding 模型必须相同
+        workers: 并行写入的线程数量
+        batch_size: 每批写入的数量
+
+    Returns:
+        快照清单
+
+    Raises:
+        SnapshotException: 快照不完整、版本不支持或与目标知识库的模型、向量维度不一致
+    """
+    manifest = read_manifest(path)
+    kb_id = kb_id or manifest["kb_id"]
+    kb = get_doc_kb_by_id(kb_id)
+    _check_backend(path, kb)
+    model_id = kb.embedding_model_id
+    dim = manifest["dimension"]
+    if model_id != manifest["embedding_model_id"]:
+        raise SnapshotException(path, f"embedding model {model_id} differs from {manifest['embedding_model_id']}")
+    _check_model_size(path, model_id, dim)
+    workers = workers or QdrantConfig.IMPORT_WORKERS
+    batch_size = batch_size or QdrantConfig.IMPORT_BATCH_SIZE
+    start = time.perf_counter()
+
+    if manifest["profile"] and get_profile_store().get(kb_id) is None:
+        get_profile_store().put(kb_id, StorageProfile.model_validate(manifest["profile"]))
+    profile = get_profile_store().get(kb_id) or StorageProfile()
+    if client.collection_exists(collection_name=kb_id):
+        size = client.get_collection(collection_name=kb_id).config.params.vectors.size
+        if size != dim:
+            raise SnapshotException(path, f"vector size {dim} differs from {size} of {kb_id}")
+    else:
+        create_collection(kb_id, dim, profile)
+    vectors = np.load(os.path.join(path, VECTORS), mmap_mode="r")
+    if vectors.shape != (manifest["count"], dim):
+        raise SnapshotException(path, f"{VECTORS} shape {vectors.shape} does not match the manifest")
+
+    with _Uploader(workers) as uploader, gzip.open(os.path.join(path, POINTS), "rt", encoding="utf-8") as f:
+        n = 0
+        for lines in _batched(f, batch_size):
+            points = [json.loads(line) for line in lines]
+            batch = vectors[n:n + len(points)].astype(np.float32)
+            uploader.submit(kb_id, models.Batch(ids=[p["id"] for p in points], vectors=batch.tolist(),
+                                                payloads=[p["payload"] for p in points]))
+            n += len(points)
+    if n != manifest["count"]:
+        raise SnapshotException(path, f"{POINTS} has {n} points, expected {manifest['count']}")
+
+    sections_path = os.path.join(path, SECTIONS)
+    if os.path.exists(sections_path):
+        kb.ensure_sections_collection()
+        with _Uploader(workers) as uploader, gzip.open(sections_path, "rt", encoding="utf-8") as f:
+            for lines in _batched(f, batch_size):
+                points = [json.loads(line) for line in lines]
+                uploader.submit(kb.sections_id, [models.PointStruct(id=p["id"], vector={}, payload=p["payload"])
+                                              for p in points])
+    # 集合可能由导入创建，清除已注册实例的检查缓存
+    kb.invalidate_collection_check()
+    get_kb_by_id(kb_id).invalidate_collection_check()
+    get_generation().bump(kb_id)
+    logger.info(f"Imported {n} points from {path} to kb-[{kb_id}] in {time.perf_counter() - start:.1f}s")
+    return manifest
+
+
+def snapshot_path(name: str) -> str:
+    """
+    快照名称对应的服务端目录，位于 `QdrantConfig.SNAPSHOT_PATH` 下
+
+    Raises:
+        SnapshotException: 名称包含路径分隔符等不允许的字符
+    """
+    if not _NAME_PATTERN.match(name):
+        raise SnapshotException(name, "name may only contain letters, digits, '_', '-' and '.'")
+    return os.path.join(QdrantConfig.SNAPSHOT_PATH, name)
+
+
+def read_manifest(path: str) -> dict[str, Any]:
+    """
+    读取快照清单
+
+    Raises:
+        SnapshotException: 清单不存在或者版本不支持
+    """
+    try:
+        with open(os.path.join(path, MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise SnapshotException(path, f"cannot read {MANIFEST}: {e}")
+    if manifest.get("version") != FORMAT_VERSION:
+        raise SnapshotException(path, f"unsupported snapshot version {manifest.get('version')}")
+    return manifest
+
+
+def _check_backend(path: str, kb):
+    if kb.backend != Backend.QDRANT:
+        raise SnapshotException(path, f"knowledge base {kb.kb_id} is not stored in qdrant")
+
+
+def _check_model_size(path: str, model_id: str, dim: int):
+    """模型维度已知时必须与快照一致，未知时直接使用快照的维度，避免请求模型探测"""
+    try:
+        model = get_embedding_model(model_id)
+    except EmbeddingNotFoundException:
+        logger.warning(f"The EmbeddingModel-[{model_id}] of the snapshot was not registered")
+        return
+    if not model.size_known:
+        model.size = dim
+    elif model.size != dim:
+        raise SnapshotException(path, f"vector size {dim} differs from {model.size} of model {model_id}")
+
+
+def _scroll(collection_name: str, batch_size: int, with_vectors: bool) -> Iterator[list[models.Record]]:
+    offset = None
+    while True:
+        records, offset = client.scroll(collection_name=collection_name, limit=batch_size, offset=offset,
+                                        with_payload=True, with_vectors=with_vectors)
+        if records:
+            yield records
+        if offset is None:
+            return
+
+
+def _batched(lines, size: int) -> Iterator[list[str]]:
+    while batch := list(itertools.islice(lines, size)):
+        yield batch
+
+
+class _Uploader:
+    """并行写入，同时进行中的批次数量有上限，内存占用与快照大小无关；任何批次失败时抛出异常"""
+
+    def __init__(self, workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kb-snapshot-upload")
+        self._slots = threading.BoundedSemaphore(workers * 2)
+        self._futures: list[Future] = []
+
+    def submit(self, collection_name: str, points):
+        self._slots.acquire()
+        future = self._executor.submit(client.upsert, collection_name=collection_name, points=points, wait=True)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures = [f for f in self._futures if not f.done() or f.exception()]
+        self._futures.append(future)
+        self._raise_failed()
+
+    def _raise_failed(self):
+        for future in self._futures:
+            if future.done() and future.exception():
+                raise future.exception()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._executor.shutdown(wait=True, cancel_futures=exc_type is not None)
+        if exc_type is None:
+            self._raise_failed()
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    export_parser = sub.add_parser("export", help="导出知识库快照")
+    export_parser.add_argument("kb_id", help="知识库id")
+    export_parser.add_argument("path", help="快照目录")
+    export_parser.add_argument("--dtype", choices=DTYPES, default="float32", help="向量精度")
+    import_parser = sub.add_parser("import", help="导入知识库快照")
+    import_parser.add_argument("path", help="快照目录")
+    import_parser.add_argument("--kb-id", help="导入的知识库id，默认与快照相同")
+    import_parser.add_argument("--workers", type=int, help="并行写入的线程数量")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "export":
+        manifest = export_kb(args.kb_id, args.path, dtype=args.dtype)
+    else:
+        manifest = import_kb(args.path, kb_id=args.kb_id, workers=args.workers)
+    print(json.dumps(manifest, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
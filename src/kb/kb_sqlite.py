@@ -0,0 +1,23 @@
+"""本地 SQLite 存储的公共连接配置，供任务队列等多进程共享的本地状态使用"""
+import os
+import sqlite3
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    打开本地 SQLite 数据库
+    Args:
+        path: 数据库文件路径，父目录不存在时自动创建
+
+    Returns:
+        自动提交模式的连接，需要事务时显式 `BEGIN`
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # WAL 模式下读写互不阻塞，适合 API 进程读状态、工作进程写进度的场景
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
@@ -0,0 +1,571 @@
+"""
+numpy 后端的知识库：向量保存在内存映射的 float32 矩阵文件中，知识块id和 payload 保存在本地 SQLite 中。
+检索时对全部向量做一次矩阵乘法并用 argpartition 取前 k 个，结果与精确检索相同，
+适合几千个知识块以内的小知识库和没有 Qdrant 的测试环境。API 进程和工作进程通过同一个目录共享数据。
+
+向量文件只追加，覆盖或删除知识块时只在 SQLite 中取消引用，读取中的快照不受之后写入的影响；
+失效的向量超过 `NumpyKBConfig.COMPACT_RATIO` 时重写到新的向量文件。
+"""
+import asyncio
+import bisect
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from typing import Any, Iterable, Iterator, List, Optional, Union
+from urllib.parse import quote
+
+import numpy as np
+from qdrant_client import models
+
+from kb.doc_retriever import ParentRetriever
+from kb.kb_cache import get_generation
+from kb.kb_config import DocxSchema, NumpyKBConfig
+from kb.kb_core import BaseVectorKB, Document
+from kb.kb_excep import InvalidConditionException
+from kb.kb_profile import Backend, StorageProfile, get_profile_store
+from kb.kb_sqlite import connect
+
+logger = logging.getLogger(__name__)
+
+PointId = Union[int, str]
+
+
+def normalize_id(point_id: PointId) -> PointId:
+    """与 Qdrant 一致，知识块id为非负整数或者 UUID，UUID 统一为小写的标准格式"""
+    if isinstance(point_id, int) and not isinstance(point_id, bool):
+        if point_id < 0:
+            raise ValueError(f"point id must be a non-negative integer or a UUID: {point_id}")
+        return point_id
+    return str(uuid.UUID(str(point_id)))
+
+
+def _id_key(point_id: PointId) -> tuple:
+    # 与 Qdrant 的滚动顺序一致，整数id在 UUID 之前
+    return isinstance(point_id, str), point_id
+
+
+def _values_at(obj, path: list[str]) -> Iterator[Any]:
+    """payload 中键路径对应的全部值，路径经过或指向数组时展开数组"""
+    if isinstance(obj, list):
+        for item in obj:
+            yield from _values_at(item, path)
+    elif not path:
+        yield obj
+    elif isinstance(obj, dict) and path[0] in obj:
+        yield from _values_at(obj[path[0]], path[1:])
+
+
+class _Snapshot:
+    """某一时刻的只读数据，查询期间不受其它线程、进程写入的影响。知识块按id排序，位置即排序后的下标"""
+
+    def __init__(self, ids: list[PointId], payloads: list[dict], rows: np.ndarray, matrix: Optional[np.ndarray]):
+        self.ids = ids
+        self.payloads = payloads
+        self.rows = rows
+        """每个知识块在向量矩阵中的行号"""
+        self.matrix = matrix
+        """向量矩阵，包含已经失效的行，没有向量时为空"""
+        self._keys = [_id_key(point_id) for point_id in ids]
+        self._positions = {point_id: i for i, point_id in enumerate(ids)}
+        self._indexes: dict[str, dict[Any, np.ndarray]] = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def select(self, query_filter: Optional[models.Filter]) -> np.ndarray:
+        """符合过滤条件的知识块位置，按id排序"""
+        if query_filter is None:
+            return np.arange(len(self.ids))
+        return np.flatnonzero(self._filter_mask(query_filter))
+
+    def _filter_mask(self, query_filter: models.Filter) -> np.ndarray:
+        # 与 Qdrant 相同：must 全部成立，should 至少一个成立，must_not 全部不成立
+        mask = np.ones(len(self.ids), dtype=bool)
+        for condition in self._as_list(query_filter.must):
+            mask &= self._condition_mask(condition)
+        should = self._as_list(query_filter.should)
+        if should:
+            any_mask = np.zeros(len(self.ids), dtype=bool)
+            for condition in should:
+                any_mask |= self._condition_mask(condition)
+            mask &= any_mask
+        for condition in self._as_list(query_filter.must_not):
+            mask &= ~self._condition_mask(condition)
+        return mask
+
+    @staticmethod
+    def _as_list(conditions) -> list:
+        if conditions is None:
+            return []
+        return conditions if isinstance(conditions, list) else [conditions]
+
+    def _condition_mask(self, condition) -> np.ndarray:
+        mask = np.zeros(len(self.ids), dtype=bool)
+        if isinstance(condition, models.Filter):
+            return self._filter_mask(condition)
+        if isinstance(condition, models.HasIdCondition):
+            positions = [self._positions.get(normalize_id(point_id)) for point_id in condition.has_id]
+            mask[[position for position in positions if position is not None]] = True
+            return mask
+        if isinstance(condition, models.FieldCondition) and condition.match is not None:
+            index = self._index(condition.key)
+            match = condition.match
+            if isinstance(match, models.MatchValue):
+                values = [match.value]
+            elif isinstance(match, models.MatchAny):
+                values = match.any
+            elif isinstance(match, models.MatchExcept):
+                excluded = set(match.except_)
+                values = [value for value in index if value not in excluded]
+            else:
+                raise InvalidConditionException(condition=condition, reason="not supported by the numpy backend")
+            for value in values:
+                if value in index:
+                    mask[index[value]] = True
+            return mask
+        raise InvalidConditionException(condition=condition, reason="not supported by the numpy backend")
+
+    def _index(self, key: str) -> dict[Any, np.ndarray]:
+        """payload 字段的倒排索引，首次按该字段过滤时建立"""
+        index = self._indexes.get(key)
+        if index is None:
+            path = key.replace("[]", "").split(".")
+            positions: dict[Any, list[int]] = {}
+            for i, payload in enumerate(self.payloads):
+                for value in _values_at(payload, path):
+                    if isinstance(value, (str, int, float, bool)):
+                        positions.setdefault(value, []).append(i)
+            index = {value: np.array(pos, dtype=np.int64) for value, pos in positions.items()}
+            self._indexes[key] = index
+        return index
+
+    def search(self, queries: np.ndarray, candidates: list[np.ndarray],
+               limits: list[Optional[int]]) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        余弦相似度检索
+        Args:
+            queries: 单位化的查询向量，每行一个查询
+            candidates: 每个查询的候选知识块位置
+            limits: 每个查询返回的数量，为空时返回全部候选
+
+        Returns:
+            每个查询按相似度从高到低排序的 (知识块位置, 相似度)
+        """
+        results = []
+        # 候选较多时一次计算全部向量与全部查询的相似度，否则只计算候选的向量
+        full = None
+        if any(len(cand) * 4 >= len(self.rows) for cand in candidates):
+            full = self.matrix @ queries.T
+        for j, (cand, limit) in enumerate(zip(candidates, limits)):
+            if len(cand) == 0:
+                results.append((cand, np.empty(0, dtype=np.float32)))
+                continue
+            scores = full[self.rows[cand], j] if full is not None else self.matrix[self.rows[cand]] @ queries[j]
+            if limit is not None and limit < len(cand):
+                top = np.argpartition(-scores, limit - 1)[:limit]
+            else:
+                top = np.arange(len(cand))
+            top = top[np.argsort(-scores[top], kind="stable")]
+            results.append((cand[top], scores[top]))
+        return results
+
+    def scroll(self, query_filter: Optional[models.Filter], limit: int, offset: Optional[PointId]):
+        """按id顺序分页，返回本页的知识块位置和下一页的起点"""
+        start = 0 if offset is None else bisect.bisect_left(self._keys, _id_key(normalize_id(offset)))
+        if query_filter is None:
+            positions = np.arange(start, min(start + limit + 1, len(self.ids)))
+        else:
+            positions = np.flatnonzero(self._filter_mask(query_filter)[start:])[:limit + 1] + start
+        next_offset = self.ids[positions[limit]] if len(positions) > limit else None
+        return positions[:limit], next_offset
+
+    def retrieve(self, ids: Iterable[PointId]) -> list[int]:
+        """按id查找知识块位置，不存在的id被忽略"""
+        positions = (self._positions.get(normalize_id(point_id)) for point_id in ids)
+        return [position for position in positions if position is not None]
+
+    def records(self, positions: Iterable[int], with_vectors: bool = False) -> list[models.Record]:
+        return [models.Record(id=self.ids[i], payload=self.payloads[i],
+                              vector=self.matrix[self.rows[i]].tolist() if with_vectors else None)
+                for i in positions]
+
+
+_EMPTY = _Snapshot([], [], np.empty(0, dtype=np.int64), None)
+
+
+class NumpyStore:
+    """一个目录中的知识块，向量维度为0时只保存 payload。线程安全，多个进程可以同时读写同一个目录"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db_path = os.path.join(path, "points.db")
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._snapshot: Optional[_Snapshot] = None
+        self._version = None
+
+    def _connect(self, create: bool) -> Optional[sqlite3.Connection]:
+        """打开数据库，只读时目录不存在返回空，不会创建空的知识库目录"""
+        if self._conn is None:
+            if not create and not os.path.exists(self._db_path):
+                return None
+            self._conn = connect(self._db_path)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS points (id PRIMARY KEY, row INTEGER, payload TEXT NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        return self._conn
+
+    def snapshot(self) -> _Snapshot:
+        """最新数据的快照，其它连接写入后重新加载"""
+        with self._lock:
+            conn = self._connect(create=False)
+            if conn is None:
+                return _EMPTY
+            # data_version 在其它连接（包括其它进程）提交后变化，本连接的写入在提交后清除快照
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if self._snapshot is None or version != self._version:
+                conn.execute("BEGIN")
+                try:
+                    self._snapshot = self._load(conn)
+                finally:
+                    conn.execute("COMMIT")
+                self._version = version
+            return self._snapshot
+
+    def _load(self, conn: sqlite3.Connection) -> _Snapshot:
+        meta = self._meta(conn)
+        points = sorted(conn.execute("SELECT id, row, payload FROM points").fetchall(), key=lambda p: _id_key(p[0]))
+        rows = np.array([p["row"] or 0 for p in points], dtype=np.int64)
+        matrix = None
+        if meta["dim"] and meta["rows"]:
+            matrix = np.memmap(os.path.join(self.path, meta["file"]), dtype=np.float32, mode="r",
+                               shape=(meta["rows"], meta["dim"]))
+        return _Snapshot([p["id"] for p in points], [json.loads(p["payload"]) for p in points], rows, matrix)
+
+    @staticmethod
+    def _meta(conn: sqlite3.Connection) -> dict[str, Any]:
+        meta = {"dim": None, "rows": 0, "file": None, "generation": 0}
+        meta.update(conn.execute("SELECT key, value FROM meta").fetchall())
+        return meta
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """写事务，BEGIN IMMEDIATE 同时阻止其它进程写入"""
+        with self._lock:
+            conn = self._connect(create=True)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                self._snapshot = None
+
+    def upsert(self, ids: list[PointId], vectors: Optional[list[list[float]]], payloads: list[dict]):
+        """
+        写入知识块，相同id覆盖
+        Args:
+            ids: 知识块id
+            vectors: 向量，只保存 payload 时为空
+            payloads: 知识块的 payload
+        """
+        if not ids:
+            return
+        # 同一批中重复的id以最后一个为准
+        latest = {normalize_id(point_id): i for i, point_id in enumerate(ids)}
+        order = list(latest.values())
+        stale_file = None
+        with self._transaction() as conn:
+            meta = self._meta(conn)
+            rows = [None] * len(order)
+            if vectors is not None:
+                matrix = np.asarray(vectors, dtype=np.float32)[order]
+                if meta["dim"] is None:
+                    meta["dim"] = matrix.shape[1]
+                    meta["file"] = "vectors.0.f32"
+                elif matrix.shape[1] != meta["dim"]:
+                    raise ValueError(f"vector size {matrix.shape[1]} differs from {meta['dim']} of {self.path}")
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                matrix /= np.where(norms == 0, 1, norms)
+                with open(os.path.join(self.path, meta["file"]), "ab") as f:
+                    # 上次写入失败时文件末尾可能有未提交的向量，从提交的行数处覆盖
+                    f.truncate(meta["rows"] * meta["dim"] * 4)
+                    f.write(matrix.tobytes())
+                rows = list(range(meta["rows"], meta["rows"] + len(order)))
+                meta["rows"] += len(order)
+            conn.executemany("INSERT INTO points (id, row, payload) VALUES (?, ?, ?) "
+                             "ON CONFLICT (id) DO UPDATE SET row = excluded.row, payload = excluded.payload",
+                             [(point_id, row, json.dumps(payloads[i], ensure_ascii=False))
+                              for (point_id, i), row in zip(latest.items(), rows)])
+            stale_file = self._maybe_compact(conn, meta)
+            self._save_meta(conn, meta)
+        self._remove_file(stale_file)
+
+    def delete(self, ids: list[PointId]):
+        """按id删除知识块"""
+        stale_file = None
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM points WHERE id = ?", [(normalize_id(point_id),) for point_id in ids])
+            meta = self._meta(conn)
+            stale_file = self._maybe_compact(conn, meta)
+            self._save_meta(conn, meta)
+        self._remove_file(stale_file)
+
+    def delete_where(self, query_filter: models.Filter):
+        """删除符合过滤条件的知识块"""
+        if not os.path.exists(self._db_path):
+            return
+        stale_file = None
+        with self._transaction() as conn:
+            snapshot = self._load(conn)
+            conn.executemany("DELETE FROM points WHERE id = ?",
+                             [(snapshot.ids[i],) for i in snapshot.select(query_filter)])
+            meta = self._meta(conn)
+            stale_file = self._maybe_compact(conn, meta)
+            self._save_meta(conn, meta)
+        self._remove_file(stale_file)
+
+    def set_payload(self, updates: dict[PointId, dict[str, Any]]):
+        """替换知识块 payload 中的字段，不修改向量"""
+        with self._transaction() as conn:
+            for point_id, fields in updates.items():
+                for key, value in fields.items():
+                    conn.execute("UPDATE points SET payload = json_set(payload, ?, json(?)) WHERE id = ?",
+                                 (f'$."{key}"', json.dumps(value, ensure_ascii=False), normalize_id(point_id)))
+
+    def _maybe_compact(self, conn: sqlite3.Connection, meta: dict[str, Any]) -> Optional[str]:
+        """失效的向量过多时将仍被引用的向量重写到新文件，返回需要删除的旧文件"""
+        if not meta["dim"] or not meta["rows"]:
+            return None
+        live = conn.execute("SELECT id, row FROM points ORDER BY row").fetchall()
+        if meta["rows"] - len(live) <= meta["rows"] * NumpyKBConfig.COMPACT_RATIO:
+            return None
+        old_file = meta["file"]
+        meta["generation"] += 1
+        meta["file"] = f"vectors.{meta['generation']}.f32"
+        old = np.memmap(os.path.join(self.path, old_file), dtype=np.float32, mode="r",
+                        shape=(meta["rows"], meta["dim"]))
+        with open(os.path.join(self.path, meta["file"]), "wb") as f:
+            f.write(np.ascontiguousarray(old[[p["row"] for p in live]]).tobytes())
+        del old
+        conn.executemany("UPDATE points SET row = ? WHERE id = ?", [(i, p["id"]) for i, p in enumerate(live)])
+        logger.info(f"Compacted {self.path}: {meta['rows']} -> {len(live)} vectors")
+        meta["rows"] = len(live)
+        return old_file
+
+    @staticmethod
+    def _save_meta(conn: sqlite3.Connection, meta: dict[str, Any]):
+        conn.executemany("INSERT INTO meta (key, value) VALUES (?, ?) "
+                         "ON CONFLICT (key) DO UPDATE SET value = excluded.value", meta.items())
+
+    def _remove_file(self, name: Optional[str]):
+        # 其它进程中已经映射的旧文件在删除后仍然可以读取
+        if name:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.path, name))
+
+
+__stores: dict[str, NumpyStore] = {}
+__stores_lock = threading.Lock()
+
+
+def get_store(name: str) -> NumpyStore:
+    """获取名称对应的存储，同一进程中共用一个实例"""
+    with __stores_lock:
+        if name not in __stores:
+            __stores[name] = NumpyStore(os.path.join(NumpyKBConfig.DATA_PATH, quote(name, safe="")))
+        return __stores[name]
+
+
+class NumpyKB(BaseVectorKB):
+    """numpy 后端的知识库，方法与 `VectorKB` 相同"""
+
+    backend = Backend.NUMPY
+
+    def __init__(self, kb_id: str):
+        super().__init__(kb_id)
+        self._store = get_store(self.kb_id)
+        self._profile = get_profile_store().get(self.kb_id) or StorageProfile(backend=Backend.NUMPY)
+
+    def is_empty(self) -> bool:
+        return len(self._store.snapshot()) == 0
+
+    def apply_profile(self, profile: StorageProfile):
+        """保存知识库的存储配置，numpy 后端没有需要更新的存储参数"""
+        get_profile_store().put(self.kb_id, profile)
+        self._profile = profile
+
+    def add_kb_splits(self, docs: list[Document], ids: list[str] = None):
+        if not docs:
+            return
+        with self._timer("embed_chunks"):
+            ems = self._get_embedding().embed_batch([doc.page_content for doc in docs])
+        self._write(docs, ids, ems)
+
+    async def aadd_kb_splits(self, docs: list[Document], ids: list[str] = None):
+        if not docs:
+            return
+        with self._timer("embed_chunks"):
+            ems = await self._get_embedding().aembed_batch([doc.page_content for doc in docs])
+        await asyncio.to_thread(self._write, docs, ids, ems)
+
+    def _write(self, docs: list[Document], ids: Optional[list[str]], ems):
+        ids = ids or [str(uuid.uuid4()) for _ in docs]
+        with self._timer("upsert"):
+            self._store.upsert(ids, [em.embedding for em in ems], [vars(doc) for doc in docs])
+        get_generation().bump(self.kb_id)
+
+    def remove_kb_split(self, ids: Union[str, list[str]]) -> bool:
+        self._store.delete_where(self._file_selector(ids).filter)
+        get_generation().bump(self.kb_id)
+        return True
+
+    def remove_points(self, ids: list[Union[str, int]]) -> bool:
+        """按知识块id删除知识块"""
+        if ids:
+            self._store.delete(ids)
+            get_generation().bump(self.kb_id)
+        return True
+
+    def update_metadata(self, metadata: dict[Union[str, int], dict[str, Any]]):
+        """替换知识块的元数据，不重新向量化"""
+        if not metadata:
+            return
+        self._store.set_payload({point_id: {DocxSchema.METADATA: value} for point_id, value in metadata.items()})
+        get_generation().bump(self.kb_id)
+
+    def file_points(self, file_id: str, batch_size: int = 256) -> list[models.Record]:
+        """获取文档的全部知识块，不包含向量"""
+        snapshot = self._store.snapshot()
+        return snapshot.records(snapshot.select(self._file_selector(file_id).filter))
+
+    def scroll(self, scroll_filter: models.Filter = None, limit: int = 10, offset: PointId = None,
+               with_payload: bool = True, with_vectors: bool = False) -> tuple[list[models.Record], Any]:
+        """与 Qdrant 的 scroll 相同，按id顺序分页"""
+        with self._timer("scroll"):
+            snapshot = self._store.snapshot()
+            positions, next_offset = snapshot.scroll(scroll_filter, limit, offset)
+            return snapshot.records(positions, with_vectors=with_vectors), next_offset
+
+    async def ascroll(self, *args, **kwargs):
+        """异步版本的 `scroll`"""
+        return await asyncio.to_thread(self.scroll, *args, **kwargs)
+
+    def filter_by(self, *arg, filter_condition: Union[dict[str, Any], models.Filter] = None, limit=3, offset=0,
+                  **kwargs):
+        records, _ = self.scroll(scroll_filter=self._build_query_filter(filter_condition), limit=limit,
+                                 offset=offset or None, with_vectors=kwargs.get("with_vectors", False))
+        return self._to_documents(records)
+
+    def scroll_page(self, filter_condition: Union[dict[str, Any], models.Filter] = None, limit=10, offset=None,
+                    with_vectors=False) -> tuple[list[models.Record], Any]:
+        """按游标分页遍历知识库，见 `VectorKB.scroll_page`"""
+        return self.scroll(scroll_filter=self._build_query_filter(filter_condition), limit=limit, offset=offset,
+                           with_vectors=with_vectors)
+
+    async def ascroll_page(self, filter_condition: Union[dict[str, Any], models.Filter] = None, limit=10,
+                           offset=None, with_vectors=False) -> tuple[list[models.Record], Any]:
+        """异步版本的 `scroll_page`"""
+        return await asyncio.to_thread(self.scroll_page, filter_condition, limit, offset, with_vectors)
+
+    def query_doc(self, *args, query: str, filter_condition: dict[str, Any] = None, limit=3,
+                  **kwargs) -> list[Document]:
+        return self._search([self._embed_query(query)], [filter_condition], [limit])[0]
+
+    async def aquery_doc(self, *args, query: str, filter_condition: dict[str, Any] = None, limit=3,
+                         **kwargs) -> list[Document]:
+        vector = await self._aembed_query(query)
+        return (await asyncio.to_thread(self._search, [vector], [filter_condition], [limit]))[0]
+
+    def query_batch(self, queries: list[str], filter_conditions: list[dict[str, Any]] = None,
+                    limits: list[int] = None) -> list[list[Document]]:
+        """批量查询，所有查询一次向量化，并通过一次矩阵乘法完成"""
+        return self._search(self._embed_queries(queries), filter_conditions, limits)
+
+    async def aquery_batch(self, queries: list[str], filter_conditions: list[dict[str, Any]] = None,
+                           limits: list[int] = None) -> list[list[Document]]:
+        """异步版本的 `query_batch`"""
+        vectors = await self._aembed_queries(queries)
+        return await asyncio.to_thread(self._search, vectors, filter_conditions, limits)
+
+    def query_groups(self, query: str, group_by: str, filter_condition: dict[str, Any] = None, limit=3,
+                     group_size=1, **kwargs) -> list[tuple[str, list[Document]]]:
+        """分组查询，见 `VectorKB.query_groups`"""
+        return self._search_groups(self._embed_query(query), group_by, filter_condition, limit, group_size)
+
+    async def aquery_groups(self, query: str, group_by: str, filter_condition: dict[str, Any] = None, limit=3,
+                            group_size=1, **kwargs) -> list[tuple[str, list[Document]]]:
+        """异步版本的 `query_groups`"""
+        vector = await self._aembed_query(query)
+        return await asyncio.to_thread(self._search_groups, vector, group_by, filter_condition, limit, group_size)
+
+    def _search(self, vectors: list[list[float]], filter_conditions: list[dict[str, Any]] = None,
+                limits: list[int] = None) -> list[list[Document]]:
+        with self._timer("search" if len(vectors) == 1 else "search_batch"):
+            snapshot = self._store.snapshot()
+            if len(snapshot) == 0:
+                return [[] for _ in vectors]
+            filter_conditions = filter_conditions or [None] * len(vectors)
+            limits = limits or [3] * len(vectors)
+            candidates = [snapshot.select(self._build_query_filter(condition)) for condition in filter_conditions]
+            results = snapshot.search(self._normalize(vectors), candidates, limits)
+            return [self._to_documents(snapshot.records(positions)) for positions, _ in results]
+
+    def _search_groups(self, vector: list[float], group_by: str, filter_condition: Optional[dict[str, Any]],
+                       limit: int, group_size: int) -> list[tuple[str, list[Document]]]:
+        with self._timer("search_groups"):
+            snapshot = self._store.snapshot()
+            if len(snapshot) == 0:
+                return []
+            candidates = snapshot.select(self._build_query_filter(filter_condition))
+            [(positions, _)] = snapshot.search(self._normalize([vector]), [candidates], [None])
+            path = [DocxSchema.METADATA, group_by]
+            groups: dict[Any, list[int]] = {}
+            for position in positions:
+                for value in _values_at(snapshot.payloads[position], path):
+                    if value in groups:
+                        if len(groups[value]) < group_size:
+                            groups[value].append(position)
+                    elif len(groups) < limit:
+                        groups[value] = [position]
+                if len(groups) == limit and all(len(group) == group_size for group in groups.values()):
+                    break
+            return [(value, self._to_documents(snapshot.records(group))) for value, group in groups.items()]
+
+    @staticmethod
+    def _normalize(vectors: list[list[float]]) -> np.ndarray:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+
+class NumpyDocRetriever(ParentRetriever, NumpyKB):
+    """numpy 知识库的父子文档检索，段落保存在知识库名称加后缀的只有 payload 的存储中"""
+
+    def __init__(self, vector_kb: NumpyKB):
+        super().__init__(vector_kb)
+        self._sections = get_store(self.sections_id)
+
+    def _save_sections(self, file_id: str, sections: List[Document]):
+        self._sections.upsert([doc.metadata[DocxSchema.PARENT_ID] for doc in sections], None,
+                              [vars(doc) for doc in sections])
+        self._sections.delete_where(self._stale_sections_selector(file_id, sections).filter)
+
+    def remove_sections(self, file_ids: list[str]):
+        self._sections.delete_where(self._file_selector(file_ids).filter)
+
+    async def aremove_sections(self, file_ids: list[str]):
+        await asyncio.to_thread(self.remove_sections, file_ids)
+
+    def _retrieve_sections(self, parent_ids: List[str]) -> list:
+        snapshot = self._sections.snapshot()
+        return snapshot.records(snapshot.retrieve(parent_ids))
+
+    async def _aretrieve_sections(self, parent_ids: List[str]) -> list:
+        # 加载快照需要读取数据库和映射向量文件，不在事件循环中执行
+        return await asyncio.to_thread(self._retrieve_sections, parent_ids)
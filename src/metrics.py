@@ -0,0 +1,190 @@
+"""
+进程内的运行指标，包含计数器和直方图，供各模块记录耗时、命中率等数据。
+指标可以导出为可 JSON 序列化的快照，多个进程的快照合并后按 Prometheus 文本格式输出
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterable
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+"""默认的直方图分桶（秒）"""
+
+
+class _Metric:
+    type: str
+    """Prometheus 指标类型"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: dict[tuple, _Metric] = {}
+        REGISTRY.append(self)
+
+    def labels(self, **labels):
+        """按标签取得子指标，标签必须和声明时的 `labelnames` 一致"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self) -> Iterable[tuple[tuple, "_Metric"]]:
+        """返回(标签值, 子指标)，没有标签的指标返回自身"""
+        if not self.labelnames:
+            return [((), self)]
+        return list(self._children.items())
+
+    def dump(self) -> Any:
+        """当前的值，可以 JSON 序列化"""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """单调递增的计数器"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), register=True):
+        self.value = 0.
+        if register:
+            super().__init__(name, documentation, labelnames)
+        else:
+            self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dump(self) -> float:
+        return self.value
+
+    def _new_child(self):
+        return Counter(self.name, self.documentation, register=False)
+
+
+class Histogram(_Metric):
+    """累积分桶的直方图，同时记录总数和总和"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS, register=True):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        if register:
+            super().__init__(name, documentation, labelnames)
+        else:
+            self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        """记录代码块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def dump(self) -> dict[str, Any]:
+        """各分桶（不累积，最后一个为超出所有分桶的数量）的数量和总和"""
+        with self._lock:
+            return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum}
+
+    def _new_child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets, register=False)
+
+
+REGISTRY: list[_Metric] = []
+"""当前进程中注册的所有指标"""
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+"""Prometheus 文本格式的内容类型"""
+
+
+def snapshot(registry: Iterable[_Metric] = None) -> dict[str, dict[str, Any]]:
+    """
+    导出指标的快照
+    Returns:
+        {指标名称: {"type", "help", "labels": 标签名称, "samples": [[标签值, 值], ...]}}
+    """
+    res = {}
+    for metric in REGISTRY if registry is None else registry:
+        samples = [[list(key), child.dump()] for key, child in metric.samples()]
+        res[metric.name] = {"type": metric.type, "help": metric.documentation, "labels": list(metric.labelnames),
+                            "samples": samples}
+    return res
+
+
+def merge(*snapshots: dict[str, dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    """合并多个进程的快照，相同标签的计数器相加，直方图按分桶相加"""
+    res: dict[str, dict[str, Any]] = {}
+    for snap in snapshots:
+        for name, metric in snap.items():
+            target = res.setdefault(name, {**metric, "samples": {}})
+            for key, value in metric["samples"]:
+                key = tuple(key)
+                current = target["samples"].get(key)
+                if metric["type"] == "counter":
+                    target["samples"][key] = (current or 0.) + value
+                elif current is None:
+                    target["samples"][key] = {**value, "counts": list(value["counts"])}
+                elif current["buckets"] == value["buckets"]:
+                    current["counts"] = [a + b for a, b in zip(current["counts"], value["counts"])]
+                    current["sum"] += value["sum"]
+    for metric in res.values():
+        metric["samples"] = [[list(key), value] for key, value in metric["samples"].items()]
+    return res
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def render(snap: dict[str, dict[str, Any]]) -> str:
+    """按 Prometheus 文本格式输出快照"""
+    lines = []
+    for name, metric in sorted(snap.items()):
+        help_text = metric["help"].replace("\\", r"\\").replace("\n", r"\n")
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        names = metric["labels"]
+        for key, value in sorted(metric["samples"], key=lambda sample: sample[0]):
+            if metric["type"] == "counter":
+                lines.append(f"{name}{_labels(names, key)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip([*value["buckets"], float("inf")], value["counts"]):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{name}_bucket{_labels(names, key, le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(names, key)} {_number(value['sum'])}")
+            lines.append(f"{name}_count{_labels(names, key)} {cumulative}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,157 @@
+"""
+生成测试和基准测试使用的 docx 文档，按形态和大小参数化。标题级别由字号区分，与加载器的规则一致：
+`H{n}` 样式的字号随级别递减，`Caption9` 样式为小字号的图题，正文段落没有字号。
+
+测试在 tests 目录中运行时可以直接导入，基准测试脚本运行时需要将 tests 目录加入 `PYTHONPATH`。
+"""
+import io
+import struct
+import zlib
+from typing import IO, Callable, Optional, Union
+
+Target = Union[str, IO[bytes]]
+"""文件路径或者可写的二进制文件对象"""
+
+SIZES = {"small": 1, "medium": 4, "large": 16}
+"""文档大小的倍数"""
+
+
+def png(seed: int = 0, size: int = 4) -> bytes:
+    """纯色的 PNG 图片，颜色随 seed 变化，seed 相同时内容相同"""
+    color = bytes(((seed * 37 + 255) % 256, (seed * 101) % 256, (seed * 173) % 256))
+    raw = b"".join(b"\x00" + color * size for _ in range(size))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+
+def new_document(levels: int = 2):
+    """创建文档及 H1..Hn 标题样式和 Caption9 图题样式"""
+    import docx
+    from docx.shared import Pt
+    d = docx.Document()
+    for level in range(1, levels + 1):
+        d.styles.add_style(f"H{level}", 1).font.size = Pt(32 - 2 * level)
+    d.styles.add_style("Caption9", 1).font.size = Pt(9)
+    return d
+
+
+def add_picture(d, seed: int = 0):
+    d.add_paragraph().add_run().add_picture(io.BytesIO(png(seed)))
+
+
+def make_sections(target: Target, sections: int, paragraphs: int = 8, tables: int = 1, title: str = "",
+                  words: Optional[Callable[[int], str]] = None):
+    """
+    两级标题、正文段落和表格组成的常规文档
+    Args:
+        target: 保存位置
+        sections: 一级标题数量，每个一级标题下两个二级标题
+        paragraphs: 每个二级标题下的段落数量
+        tables: 每个二级标题下的表格数量
+        title: 一级标题的前缀，用于区分不同的文档
+        words: 返回指定数量随机词语的函数，指定时标题和正文使用随机内容，否则使用固定内容
+    """
+    d = new_document(2)
+    for s in range(sections):
+        d.add_paragraph(f"{title}第{s}章" + (f" {words(1)}" if words else ""), style="H1")
+        for k in range(2):
+            d.add_paragraph(f"第{s}.{k}节" + (f" {words(1)}" if words else ""), style="H2")
+            for j in range(paragraphs):
+                d.add_paragraph(words(12) + "。" if words else f"第{s}章第{k}节的第{j}段。" * 10)
+            for _ in range(tables):
+                table = d.add_table(rows=4, cols=4)
+                for i, row in enumerate(table.rows):
+                    for c, cell in enumerate(row.cells):
+                        cell.text = f"单元格{i}-{c}"
+    d.save(target)
+
+
+def make_deep_headings(target: Target, scale: int = 1, depth: int = 8):
+    """多级标题：每个分支逐级嵌套到 depth 级，叶子下若干正文段落，知识块的标题路径很长"""
+    d = new_document(depth)
+    for s in range(20 * scale):
+        for level in range(1, depth + 1):
+            d.add_paragraph(f"第{s}部分第{level}级标题", style=f"H{level}")
+            if level >= depth - 1:
+                for j in range(3):
+                    d.add_paragraph(f"第{s}部分第{level}级的第{j}段正文。" * 8)
+    d.save(target)
+
+
+def make_huge_tables(target: Target, scale: int = 1, tables: int = 4, cols: int = 8):
+    """大表格：少量标题，每个标题下一张行数很多的表格"""
+    d = new_document(1)
+    for t in range(tables):
+        d.add_paragraph(f"第{t}张表", style="H1")
+        d.add_paragraph(f"第{t}张表的说明。")
+        table = d.add_table(rows=250 * scale, cols=cols)
+        for i, row in enumerate(table.rows):
+            for c, cell in enumerate(row.cells):
+                cell.text = f"{t}-{i}-{c}"
+    d.save(target)
+
+
+def make_many_images(target: Target, scale: int = 1):
+    """大量图片：每张图片后跟以“图”开头的图题，图片内容各不相同"""
+    d = new_document(2)
+    for s in range(10 * scale):
+        d.add_paragraph(f"第{s}章", style="H1")
+        for k in range(10):
+            n = s * 10 + k
+            add_picture(d, seed=n)
+            d.add_paragraph(f"图{n} 示意图", style="Caption9")
+            d.add_paragraph(f"图{n}的说明文字。")
+    d.save(target)
+
+
+def make_edge_cases(target: Target, scale: int = 1):
+    """
+    加载器的边界情况：标题前的正文、空段落、同名段落、合并单元格、图片及其图题、图片和图题之间的表格。
+    所有图片内容相同，每个 scale 产生 25 个知识块
+    """
+    d = new_document(2)
+    d.add_paragraph("前言")
+    for s in range(3 * scale):
+        d.add_paragraph(f"第{s}章", style="H1")
+        d.add_paragraph("")
+        d.add_paragraph(f"第{s}.0节", style="H2")
+        d.add_paragraph("正文")
+        d.add_paragraph("正文")
+        add_picture(d)
+        d.add_paragraph(f"图{s} 示意图", style="Caption9")
+        table = d.add_table(rows=3, cols=3)
+        for i, row in enumerate(table.rows):
+            for j, cell in enumerate(row.cells):
+                cell.text = f"{i}{j}"
+        table.cell(0, 0).merge(table.cell(0, 1))
+        table.cell(1, 2).merge(table.cell(2, 2))
+        d.add_paragraph(f"第{s}.1节", style="H2")
+        add_picture(d)
+        d.add_table(rows=1, cols=1).cell(0, 0).text = "图片和标题之间的表格"
+        d.add_paragraph(f"图{s}-1 示意图", style="Caption9")
+    d.save(target)
+
+
+SHAPES: dict[str, Callable[[Target, int], None]] = {
+    "sections": lambda target, scale: make_sections(target, sections=50 * scale),
+    "deep-headings": make_deep_headings,
+    "huge-tables": make_huge_tables,
+    "many-images": make_many_images,
+    "edge-cases": make_edge_cases,
+}
+"""文档形态，参数为保存位置和大小的倍数"""
+
+
+def make(shape: str, target: Target, size: Union[str, int] = "small"):
+    """
+    按形态和大小生成文档
+    Args:
+        shape: `SHAPES` 中的形态
+        target: 保存位置
+        size: `SIZES` 中的大小或者倍数
+    """
+    SHAPES[shape](target, SIZES[size] if isinstance(size, str) else size)
@@ -1,6 +1,10 @@
+import asyncio
+import functools
 from unittest import TestCase
 
-from kb.doc_retriever import get_doc_kb_by_id
+from kb.doc_retriever import DocRetriever, aget_doc_kb_by_id, get_doc_kb_by_id, merge_chunks
+from kb.kb_config import RetrieverConfig
+from kb.kb_core import VectorKB, aget_kb_by_id, get_kb_by_id
 
 
 class Test(TestCase):
@@ -8,3 +12,32 @@ class Test(TestCase):
         kb = get_doc_kb_by_id('Hello;bge-m3')
         res = kb.query_doc(query="长沙理工大学23年就业数据")
         self.assertIsNotNone(res)
+
+    def test_aget_kb_by_id(self):
+        """异步获取与同步获取的是同一个已注册的实例"""
+        kb = asyncio.run(aget_kb_by_id('Async;bge-m3'))
+        self.assertIs(get_kb_by_id('Async;bge-m3'), kb)
+        self.assertIs(kb, asyncio.run(aget_kb_by_id('Async;bge-m3')))
+        doc_kb = asyncio.run(aget_doc_kb_by_id('Async;bge-m3'))
+        self.assertIsInstance(doc_kb, DocRetriever)
+        self.assertIs(get_doc_kb_by_id('Async;bge-m3'), doc_kb)
+
+    def test_merge_chunks(self):
+        """与逐个合并的结果相同"""
+        for contents in (["# 标题\n第1段", "# 标题\n第2段", "# 标题\n第3段"],
+                         ["# 标题\n正文", "# 标题\n正文", "# 标题\n正文\n续"],
+                         ["# 标题\n正文", "# 其它\n正文"],
+                         ["唯一"]):
+            self.assertEqual(functools.reduce(DocRetriever.merge_with_common_prefix, contents),
+                             merge_chunks(contents))
+
+    def test_overfetch(self):
+        """多取倍数随重复程度调整，不超过上限"""
+        kb = DocRetriever(VectorKB('Hello;bge-m3'))
+        self.assertEqual(9, kb._fetch_size(3))
+        for _ in range(50):
+            kb._observe(chunks=9, parents=9)
+        self.assertEqual(3, kb._fetch_size(3))
+        for _ in range(50):
+            kb._observe(chunks=100, parents=1)
+        self.assertEqual(RetrieverConfig.MAX_OVERFETCH * 3, kb._fetch_size(3))
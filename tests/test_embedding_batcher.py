@@ -0,0 +1,54 @@
+import asyncio
+from unittest import TestCase
+
+from openai.types.embedding import Embedding
+
+from kb.embedding.kb_embedding import EmbeddingModel
+from kb.embedding.embedding_batcher import CoalescingEmbedding
+
+
+class CountingEmbedding(EmbeddingModel):
+    """按文本长度生成向量并记录请求"""
+
+    def __init__(self):
+        super().__init__(size=2)
+        self.requests: list[list[str]] = []
+
+    def embed(self, query: str) -> Embedding:
+        return self.embed_batch([query])[0]
+
+    def embed_batch(self, texts: list[str]) -> list[Embedding]:
+        self.requests.append(texts)
+        return [Embedding(embedding=[len(text), 1.], index=i, object="embedding") for i, text in enumerate(texts)]
+
+
+class TestCoalescingEmbedding(TestCase):
+
+    def setUp(self):
+        self.model = CountingEmbedding()
+
+    def test_coalesce(self):
+        em = CoalescingEmbedding(self.model, model_uid="counting", max_wait_ms=50, max_batch=100)
+
+        async def run():
+            return await asyncio.gather(*[em.aembed("x" * i) for i in range(10)])
+
+        res = asyncio.run(run())
+        self.assertEqual(1, len(self.model.requests))
+        self.assertEqual([float(i) for i in range(10)], [r.embedding[0] for r in res])
+
+    def test_max_batch(self):
+        em = CoalescingEmbedding(self.model, model_uid="counting", max_wait_ms=1000, max_batch=4)
+
+        async def run():
+            return await asyncio.gather(*[em.aembed_batch(["a", "bb"]) for _ in range(4)])
+
+        res = asyncio.run(asyncio.wait_for(run(), timeout=0.5))
+        self.assertEqual([4, 4], [len(r) for r in self.model.requests])
+        self.assertEqual([[0, 1]] * 4, [[e.index for e in r] for r in res])
+
+    def test_error(self):
+        em = CoalescingEmbedding(self.model, model_uid="counting", max_wait_ms=1, max_batch=4)
+        self.model.embed_batch = lambda texts: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            asyncio.run(em.aembed("a"))
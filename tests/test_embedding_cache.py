@@ -0,0 +1,79 @@
+import asyncio
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from openai.types.embedding import Embedding
+
+from kb.embedding.embedding_cache import CachedEmbedding
+from kb.embedding.kb_embedding import EmbeddingModel
+
+
+class CountingEmbedding(EmbeddingModel):
+    """按文本长度生成向量并记录请求次数"""
+
+    def __init__(self):
+        super().__init__(size=4)
+        self.requests: list[list[str]] = []
+
+    def embed(self, query: str) -> Embedding:
+        return self.embed_batch([query])[0]
+
+    def embed_batch(self, texts: list[str]) -> list[Embedding]:
+        self.requests.append(texts)
+        return [Embedding(embedding=[len(text), 1., 0., 0.5], index=i, object="embedding")
+                for i, text in enumerate(texts)]
+
+
+class TestCachedEmbedding(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.model = CountingEmbedding()
+        self.cache = CachedEmbedding(self.model, model_uid="counting",
+                                     path=os.path.join(self.tmp.name, "cache.db"), max_items=10)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_embed_batch(self):
+        res = self.cache.embed_batch(["a", "bb", "a"])
+        self.assertEqual([["a", "bb"]], self.model.requests)
+        self.assertEqual([1., 2., 1.], [em.embedding[0] for em in res])
+        res = self.cache.embed_batch(["bb", "ccc"])
+        self.assertEqual(["ccc"], self.model.requests[-1])
+        self.assertEqual([2., 3.], [em.embedding[0] for em in res])
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(4, self.cache.misses)
+
+    def test_aembed_batch(self):
+        threads = []
+        lookup, store = self.cache._lookup, self.cache._store
+
+        def record(fn):
+            def wrapper(*args):
+                threads.append(threading.get_ident())
+                return fn(*args)
+            return wrapper
+
+        self.cache._lookup, self.cache._store = record(lookup), record(store)
+        res = asyncio.run(self.cache.aembed_batch(["a", "bb", "a"]))
+        self.assertEqual([1., 2., 1.], [em.embedding[0] for em in res])
+        self.assertEqual([2., 3.], [em.embedding[0] for em in asyncio.run(self.cache.aembed_batch(["bb", "ccc"]))])
+        self.assertEqual([["a", "bb"], ["ccc"]], self.model.requests)
+        # 缓存的读写都不在事件循环所在的线程中执行
+        self.assertEqual(4, len(threads))
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_persistent(self):
+        self.cache.embed("hello")
+        cache = CachedEmbedding(self.model, model_uid="counting", path=self.cache._conn.execute(
+            "PRAGMA database_list").fetchone()[2])
+        self.assertEqual(5., cache.embed("hello").embedding[0])
+        self.assertEqual(1, len(self.model.requests))
+
+    def test_evict(self):
+        self.cache.embed_batch([str(i) for i in range(11)])
+        self.assertLessEqual(self.cache._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0], 10)
+        self.assertEqual(2., self.cache.embed("10").embedding[0])
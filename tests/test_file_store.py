@@ -0,0 +1,168 @@
+import hashlib
+import os
+import tempfile
+from unittest import TestCase
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from kb.file.file_excep import FileNotFound, FileDuplicateException
+from kb.file.file_service import SavedFile, file_range_response
+from kb.file.file_store import FileStore
+from kb.job.job_queue import JobQueue, JobState
+from kb.kb_config import UploadConfig
+from kb.kb_sqlite import connect
+
+
+class TestFileStore(TestCase):
+    content = b"hello world"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.upload_path = UploadConfig.UPLOAD_SAVING_PATH
+        UploadConfig.UPLOAD_SAVING_PATH = self.tmp.name
+        self.jobs = JobQueue(os.path.join(self.tmp.name, "jobs.db"))
+        self.store = FileStore(os.path.join(self.tmp.name, "files.db"), jobs=self.jobs)
+
+    def tearDown(self):
+        UploadConfig.UPLOAD_SAVING_PATH = self.upload_path
+        self.tmp.cleanup()
+
+    def save(self, content=None) -> SavedFile:
+        content = content or TestFileStore.content
+        part = tempfile.NamedTemporaryFile(dir=self.tmp.name, suffix=".part", delete=False)
+        part.write(content)
+        part.close()
+        return SavedFile(path=part.name, size=len(content), sha256=hashlib.sha256(content).hexdigest())
+
+    def upload(self, kb_id, filename="test.docx", content=None):
+        return self.store.add(kb_id=kb_id, saved=self.save(content), filename=filename)
+
+    def test_add_same_content(self):
+        record, created = self.upload("Hello;bge-m3")
+        self.assertTrue(created)
+        again, created = self.upload("Hello;bge-m3", filename="copy.docx")
+        self.assertFalse(created)
+        self.assertEqual(record.file_id, again.file_id)
+        self.assertEqual(["copy.docx"], again.aliases)
+        self.assertEqual(1, len([f for f in os.listdir(self.tmp.name) if f.endswith(".docx")]))
+
+    def test_add_other_kb(self):
+        record, _ = self.upload("Hello;bge-m3")
+        other, created = self.upload("Other;bge-m3")
+        self.assertTrue(created)
+        self.assertNotEqual(record.file_id, other.file_id)
+        self.assertEqual(record.path, other.path)
+
+    def test_release(self):
+        record, _ = self.upload("Hello;bge-m3")
+        other, _ = self.upload("Other;bge-m3")
+        self.assertTrue(self.store.release("Hello;bge-m3", record.file_id))
+        self.assertTrue(os.path.exists(other.path))
+        self.assertTrue(self.store.release("Other;bge-m3", other.file_id))
+        self.assertFalse(os.path.exists(other.path))
+        self.assertFalse(self.store.release("Other;bge-m3", other.file_id))
+        with self.assertRaises(FileNotFound):
+            self.store.get(other.file_id)
+
+    def test_replace(self):
+        record, _ = self.upload("Hello;bge-m3")
+        replaced, changed = self.store.replace("Hello;bge-m3", record.file_id, self.save(b"new"), "test_v2.docx")
+        self.assertTrue(changed)
+        self.assertEqual(record.file_id, replaced.file_id)
+        self.assertEqual(hashlib.sha256(b"new").hexdigest(), replaced.sha256)
+        self.assertEqual(["test_v2.docx"], replaced.aliases)
+        self.assertFalse(os.path.exists(record.path))
+        self.assertTrue(os.path.exists(replaced.path))
+        _, changed = self.store.replace("Hello;bge-m3", record.file_id, self.save(b"new"), "test.docx")
+        self.assertFalse(changed)
+        self.assertEqual(0, len([f for f in os.listdir(self.tmp.name) if f.endswith(".part")]))
+
+    def test_replace_while_job_pending(self):
+        """旧文件仍被未完成的任务使用时保留，任务结束后删除"""
+        record, _ = self.upload("Hello;bge-m3")
+        job = self.jobs.submit(kb_id="Hello;bge-m3", file_id=record.file_id, filename="test.docx",
+                               filepath=record.path)
+        self.store.replace("Hello;bge-m3", record.file_id, self.save(b"new"), "test.docx")
+        self.assertTrue(os.path.exists(record.path))
+        self.assertFalse(self.store.remove_unreferenced(record.path))
+        self.jobs.claim()
+        self.jobs.finish(job.job_id)
+        self.assertTrue(self.store.remove_unreferenced(record.path))
+        self.assertFalse(os.path.exists(record.path))
+
+    def test_replace_conflict(self):
+        record, _ = self.upload("Hello;bge-m3")
+        other, _ = self.upload("Hello;bge-m3", filename="other.docx", content=b"other")
+        with self.assertRaises(FileDuplicateException):
+            self.store.replace("Hello;bge-m3", record.file_id, self.save(b"other"), "other.docx")
+        with self.assertRaises(FileNotFound):
+            self.store.replace("Other;bge-m3", record.file_id, self.save(b"new"), "test.docx")
+        self.assertTrue(os.path.exists(record.path))
+        self.assertTrue(os.path.exists(other.path))
+
+    def test_list_and_status(self):
+        record, _ = self.upload("Hello;bge-m3")
+        self.upload("Hello;bge-m3", filename="copy.docx")
+        other, _ = self.upload("Hello;bge-m3", filename="other.docx", content=b"other")
+        self.upload("Other;bge-m3")
+        self.assertEqual(JobState.PENDING, record.status)
+        self.store.set_job(record.file_id, "job")
+        self.store.set_status(record.file_id, JobState.DONE, chunks=12)
+        self.store.set_status(record.file_id, JobState.RUNNING)
+        files, total = self.store.list("Hello;bge-m3")
+        self.assertEqual(2, total)
+        self.assertEqual([record.file_id, other.file_id], [f.file_id for f in files])
+        self.assertEqual((JobState.RUNNING, 12, ["copy.docx"]), (files[0].status, files[0].chunks, files[0].aliases))
+        files, total = self.store.list("Hello;bge-m3", offset=1, limit=1)
+        self.assertEqual((2, [other.file_id]), (total, [f.file_id for f in files]))
+
+    def test_migrate_status(self):
+        path = os.path.join(self.tmp.name, "old.db")
+        connect(path).execute("CREATE TABLE files (file_id TEXT PRIMARY KEY, kb_id TEXT NOT NULL, "
+                              "sha256 TEXT NOT NULL, filename TEXT NOT NULL, path TEXT NOT NULL, "
+                              "size INTEGER NOT NULL, job_id TEXT, created_at REAL NOT NULL, UNIQUE (kb_id, sha256))")
+        connect(path).execute("INSERT INTO files VALUES ('old', 'Hello;bge-m3', 'sha', 'a.docx', 'a.docx', 1, NULL, 0)")
+        record = FileStore(path).get("old")
+        self.assertEqual((JobState.DONE, None), (record.status, record.chunks))
+
+
+class TestFileRangeResponse(TestCase):
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, "test.docx")
+        with open(path, "wb") as f:
+            f.write(TestFileRangeResponse.content)
+        app = FastAPI()
+
+        @app.get("/file")
+        def get_file(request: Request):
+            return file_range_response(request, path, "test.docx", etag="sha")
+
+        self.client = TestClient(app)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_full(self):
+        resp = self.client.get("/file")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(TestFileRangeResponse.content, resp.content)
+        self.assertEqual('"sha"', resp.headers["etag"])
+        self.assertEqual("bytes", resp.headers["accept-ranges"])
+        self.assertEqual(304, self.client.get("/file", headers={"If-None-Match": '"sha"'}).status_code)
+
+    def test_range(self):
+        content = TestFileRangeResponse.content
+        resp = self.client.get("/file", headers={"Range": "bytes=10-19"})
+        self.assertEqual(206, resp.status_code)
+        self.assertEqual(content[10:20], resp.content)
+        self.assertEqual(f"bytes 10-19/{len(content)}", resp.headers["content-range"])
+        self.assertEqual(content[1000:], self.client.get("/file", headers={"Range": "bytes=1000-"}).content)
+        self.assertEqual(content[-24:], self.client.get("/file", headers={"Range": "bytes=-24"}).content)
+        self.assertEqual(416, self.client.get("/file", headers={"Range": "bytes=5000-"}).status_code)
+        # 文件已经变化时返回完整文件
+        resp = self.client.get("/file", headers={"Range": "bytes=10-19", "If-Range": '"old"'})
+        self.assertEqual((200, content), (resp.status_code, resp.content))
@@ -0,0 +1,65 @@
+import hashlib
+import os
+import tempfile
+from unittest import TestCase
+
+from fastapi.testclient import TestClient
+
+from kb.file.file_excep import FileNotFound
+from kb.file.image_store import ImageStore, get_image_store
+from kb.kb_config import DocxImageParserConfig
+
+
+class TestImageStore(TestCase):
+    blob = b"\x89PNG fake image"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = ImageStore(os.path.join(self.tmp.name, "img"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_save(self):
+        filename = self.store.save(TestImageStore.blob, "PNG")
+        self.assertEqual(f"{hashlib.sha256(TestImageStore.blob).hexdigest()}.png", filename)
+        # 相同内容只写入一次
+        self.assertEqual(filename, self.store.save(TestImageStore.blob, "png"))
+        self.assertEqual(1, len(self.store._pending))
+        self.store.flush()
+        self.assertEqual([filename], os.listdir(self.store.path))
+        with open(self.store.path_of(filename), "rb") as f:
+            self.assertEqual(TestImageStore.blob, f.read())
+        self.assertEqual(filename, self.store.save(TestImageStore.blob, "png"))
+        self.assertEqual(0, len(self.store._pending))
+
+    def test_path_of(self):
+        with self.assertRaises(FileNotFound):
+            self.store.path_of("missing.png")
+        with self.assertRaises(FileNotFound):
+            self.store.path_of("../files.db")
+
+
+class TestImageRouter(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.img_path = DocxImageParserConfig.IMG_SAVE_PATH
+        DocxImageParserConfig.IMG_SAVE_PATH = self.tmp.name
+
+    def tearDown(self):
+        DocxImageParserConfig.IMG_SAVE_PATH = self.img_path
+        self.tmp.cleanup()
+
+    def test_get_image(self):
+        from kb.kb_file import router
+        client = TestClient(router)
+        store = get_image_store()
+        filename = store.save(TestImageStore.blob)
+        store.flush()
+        resp = client.get(f"/file/img/{filename}")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(TestImageStore.blob, resp.content)
+        self.assertIn("immutable", resp.headers["cache-control"])
+        resp = client.get(f"/file/img/{filename}", headers={"If-None-Match": resp.headers["etag"]})
+        self.assertEqual(304, resp.status_code)
@@ -0,0 +1,96 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from kb.job.job_excep import JobNotFoundException, JobStateException
+from kb.job.job_queue import JobKind, JobQueue, JobState
+from kb.job.job_worker import heartbeat
+from kb.kb_sqlite import connect
+from kb.kb_config import JobConfig
+
+
+class TestJobQueue(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = JobQueue(os.path.join(self.tmp.name, "jobs.db"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def submit(self):
+        return self.queue.submit(kb_id="Hello;bge-m3", file_id="file", filename="test.docx", filepath="test.docx")
+
+    def test_claim(self):
+        job = self.submit()
+        claimed = self.queue.claim()
+        self.assertEqual(job.job_id, claimed.job_id)
+        self.assertEqual(claimed.state, JobState.RUNNING)
+        self.assertEqual(claimed.attempts, 1)
+        self.assertIsNone(self.queue.claim())
+
+    def test_progress_and_finish(self):
+        job = self.submit()
+        self.queue.claim()
+        self.queue.progress(job.job_id, chunks_done=3, chunks_total=10, parse_seconds=1.5, write_seconds=2)
+        self.assertEqual(self.queue.get(job.job_id).chunks_done, 3)
+        self.queue.finish(job.job_id)
+        job = self.queue.get(job.job_id)
+        self.assertEqual(job.state, JobState.DONE)
+        self.assertEqual(job.chunks_done, 10)
+        self.assertEqual(job.parse_seconds, 1.5)
+
+    def test_fail_keeps_progress(self):
+        job = self.submit()
+        for _ in range(JobConfig.MAX_ATTEMPTS):
+            self.queue.claim()
+            self.queue.progress(job.job_id, chunks_done=4)
+            self.queue.fail(job.job_id, error="boom")
+            # 跳过退避等待
+            self.queue._conn.execute("UPDATE jobs SET available_at = 0")
+        job = self.queue.get(job.job_id)
+        self.assertEqual(job.state, JobState.FAILED)
+        self.assertEqual(job.chunks_done, 4)
+        job = self.queue.retry(job.job_id)
+        self.assertEqual(job.state, JobState.PENDING)
+        self.assertEqual(self.queue.claim().chunks_done, 4)
+
+    def test_heartbeat(self):
+        """没有进度回调的长时间步骤中，后台心跳使任务不被其它工作进程重新领取"""
+        job = self.submit()
+        self.queue.claim()
+        stale = time.time() - JobConfig.STALE_SECONDS - 1
+        self.queue._conn.execute("UPDATE jobs SET heartbeat_at = ?", (stale,))
+        with heartbeat(self.queue, job.job_id, interval=0.01):
+            time.sleep(0.1)
+        self.assertIsNone(self.queue.claim())
+        self.queue.finish(job.job_id)
+        self.queue.heartbeat(job.job_id)
+        self.assertEqual(JobState.DONE, self.queue.get(job.job_id).state)
+
+    def test_retry_not_failed(self):
+        job = self.submit()
+        with self.assertRaises(JobStateException):
+            self.queue.retry(job.job_id)
+
+    def test_get_not_found(self):
+        with self.assertRaises(JobNotFoundException):
+            self.queue.get("missing")
+
+    def test_kind(self):
+        self.assertEqual(JobKind.INGEST, self.submit().kind)
+        job = self.queue.submit(kb_id="Hello;bge-m3", file_id="file", filename="test.docx", filepath="test.docx",
+                                kind=JobKind.REPLACE)
+        self.assertEqual(JobKind.REPLACE, self.queue.get(job.job_id).kind)
+
+    def test_migrate_kind(self):
+        path = os.path.join(self.tmp.name, "old.db")
+        connect(path).execute("CREATE TABLE jobs (job_id TEXT PRIMARY KEY, kb_id TEXT NOT NULL, file_id TEXT NOT NULL, "
+                              "filename TEXT NOT NULL, filepath TEXT NOT NULL, state TEXT NOT NULL, "
+                              "attempts INTEGER NOT NULL DEFAULT 0, chunks_total INTEGER, "
+                              "chunks_done INTEGER NOT NULL DEFAULT 0, error TEXT, created_at REAL NOT NULL, "
+                              "available_at REAL NOT NULL, started_at REAL, heartbeat_at REAL, finished_at REAL, "
+                              "parse_seconds REAL NOT NULL DEFAULT 0, write_seconds REAL NOT NULL DEFAULT 0)")
+        job = JobQueue(path).submit(kb_id="Hello;bge-m3", file_id="file", filename="test.docx", filepath="test.docx")
+        self.assertEqual(JobKind.INGEST, job.kind)
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from kb.kb_cache import LRUCache, KBGeneration
+
+
+class TestLRUCache(TestCase):
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache("test", max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+        self.assertEqual({"size": 2, "max_size": 2, "hits": 3, "misses": 1, "hit_ratio": 0.75}, cache.stats())
+
+    def test_ttl(self):
+        cache = LRUCache("test", max_size=2, ttl=0.01)
+        cache.put("a", 1)
+        self.assertEqual(1, cache.get("a"))
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+
+
+class TestKBGeneration(TestCase):
+
+    def test_bump(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "generations.db")
+            generation = KBGeneration(path)
+            self.assertEqual(0, generation.current("Hello;bge-m3"))
+            generation.bump("Hello;bge-m3")
+            # 其它进程中的实例读取到相同的版本号
+            self.assertEqual(1, KBGeneration(path).current("Hello;bge-m3"))
+            self.assertEqual(0, generation.current("Other;bge-m3"))
+
+    def test_async(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            generation = KBGeneration(os.path.join(tmp, "generations.db"))
+
+            async def bump_and_read():
+                await generation.abump("Hello;bge-m3")
+                return await generation.acurrent("Hello;bge-m3")
+
+            self.assertEqual(1, asyncio.run(bump_and_read()))
@@ -1,8 +1,10 @@
+import asyncio
 from unittest import TestCase
 
 import qdrant_client.models
 
-from kb.kb_core import VectorKB, Document
+from kb.kb_cache import get_generation
+from kb.kb_core import VectorKB, Document, client
 
 
 class TestVectorKB(TestCase):
@@ -13,11 +15,30 @@ class TestVectorKB(TestCase):
         res = test_kb.add_kb_split(Document("Hello", metadata={"_id": "wuhu"}))
         self.assertIsInstance(res, qdrant_client.models.UpdateResult)
 
+    def test_add_kb_splits(self):
+        test_kb = VectorKB(kb_id=TestVectorKB.test_kb_id)
+        res = test_kb.add_kb_splits([Document("Hello", metadata={"_id": "wuhu"}),
+                                     Document("World", metadata={"_id": "wuhu"})])
+        self.assertIsInstance(res, qdrant_client.models.UpdateResult)
+
+    def test_add_empty_splits(self):
+        test_kb = VectorKB(kb_id=TestVectorKB.test_kb_id)
+        generation = get_generation().current(test_kb.kb_id)
+        self.assertIsNone(test_kb.add_kb_splits([]))
+        self.assertIsNone(asyncio.run(test_kb.aadd_kb_splits([])))
+        # 没有写入时查询缓存仍然有效
+        self.assertEqual(generation, get_generation().current(test_kb.kb_id))
+
     def test_query_doc(self):
         test_kb = VectorKB(kb_id=TestVectorKB.test_kb_id)
         docs = test_kb.query_doc(query="Hello")
         self.assertGreaterEqual(len(docs), 1)
 
+    def test_aquery_doc(self):
+        test_kb = VectorKB(kb_id=TestVectorKB.test_kb_id)
+        docs = asyncio.run(test_kb.aquery_doc(query="Hello"))
+        self.assertGreaterEqual(len(docs), 1)
+
     def test_filter_by(self):
         test_kb = VectorKB(kb_id=TestVectorKB.test_kb_id)
         res = test_kb.filter_by()
@@ -31,3 +52,13 @@ class TestVectorKB(TestCase):
         test_kb = VectorKB(kb_id=TestVectorKB.test_kb_id)
         res = test_kb.remove_kb_split(ids="7425e378-985a-4b13-acac-c7ac846bfe43")
         self.assertTrue(res)
+
+    def test_collection_check_cached(self):
+        test_kb = VectorKB(kb_id="Cached;bge-m3")
+        test_kb.add_kb_split(Document("Hello", metadata={"_id": "wuhu"}))
+        self.assertTrue(test_kb._collection_checked())
+        # 缓存期内集合被删除，操作时应当重新创建集合
+        client.delete_collection(test_kb.kb_id)
+        test_kb.add_kb_split(Document("Hello", metadata={"_id": "wuhu"}))
+        self.assertEqual(1, len(test_kb.filter_by()))
+        client.delete_collection(test_kb.kb_id)
@@ -0,0 +1,117 @@
+import os
+import tempfile
+import uuid
+from unittest import TestCase
+
+import docx
+from openai.types.embedding import Embedding
+
+from docx_factory import make_sections
+from kb import kb_parse_pool
+from kb.doc_retriever import get_doc_kb_by_id
+from kb.embedding.kb_embedding import EmbeddingModel, get_all_embeddings, get_embedding_model, register
+from kb.kb_config import DocxSchema, NumpyKBConfig
+from kb.kb_core import get_kb_by_id
+from kb.kb_file import replace_kb_docx, write_to_kb_with_docx
+from kb.kb_profile import Backend, StorageProfile, get_profile_store
+
+
+class RecordingEmbedding(EmbeddingModel):
+    """记录向量化的文本，向量为固定的字符统计，不需要 Embedding 服务"""
+
+    def __init__(self):
+        super().__init__(size=4)
+        self.texts = []
+
+    def embed(self, query: str) -> Embedding:
+        return self.embed_batch([query])[0]
+
+    def embed_batch(self, texts: list[str]) -> list[Embedding]:
+        self.texts.extend(texts)
+        return [Embedding(embedding=[float(len(text)), float(text.count("段")), float(text.count("表")), 1.],
+                          index=i, object="embedding") for i, text in enumerate(texts)]
+
+
+if "recording" not in get_all_embeddings():
+    register("recording", RecordingEmbedding())
+
+
+def paragraph(chapter: int, section: int, n: int) -> str:
+    """`make_sections` 生成的正文段落"""
+    return f"第{chapter}章第{section}节的第{n}段。" * 10
+
+
+class TestReplaceKBDocx(TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        kb_parse_pool.shutdown()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = NumpyKBConfig.DATA_PATH
+        NumpyKBConfig.DATA_PATH = self.tmp.name
+        self.kb_id = f"{uuid.uuid4().hex};recording"
+        get_profile_store().put(self.kb_id, StorageProfile(backend=Backend.NUMPY))
+        self.file_id = str(uuid.uuid4())
+        self.embedding = get_embedding_model("recording")
+        self.embedding.texts.clear()
+
+    def tearDown(self):
+        NumpyKBConfig.DATA_PATH = self.path
+        self.tmp.cleanup()
+
+    def points(self) -> dict[str, str]:
+        """知识块内容到id的映射"""
+        return {point.payload[DocxSchema.PAGE_CONTENT]: str(point.id)
+                for point in get_kb_by_id(self.kb_id).file_points(self.file_id)}
+
+    def test_replace(self):
+        v1, v2 = os.path.join(self.tmp.name, "v1.docx"), os.path.join(self.tmp.name, "v2.docx")
+        make_sections(v1, sections=2, paragraphs=3)
+        write_to_kb_with_docx(v1, self.kb_id, "doc.docx", self.file_id)
+        before = self.points()
+        self.assertEqual(16, len(before))
+        # 修改两个段落，删除一个段落，删除位置之后的知识块顺序发生变化
+        d = docx.Document(v1)
+        for p in d.paragraphs:
+            if p.text in (paragraph(0, 0, 1), paragraph(1, 1, 2)):
+                p.text = p.text.replace("段", "段（修改）")
+            elif p.text == paragraph(1, 0, 0):
+                p._element.getparent().remove(p._element)
+        d.save(v2)
+        self.embedding.texts.clear()
+
+        stats = replace_kb_docx(v2, self.kb_id, "doc.docx", self.file_id)
+        after = self.points()
+        self.assertEqual((2, 6, 7, 3), (stats.added, stats.updated, stats.unchanged, stats.removed))
+        # 只有修改的两个知识块重新向量化
+        self.assertEqual(2, len(self.embedding.texts))
+        self.assertTrue(all("（修改）" in text for text in self.embedding.texts))
+        self.assertEqual(15, len(after))
+        kept = before.keys() & after.keys()
+        self.assertEqual(13, len(kept))
+        self.assertTrue(all(before[content] == after[content] for content in kept))
+        removed = {before[content] for content in before.keys() - after.keys()}
+        self.assertEqual(3, len(removed))
+        added = {after[content] for content in after.keys() - before.keys()}
+        self.assertEqual(2, len(added))
+        self.assertFalse(added & set(before.values()))
+        self.assertFalse(removed & set(after.values()))
+        # 顺序变化的知识块只更新了元数据
+        orders = [point.payload[DocxSchema.METADATA][DocxSchema.ORDER_BY]
+                  for point in get_kb_by_id(self.kb_id).file_points(self.file_id)]
+        self.assertEqual(list(range(1, 16)), sorted(orders))
+        # 段落按新版本重新合并
+        sections = get_doc_kb_by_id(self.kb_id)._sections.snapshot()
+        text = "\n".join(record.payload[DocxSchema.PAGE_CONTENT]
+                         for record in sections.records(sections.select(None)))
+        self.assertIn("第0章第0节的第1段（修改）。", text)
+        self.assertNotIn(paragraph(1, 0, 0), text)
+
+        # 重复执行结果相同
+        self.embedding.texts.clear()
+        stats = replace_kb_docx(v2, self.kb_id, "doc.docx", self.file_id)
+        self.assertEqual((0, 0, 15, 0), tuple(stats))
+        self.assertEqual([], self.embedding.texts)
+        self.assertEqual(after, self.points())
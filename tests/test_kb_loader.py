@@ -1,7 +1,9 @@
 import os
+import tempfile
 from unittest import TestCase
 
-from kb.kb_loader import DocxLoader
+from docx_factory import make_edge_cases
+from kb.kb_loader import DocxLoader, DocxStreamLoader
 
 
 class TestDocxLoader(TestCase):
@@ -24,3 +26,31 @@ class TestDocxLoader(TestCase):
         doc = DocxLoader(file_path)
         for d in doc.lazy_load():
             self.assertIsNotNone(d.page_content, d.metadata)
+
+
+class TestDocxStreamLoader(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.img_path = os.path.join(self.tmp.name, "img")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def load(self, loader_cls, file_path):
+        loader = loader_cls(file_path, img_path=self.img_path, doc_id="doc")
+        loader.root.value = "文档.docx"
+        return [(d.page_content, d.metadata) for d in loader.lazy_load()]
+
+    def test_same_as_docx_loader(self):
+        file_path = os.path.join(self.tmp.name, "test.docx")
+        make_edge_cases(file_path)
+        expected = self.load(DocxLoader, file_path)
+        self.assertEqual(expected, self.load(DocxStreamLoader, file_path))
+        self.assertEqual(25, len(expected))
+        # 相同的图片只保存一次
+        self.assertEqual(1, len(os.listdir(self.img_path)))
+
+    def test_same_as_docx_loader_on_test_file(self):
+        file_path = TestDocxLoader.test_file
+        self.assertEqual(self.load(DocxLoader, file_path), self.load(DocxStreamLoader, file_path))
@@ -0,0 +1,55 @@
+import asyncio
+import os
+import tempfile
+from unittest import TestCase
+
+from qdrant_client import models
+
+from kb.kb_profile import ProfileStore, Quantization, StorageProfile
+
+
+class TestStorageProfile(TestCase):
+
+    def test_default(self):
+        params = StorageProfile().create_params(1024)
+        self.assertEqual(models.VectorParams(size=1024, distance=models.Distance.COSINE), params["vectors_config"])
+        self.assertIsNone(params["quantization_config"])
+        self.assertIsNone(params["hnsw_config"])
+        self.assertIsNone(params["optimizers_config"])
+        self.assertIsNone(StorageProfile().search_params())
+        self.assertEqual(models.Disabled.DISABLED, StorageProfile().update_params()["quantization_config"])
+
+    def test_quantization(self):
+        profile = StorageProfile(quantization=Quantization.INT8, on_disk=True, oversampling=2, hnsw_m=32,
+                                 indexing_threshold=0)
+        params = profile.create_params(1024)
+        self.assertTrue(params["vectors_config"].on_disk)
+        self.assertEqual(models.ScalarType.INT8, params["quantization_config"].scalar.type)
+        self.assertEqual(32, params["hnsw_config"].m)
+        self.assertEqual(0, params["optimizers_config"].indexing_threshold)
+        self.assertEqual(2, profile.search_params().quantization.oversampling)
+        binary = StorageProfile(quantization=Quantization.BINARY).quantization_config()
+        self.assertIsInstance(binary, models.BinaryQuantization)
+
+
+class TestProfileStore(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = ProfileStore(os.path.join(self.tmp.name, "profiles.db"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_put(self):
+        self.assertIsNone(self.store.get("Hello;bge-m3"))
+        self.store.put("Hello;bge-m3", StorageProfile(quantization=Quantization.INT8))
+        self.store.put("Hello;bge-m3", StorageProfile(quantization=Quantization.BINARY, on_disk=True))
+        self.assertEqual(StorageProfile(quantization=Quantization.BINARY, on_disk=True),
+                         self.store.get("Hello;bge-m3"))
+
+    def test_async(self):
+        profile = StorageProfile(quantization=Quantization.INT8)
+        asyncio.run(self.store.aput("Hello;bge-m3", profile))
+        self.assertEqual(profile, asyncio.run(self.store.aget("Hello;bge-m3")))
+        self.assertIsNone(asyncio.run(self.store.aget("Other;bge-m3")))
@@ -1,15 +1,44 @@
+import json
 import os
 from unittest import TestCase
 
 from fastapi.testclient import TestClient
 
 from common import ResponseCode
+from kb.file.file_service import get_upload_file_path
+from kb.file.file_store import get_file_store
+from kb.job.job_queue import get_job_queue
 from kb.kb_config import UploadConfig
-from kb.kb_router import router
+from kb.kb_core import Document
+from kb.kb_router import fuse_results, router
 
 client = TestClient(router)
 
 
+def fuse_key(doc: dict) -> tuple:
+    return doc['metadata'].get('file_id'), doc['metadata'].get('idx'), doc['page_content']
+
+
+def rrf_scores(results: list[list[dict]], k: int = 60) -> dict[tuple, float]:
+    scores = {}
+    for result in results:
+        for rank, doc in enumerate(result):
+            scores[fuse_key(doc)] = scores.get(fuse_key(doc), 0.) + 1 / (k + rank + 1)
+    return scores
+
+
+class TestFuseResults(TestCase):
+
+    def test_rrf_order(self):
+        a, b, c, d = [Document(text, {"file_id": "f", "idx": i}) for i, text in enumerate("abcd")]
+        dup = Document("a", {"file_id": "f", "idx": 0})
+        # a: 1/61 + 1/62，c: 1/63 + 1/61，b: 1/62，d: 1/63
+        fused = fuse_results([[a, b, c], [c, dup, d]], limit=10)
+        self.assertEqual(["a", "c", "b", "d"], [doc.page_content for doc in fused])
+        self.assertIs(a, fused[0])
+        self.assertEqual(["a", "c"], [doc.page_content for doc in fuse_results([[a, b, c], [c, dup, d]], limit=2)])
+
+
 class Test(TestCase):
     test_file = 'test.docx'
 
@@ -23,9 +52,27 @@ class Test(TestCase):
                                           "application/vnd.openxmlformats-officedocument.wordprocessingml.document")})
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.json().get('code'), ResponseCode.SUCCESS.value)
-        file_path = os.path.join(UploadConfig.UPLOAD_SAVING_PATH, resp.json().get('data')['file_id'] + '.docx')
+        file_id = resp.json().get('data')['file_id']
+        job_id = resp.json().get('data')['job_id']
+        self.assertTrue(os.path.exists(get_upload_file_path(file_id)))
+        # 相同内容再次上传返回同一个文档id
+        resp = client.put('/kb/file/Hello;bge-m3',
+                          files={"file": ('example_copy.docx', docx_content,
+                                          "application/vnd.openxmlformats-officedocument.wordprocessingml.document")})
+        self.assertEqual(resp.json().get('data')['file_id'], file_id)
+        self.assertTrue(resp.json().get('data')['duplicate'])
+        files = client.get('/kb/file/list/Hello;bge-m3').json().get('data')['files']
+        self.assertIn(file_id, [f['file_id'] for f in files])
+        resp = client.get(f'/kb/file/{file_id}', headers={"Range": "bytes=0-99"})
+        self.assertEqual(206, resp.status_code)
+        self.assertEqual(docx_content[:100], resp.content)
+        file_path = get_upload_file_path(file_id)
+        get_file_store().release(kb_id='Hello;bge-m3', file_id=file_id)
+        # 入库任务还没有执行，文件保留到任务结束
         self.assertTrue(os.path.exists(file_path))
-        os.remove(file_path)
+        get_job_queue().finish(job_id)
+        self.assertTrue(get_file_store().remove_unreferenced(file_path))
+        self.assertFalse(os.path.exists(file_path))
 
     def tearDown(self):
         if os.path.exists(UploadConfig.UPLOAD_SAVING_PATH):
@@ -40,11 +87,58 @@ class Test(TestCase):
         self.assertEqual(resp.json().get('code'), ResponseCode.SUCCESS.value)
         self.assertGreaterEqual(len(resp.json().get('data')), 1)
 
+    def test_query_kb_grouped(self):
+        resp = client.get("/kb/Hello;bge-m3/grouped",
+                          params={"query": "Hello", "group_by": "parent", "limit": 2, "group_size": 2})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json().get('code'), ResponseCode.SUCCESS.value)
+        for group in resp.json().get('data'):
+            self.assertLessEqual(len(group['docs']), 2)
+            self.assertTrue(all(doc['metadata']['parent'] == group['id'] for doc in group['docs']))
+
+    def test_batch_query_kb(self):
+        resp = client.post("/kb/Hello;bge-m3/batch_query",
+                           json={"queries": [{"query": "Hello"}, {"query": "你好", "limit": 1, "docs": ["file"]}],
+                                 "fuse": True})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json().get('code'), ResponseCode.SUCCESS.value)
+        data = resp.json().get('data')
+        self.assertEqual(2, len(data['results']))
+        self.assertEqual(0, len(data['results'][1]))
+        # 共享知识库中可能有内容相同的知识块，融合去重后数量可能少于原始结果
+        keys = [fuse_key(doc) for doc in data['fused']]
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertLessEqual(len(data['fused']), len(data['results'][0]))
+        scores = rrf_scores(data['results'])
+        fused_scores = [scores[key] for key in keys]
+        self.assertEqual(sorted(fused_scores, reverse=True), fused_scores)
+
+    def test_put_kb(self):
+        resp = client.put('/kb/Hello;bge-m3', json={"quantization": "int8", "oversampling": 2})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json().get('code'), ResponseCode.SUCCESS.value)
+        self.assertEqual("int8", client.get('/kb/Hello;bge-m3/profile').json().get('data')['quantization'])
+        client.put('/kb/Hello;bge-m3', json={})
+
     def test_filter_kb(self):
         resp = client.post('/kb/Hello;bge-m3')
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.json().get('code'), ResponseCode.SUCCESS.value)
-        self.assertGreaterEqual(len(resp.json().get('data')), 1)
+        self.assertGreaterEqual(len(resp.json().get('data')['records']), 1)
+
+    def test_filter_kb_cursor(self):
+        """按游标遍历的结果与一次查询全部的结果一致"""
+        records, cursor = [], None
+        while True:
+            data = client.post('/kb/Hello;bge-m3', params={"limit": 2, "cursor": cursor}).json().get('data')
+            records.extend(data['records'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        resp = client.get('/kb/Hello;bge-m3/export')
+        self.assertEqual(resp.status_code, 200)
+        lines = [json.loads(line) for line in resp.text.splitlines()]
+        self.assertEqual([r['page_content'] for r in records], [line['page_content'] for line in lines])
 
     def test_delete_doc(self):
         resp = client.delete('/kb/Hello;bge-m3',
@@ -54,3 +148,23 @@ class Test(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.json().get('code'), ResponseCode.SUCCESS.value)
         self.assertEqual(resp.json().get('msg'), "成功删除")
+
+    def test_replace_file(self):
+        """测试文档替换，内容相同时不提交任务"""
+        with open(Test.test_file, 'rb') as docx_file:
+            docx_content = docx_file.read()
+        resp = client.put('/kb/file/Hello;bge-m3',
+                          files={"file": ('example.docx', docx_content,
+                                          "application/vnd.openxmlformats-officedocument.wordprocessingml.document")})
+        file_id = resp.json().get('data')['file_id']
+        job_id = resp.json().get('data')['job_id']
+        resp = client.put(f'/kb/file/Hello;bge-m3/{file_id}',
+                          files={"file": ('example.docx', docx_content,
+                                          "application/vnd.openxmlformats-officedocument.wordprocessingml.document")})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json().get('data')['file_id'], file_id)
+        self.assertFalse(resp.json().get('data')['changed'])
+        file_path = get_upload_file_path(file_id)
+        get_file_store().release(kb_id='Hello;bge-m3', file_id=file_id)
+        get_job_queue().finish(job_id)
+        get_file_store().remove_unreferenced(file_path)
@@ -0,0 +1,144 @@
+import gzip
+import json
+import os
+import tempfile
+import uuid
+from unittest import TestCase
+
+import numpy as np
+from openai.types.embedding import Embedding
+from qdrant_client import models
+
+from kb import kb_snapshot
+from kb.doc_retriever import SECTIONS_SUFFIX, get_doc_kb_by_id
+from kb.embedding.kb_embedding import EmbeddingModel, get_all_embeddings, register
+from kb.kb_config import DocxSchema, QdrantConfig
+from kb.kb_core import PAYLOAD_INDEXES, Document, client, get_kb_by_id
+from kb.kb_excep import SnapshotException
+
+LETTERS = "abcdefgh"
+
+
+class LetterEmbedding(EmbeddingModel):
+    """按字母出现次数生成向量，不需要 Embedding 服务"""
+
+    def __init__(self):
+        super().__init__(size=len(LETTERS))
+
+    def embed(self, query: str) -> Embedding:
+        return self.embed_batch([query])[0]
+
+    def embed_batch(self, texts: list[str]) -> list[Embedding]:
+        return [Embedding(embedding=[float(text.count(c)) + 0.1 for c in LETTERS], index=i, object="embedding")
+                for i, text in enumerate(texts)]
+
+
+if "snapshot-letters" not in get_all_embeddings():
+    register("snapshot-letters", LetterEmbedding())
+
+
+class TestKBSnapshot(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_snapshot_path(self):
+        self.assertEqual(os.path.join(QdrantConfig.SNAPSHOT_PATH, "hello-1.0"), kb_snapshot.snapshot_path("hello-1.0"))
+        for name in ["../hello", "a/b", ".hidden", "", "a" * 200]:
+            with self.assertRaises(SnapshotException):
+                kb_snapshot.snapshot_path(name)
+
+    def test_read_manifest(self):
+        with self.assertRaises(SnapshotException):
+            kb_snapshot.read_manifest(self.tmp.name)
+        with open(os.path.join(self.tmp.name, kb_snapshot.MANIFEST), "w") as f:
+            json.dump({"version": kb_snapshot.FORMAT_VERSION + 1}, f)
+        with self.assertRaises(SnapshotException):
+            kb_snapshot.read_manifest(self.tmp.name)
+
+    def test_batched(self):
+        self.assertEqual([["a", "b"], ["c"]], list(kb_snapshot._batched(iter("abc"), 2)))
+
+    def test_uploader_error(self):
+        point = models.PointStruct(id=str(uuid.uuid4()), vector=[0.1] * len(LETTERS), payload={})
+        with self.assertRaises(Exception):
+            with kb_snapshot._Uploader(1) as uploader:
+                uploader.submit(f"missing-{uuid.uuid4().hex}", [point])
+
+
+class TestKBSnapshotRoundTrip(TestCase):
+    """导出后以新的知识库id导入，使用与接口测试相同的 Qdrant"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        name = uuid.uuid4().hex[:8]
+        self.source, self.target = f"snap{name};snapshot-letters", f"snap{name}copy;snapshot-letters"
+        parents = [str(uuid.uuid4()), str(uuid.uuid4())]
+        docs = [Document(text, {DocxSchema.FILE_ID: "f1", DocxSchema.PARENT_ID: parents[i // 3],
+                                DocxSchema.ORDER_BY: i})
+                for i, text in enumerate(["# t\naa", "# t\nab", "# t\nac", "# u\nbb", "# u\nbc", "# u\ncc"])]
+        get_kb_by_id(self.source).add_kb_splits(docs, ids=[str(uuid.uuid4()) for _ in docs])
+        get_doc_kb_by_id(self.source).build_sections("f1")
+
+    def tearDown(self):
+        for kb_id in (self.source, self.target):
+            for collection_name in (kb_id, f"{kb_id}{SECTIONS_SUFFIX}"):
+                if client.collection_exists(collection_name=collection_name):
+                    client.delete_collection(collection_name=collection_name)
+        self.tmp.cleanup()
+
+    @staticmethod
+    def records(collection_name: str, with_vectors: bool = False) -> dict:
+        records, _ = client.scroll(collection_name=collection_name, limit=100, with_payload=True,
+                                   with_vectors=with_vectors)
+        return {record.id: (record.payload, record.vector) for record in records}
+
+    @staticmethod
+    def indexes(collection_name: str) -> set[str]:
+        return set(client.get_collection(collection_name=collection_name).payload_schema) & set(PAYLOAD_INDEXES)
+
+    def test_round_trip(self):
+        source = self.records(self.source, with_vectors=True)
+        for dtype, atol in [("float32", 1e-6), ("float16", 1e-3)]:
+            with self.subTest(dtype=dtype):
+                path = os.path.join(self.tmp.name, dtype)
+                manifest = kb_snapshot.export_kb(self.source, path, dtype=dtype)
+                self.assertEqual((6, 2, dtype), (manifest["count"], manifest["sections"], manifest["dtype"]))
+                self.assertEqual((6, len(LETTERS)), np.load(os.path.join(path, kb_snapshot.VECTORS)).shape)
+                self.assertEqual(np.dtype(dtype), np.load(os.path.join(path, kb_snapshot.VECTORS)).dtype)
+
+                kb_snapshot.import_kb(path, kb_id=self.target)
+                target = self.records(self.target, with_vectors=True)
+                self.assertEqual(source.keys(), target.keys())
+                for point_id, (payload, vector) in source.items():
+                    self.assertEqual(payload, target[point_id][0])
+                    np.testing.assert_allclose(vector, target[point_id][1], atol=atol)
+                self.assertEqual(self.records(f"{self.source}{SECTIONS_SUFFIX}"),
+                                 self.records(f"{self.target}{SECTIONS_SUFFIX}"))
+                # 导入创建的集合与写入创建的集合有相同的 payload 索引，本地模式不支持索引，两者都为空
+                self.assertEqual(self.indexes(self.source), self.indexes(self.target))
+                self.assertEqual(["# t\naa\nb\nc"], [d.page_content for d in get_doc_kb_by_id(self.target).query_doc(
+                    query="aaa", limit=1)])
+
+    def test_export_dtype(self):
+        with self.assertRaises(SnapshotException):
+            kb_snapshot.export_kb(self.source, self.tmp.name, dtype="int8")
+
+    def test_import_shape_mismatch(self):
+        kb_snapshot.export_kb(self.source, self.tmp.name)
+        np.save(os.path.join(self.tmp.name, kb_snapshot.VECTORS), np.zeros((5, len(LETTERS)), dtype=np.float32))
+        with self.assertRaises(SnapshotException):
+            kb_snapshot.import_kb(self.tmp.name, kb_id=self.target)
+
+    def test_import_count_mismatch(self):
+        kb_snapshot.export_kb(self.source, self.tmp.name)
+        points = os.path.join(self.tmp.name, kb_snapshot.POINTS)
+        with gzip.open(points, "rt", encoding="utf-8") as f:
+            lines = f.readlines()
+        with gzip.open(points, "wt", encoding="utf-8") as f:
+            f.writelines(lines[:-1])
+        with self.assertRaises(SnapshotException):
+            kb_snapshot.import_kb(self.tmp.name, kb_id=self.target)
@@ -0,0 +1,81 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from fastapi import APIRouter, FastAPI
+from fastapi.testclient import TestClient
+
+import metrics
+from kb.kb_metrics import ENCODE_SECONDS, REQUEST_ERRORS, REQUEST_SECONDS, MetricsRoute, MetricsStore
+from metrics import Counter, Histogram
+
+
+class TestMetrics(TestCase):
+
+    def test_render(self):
+        counter = Counter("test_render_total", "计数", labelnames=("kb_id",))
+        counter.labels(kb_id='a"b').inc(2)
+        histogram = Histogram("test_render_seconds", "耗时", buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        text = metrics.render(metrics.snapshot([counter, histogram]))
+        self.assertIn('# TYPE test_render_total counter\ntest_render_total{kb_id="a\\"b"} 2.0\n', text)
+        self.assertIn('test_render_seconds_bucket{le="0.1"} 1\n'
+                      'test_render_seconds_bucket{le="1.0"} 2\n'
+                      'test_render_seconds_bucket{le="+Inf"} 3\n'
+                      'test_render_seconds_sum 5.55\n'
+                      'test_render_seconds_count 3\n', text)
+
+    def test_merge(self):
+        counter = Counter("test_merge_total", "计数", labelnames=("model",))
+        histogram = Histogram("test_merge_seconds", "耗时", buckets=(1,))
+        counter.labels(model="m1").inc()
+        histogram.observe(0.5)
+        first = metrics.snapshot([counter, histogram])
+        counter.labels(model="m2").inc(3)
+        histogram.observe(2)
+        merged = metrics.merge(first, metrics.snapshot([counter, histogram]))
+        self.assertEqual([[["m1"], 2.], [["m2"], 3.]], merged["test_merge_total"]["samples"])
+        self.assertEqual({"buckets": [1], "counts": [2, 1], "sum": 3.}, merged["test_merge_seconds"]["samples"][0][1])
+
+
+class TestMetricsStore(TestCase):
+
+    def test_collect(self):
+        counter = Counter("test_store_total", "计数")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.db")
+            # 模拟工作进程写入快照后 API 进程读取
+            worker, api = MetricsStore(path), MetricsStore(path)
+            counter.inc(2)
+            worker.flush()
+            counter.inc()
+            # 当前进程的实时值与工作进程的快照相加
+            self.assertEqual([[[], 5.]], api.collect()["test_store_total"]["samples"])
+            self.assertEqual([[[], 3.]], worker.collect()["test_store_total"]["samples"])
+
+
+class TestMetricsRoute(TestCase):
+
+    def test_route(self):
+        router = APIRouter(prefix="/items", route_class=MetricsRoute)
+
+        @router.get("/{item_id}")
+        async def get_item(item_id: str):
+            return {"id": item_id}
+
+        @router.get("/{item_id}/fail")
+        def fail_item(item_id: str):
+            raise ValueError(item_id)
+
+        app = FastAPI()
+        app.include_router(router)
+        client = TestClient(app, raise_server_exceptions=False)
+        self.assertEqual({"id": "1"}, client.get("/items/1").json())
+        self.assertEqual({"id": "2"}, client.get("/items/2").json())
+        self.assertEqual(500, client.get("/items/3/fail").status_code)
+        # 按路由模板统计
+        self.assertEqual(2, REQUEST_SECONDS.labels(route="/items/{item_id}", method="GET", status=200).count)
+        self.assertEqual(2, ENCODE_SECONDS.labels(route="/items/{item_id}").count)
+        self.assertEqual(1, REQUEST_ERRORS.labels(route="/items/{item_id}/fail", error="ValueError").value)
@@ -0,0 +1,137 @@
+import asyncio
+import tempfile
+import uuid
+from unittest import TestCase
+
+from openai.types.embedding import Embedding
+from qdrant_client import models
+
+from kb.embedding.kb_embedding import EmbeddingModel, get_all_embeddings, register
+from kb.kb_cache import get_generation
+from kb.kb_config import DocxSchema, NumpyKBConfig
+from kb.kb_core import Document
+from kb.kb_excep import InvalidConditionException
+from kb.numpy_kb import NumpyDocRetriever, NumpyKB, NumpyStore
+
+LETTERS = "abcdefgh"
+
+
+class LetterEmbedding(EmbeddingModel):
+    """按字母出现次数生成向量，相似度可以直接推算"""
+
+    def __init__(self):
+        super().__init__(size=len(LETTERS))
+
+    def embed(self, query: str) -> Embedding:
+        return self.embed_batch([query])[0]
+
+    def embed_batch(self, texts: list[str]) -> list[Embedding]:
+        return [Embedding(embedding=[float(text.count(c)) for c in LETTERS], index=i, object="embedding")
+                for i, text in enumerate(texts)]
+
+
+if "letters" not in get_all_embeddings():
+    register("letters", LetterEmbedding())
+
+
+def doc(content: str, file_id: str, parent: str = None, idx: int = 0) -> Document:
+    return Document(content, {DocxSchema.FILE_ID: file_id, DocxSchema.PARENT_ID: parent, DocxSchema.ORDER_BY: idx})
+
+
+class TestNumpyKB(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = NumpyKBConfig.DATA_PATH
+        NumpyKBConfig.DATA_PATH = self.tmp.name
+        self.kb = NumpyKB(f"{uuid.uuid4().hex};letters")
+
+    def tearDown(self):
+        NumpyKBConfig.DATA_PATH = self.path
+        self.tmp.cleanup()
+
+    def test_query(self):
+        self.assertEqual([], self.kb.query_doc(query="a"))
+        self.kb.add_kb_splits([doc("aaa", "f1"), doc("bbb", "f1"), doc("abab", "f2"), doc("hhh", "f2")])
+        self.assertEqual(["aaa", "abab"], [d.page_content for d in self.kb.query_doc(query="a", limit=2)])
+        self.assertEqual(["abab"], [d.page_content for d in self.kb.query_doc(
+            query="a", limit=1, filter_condition={DocxSchema.FILE_ID: "f2"})])
+        res = asyncio.run(self.kb.aquery_batch(["b", "h"], limits=[1, 1]))
+        self.assertEqual([["bbb"], ["hhh"]], [[d.page_content for d in docs] for docs in res])
+        groups = self.kb.query_groups(query="a", group_by=DocxSchema.FILE_ID, limit=2, group_size=2)
+        self.assertEqual(["f1", "f2"], [group for group, _ in groups])
+        self.assertEqual(["aaa", "bbb"], [d.page_content for d in groups[0][1]])
+
+    def test_write(self):
+        ids = [str(uuid.uuid4()) for _ in range(20)]
+        self.kb.add_kb_splits([doc(c * 3, f"f{i % 2}") for i, c in enumerate(LETTERS * 2 + "abcd")], ids=ids)
+        records, offset, pages = [], None, 0
+        while True:
+            page, offset = self.kb.scroll_page(limit=6, offset=offset)
+            records.extend(page)
+            pages += 1
+            if offset is None:
+                break
+        self.assertEqual((20, 4), (len(records), pages))
+        self.assertEqual(sorted(ids), [r.id for r in records])
+
+        self.kb.update_metadata({ids[0]: {DocxSchema.FILE_ID: "moved"}})
+        self.assertEqual(["aaa"], [d.page_content for d in self.kb.filter_by(filter_condition={
+            DocxSchema.FILE_ID: "moved"})])
+        self.kb.remove_kb_split("f1")
+        self.assertEqual(10, len(self.kb.file_points("f0")) + len(self.kb.file_points("moved")))
+        # 反复覆盖后向量文件被重写，结果不变
+        for _ in range(3):
+            self.kb.add_kb_splits([doc("ggg", "f0")], ids=[ids[6]])
+        self.assertEqual("ggg", self.kb.query_doc(query="g", limit=1)[0].page_content)
+        # 其它连接（其它进程）看到相同的数据
+        other = NumpyStore(self.kb._store.path).snapshot()
+        self.assertEqual(10, len(other))
+        self.assertFalse(self.kb.is_empty())
+
+    def test_add_empty(self):
+        generation = get_generation().current(self.kb.kb_id)
+        self.kb.add_kb_splits([])
+        asyncio.run(self.kb.aadd_kb_splits([]))
+        self.assertTrue(self.kb.is_empty())
+        self.assertEqual(generation, get_generation().current(self.kb.kb_id))
+
+    def test_sections(self):
+        parent = str(uuid.uuid4())
+        self.kb.add_kb_splits([doc("# t\naa", "f1", parent, 0), doc("# t\nbb", "f1", parent, 1),
+                               doc("hh", "f1", str(uuid.uuid4()), 2)])
+        retriever = NumpyDocRetriever(self.kb)
+        retriever.build_sections("f1")
+        self.assertEqual(["# t\naa\nbb"], [d.page_content for d in retriever.query_doc(query="a", limit=1)])
+        res = asyncio.run(retriever.aquery_doc(query="a", limit=1))
+        self.assertEqual(["# t\naa\nbb"], [d.page_content for d in res])
+        retriever.remove_sections(["f1"])
+        self.assertEqual(0, len(retriever._sections.snapshot()))
+
+
+class TestNumpyStoreFilter(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = NumpyStore(self.tmp.name)
+        self.store.upsert([1, 2, 3], None, [{"tag": ["x", "y"], "n": {"k": 1}}, {"tag": "y", "n": {"k": 2}},
+                                            {"n": [{"k": 3}]}])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def select(self, **kwargs) -> list:
+        snapshot = self.store.snapshot()
+        return [snapshot.ids[i] for i in snapshot.select(models.Filter(**kwargs))]
+
+    def test_filter(self):
+        self.assertEqual([1, 2], self.select(must=[models.FieldCondition(key="tag", match=models.MatchValue(
+            value="y"))]))
+        self.assertEqual([1, 3], self.select(should=[
+            models.FieldCondition(key="tag", match=models.MatchValue(value="x")),
+            models.FieldCondition(key="n[].k", match=models.MatchAny(any=[3]))]))
+        self.assertEqual([2, 3], self.select(must_not=[models.HasIdCondition(has_id=[1])]))
+        self.assertEqual([1], self.select(must=[models.FieldCondition(key="tag", match=models.MatchExcept(
+            **{"except": ["y"]}))]))
+        with self.assertRaises(InvalidConditionException):
+            self.select(must=[models.FieldCondition(key="n.k", range=models.Range(gt=1))])
@@ -0,0 +1,63 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+from openai.types.embedding import Embedding
+
+from kb.embedding.kb_embedding import EmbeddingModel, awarm_up
+
+COLD_START_BUDGET = 5
+"""导入应用的耗时上限（秒）"""
+
+
+class ProbeEmbedding(EmbeddingModel):
+    """记录探测次数的模型"""
+
+    def __init__(self, fail=False):
+        super().__init__()
+        self.fail = fail
+        self.calls = 0
+
+    def embed(self, query: str) -> Embedding:
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("unreachable")
+        return Embedding(embedding=[0., 1., 2.], index=0, object="embedding")
+
+
+class TestStartup(TestCase):
+
+    def test_cold_start(self):
+        # 模型服务不可达时导入应用也不应该被阻塞
+        env = dict(os.environ, LOCATION=":memory:", BASE_URL="http://127.0.0.1:9/v1", EMBEDDED_WORKERS="false")
+        code = "import time; t = time.monotonic(); import app; print(time.monotonic() - t)"
+        out = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+        seconds = json.loads(out.stdout.strip().splitlines()[-1])
+        self.assertLess(seconds, COLD_START_BUDGET)
+
+    def test_lazy_size(self):
+        model = ProbeEmbedding()
+        self.assertEqual(0, model.calls)
+        self.assertEqual(3, model.size)
+        self.assertEqual(3, model.size)
+        self.assertEqual(1, model.calls)
+
+    def test_declared_size(self):
+        model = ProbeEmbedding()
+        model.size = 1024
+        self.assertEqual(1024, model.size)
+        self.assertEqual(0, model.calls)
+
+    def test_warm_up(self):
+        ok, bad = ProbeEmbedding(), ProbeEmbedding(fail=True)
+        state = asyncio.run(awarm_up({"ok": ok, "bad": bad}))
+        self.assertEqual({"ok": "ready", "bad": "failed"}, state.models)
+        self.assertFalse(state.ready)
+        self.assertEqual(3, ok.size)
+        self.assertEqual(1, ok.calls)
+        # 失败的模型在首次使用时再次探测
+        with self.assertRaises(ConnectionError):
+            _ = bad.size